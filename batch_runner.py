@@ -0,0 +1,168 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from data_context import DataContext
+from metrics import Metrics
+from multiprocessing import shared_memory
+from utils import Utils
+from typing import Dict, List, TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    from price_history import PriceHistory
+
+class SharedPrices:
+    # The price matrix and its axis of days in shared memory. The batch's parent loads the prices once
+    # and shares them, and every worker builds its price history over the same pages instead of
+    # reading its own copy. The parent owns the blocks and removes them when the batch is done.
+    def __init__(self) -> None:
+        self.blocks: List[shared_memory.SharedMemory] = []
+
+    def share(self, price_history: 'PriceHistory') -> Dict:
+        # what attach() needs to find the arrays, small enough to hand to every worker
+        arrays = {}
+        for (name, array) in [('values', price_history.values), ('rowDays', price_history.rowDays)]:
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            arrays[name] = (block.name, array.shape, array.dtype.str)
+        return {
+            'arrays': arrays,
+            'symbols': sorted(price_history.symbolIndex, key=price_history.symbolIndex.get),
+            'version': price_history.version,
+        }
+
+    def attach(self, shared: Dict) -> 'PriceHistory':
+        from price_history import PriceHistory
+        arrays = {}
+        for (name, (block_name, shape, dtype)) in shared['arrays'].items():
+            block = shared_memory.SharedMemory(name=block_name)
+            self.blocks.append(block)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            # every worker reads the same pages
+            array.flags.writeable = False
+            arrays[name] = array
+        return PriceHistory.fromArrays(arrays['values'], arrays['rowDays'], shared['symbols'], shared['version'])
+
+    def close(self, unlink: bool) -> None:
+        for block in self.blocks:
+            block.close()
+            if unlink:
+                block.unlink()
+        self.blocks = []
+
+class BatchRunner:
+    # Runs the reports of many portfolios, each a folder with its own data/trades.csv and
+    # data/starting_positions.csv, against the prices of the folder it's started from. Every
+    # portfolio's artifacts are written to its own artifacts folder, by a pool of processes.
+    REPORTS = ['timeseries', 'lots', 'alerts']
+    ALERTS_FILE_NAME = 'artifacts/alerts.md'
+
+    def __init__(self, directories: List[str], workers: int) -> None:
+        # the workers change into each folder, so relative paths are resolved first
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.workers = workers
+
+    def run(self, reports: List[str], periods: List[str], method: str, threshold: float) -> List[Dict]:
+        Utils.log('Loading prices')
+        shared_prices = SharedPrices()
+        try:
+            with Metrics.span('batch.share'):
+                shared = shared_prices.share(DataContext.priceHistory())
+            Utils.log(f'Running {len(self.directories)} portfolios on {self.workers} workers')
+            results = []
+            with ProcessPoolExecutor(max_workers=max(min(self.workers, len(self.directories)), 1), initializer=initWorker, initargs=(shared,)) as pool:
+                futures = [pool.submit(runPortfolio, d, reports, periods, method, threshold) for d in self.directories]
+                for future in as_completed(futures):
+                    result = future.result()
+                    # workers count into their own Metrics, added up here for --profile
+                    for (name, n) in result['counters'].items():
+                        Metrics.count(name, n)
+                    Utils.log(f'{result["directory"]}: {result["error"] if result["error"] else "done"} in {result["seconds"]:.2f}s')
+                    results.append(result)
+            Metrics.count('batch.portfolios', len(results))
+            # in the order they were given
+            order = {d: i for (i, d) in enumerate(self.directories)}
+            return sorted(results, key=lambda r: order[r['directory']])
+        finally:
+            shared_prices.close(unlink=True)
+
+    def runReports(reports: List[str], periods: List[str], method: str, threshold: float) -> List[str]:
+        # reports of the portfolio in the working directory, returning the symbols it has no prices for
+        from lot_analysis import LotAnalysis
+        from price_alerts import PriceAlerts
+        from render_portfolio import RenderPortfolio
+        os.makedirs('artifacts', exist_ok=True)
+        render = RenderPortfolio('file')
+        portfolio = render.portfolio
+        if 'timeseries' in reports:
+            render.periods(periods)
+        if 'lots' in reports:
+            analysis = LotAnalysis(method, portfolio.trades, portfolio.priceHistory)
+            with Metrics.span('csv.write'):
+                analysis.table.toFrame(analysis.table.atLoss(threshold)).to_csv(LotAnalysis.FILE_NAME, index=False)
+                analysis.harvestFrame(analysis.harvestPlan(threshold)).to_csv(LotAnalysis.HARVEST_FILE_NAME, index=False)
+        if 'alerts' in reports:
+            with open(BatchRunner.ALERTS_FILE_NAME, 'w') as f:
+                f.write(PriceAlerts(portfolio).render())
+        return sorted(set(DataContext.watchlist()) - set(portfolio.priceHistory.symbolIndex))
+
+# each worker attaches to the shared prices once, and keeps them for every portfolio it runs
+workerPrices = SharedPrices()
+workerPriceHistory = None
+
+def initWorker(shared: Dict) -> None:
+    global workerPriceHistory
+    workerPriceHistory = workerPrices.attach(shared)
+
+def runPortfolio(directory: str, reports: List[str], periods: List[str], method: str, threshold: float) -> Dict:
+    start = time.perf_counter()
+    Metrics.reset()
+    result = {'directory': directory, 'error': None, 'missingSymbols': []}
+    try:
+        os.chdir(directory)
+        # the portfolio's own folder has no price files, so the shared prices stand in for them
+        DataContext.put('price_history', DataContext.priceFiles, workerPriceHistory)
+        with Metrics.span('batch.portfolio'):
+            result['missingSymbols'] = BatchRunner.runReports(reports, periods, method, threshold)
+    except Exception as e:
+        result['error'] = repr(e)
+    result['seconds'] = time.perf_counter() - start
+    result['counters'] = dict(Metrics.counters)
+    return result
+
+def main():
+    from render_portfolio import RenderPortfolio
+    from lot_analysis import LotMatcher
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directories', nargs='*', help='portfolio folders, each with its own data folder')
+    parser.add_argument('-f', '--file', help='file listing portfolio folders, one per line')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='processes to run portfolios with')
+    parser.add_argument('-r', '--reports', nargs='+', choices=BatchRunner.REPORTS, default=BatchRunner.REPORTS)
+    parser.add_argument('-p', '--periods', nargs='+', choices=RenderPortfolio.PERIODS, default=['ytd'])
+    parser.add_argument('-m', '--method', choices=LotMatcher.METHODS, default='fifo')
+    parser.add_argument('-t', '--thresh', type=float, default=0.8)
+    Metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    with Metrics.profiling('batch_runner', args):
+        directories = list(args.directories)
+        if args.file:
+            with open(args.file) as f:
+                directories += [line.strip() for line in f if line.strip()]
+        if not directories:
+            parser.error('no portfolio folders given')
+
+        results = BatchRunner(directories, args.workers).run(args.reports, args.periods, args.method, args.thresh)
+        for result in results:
+            status = f'failed: {result["error"]}' if result['error'] else 'ok'
+            print(f'{result["directory"]}\t{status}\t{result["seconds"]:.2f}s')
+            if result['missingSymbols']:
+                print(f'\tno prices for {", ".join(result["missingSymbols"])}')
+        if any(r['error'] for r in results):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from synthetic_data import SyntheticData
+from utils import Utils
+from typing import Callable, Dict
+
+class Benchmark:
+    # Times the expensive stages against synthetic portfolios of a few sizes. Every run appends a
+    # line per size to a JSON lines file, tagged with the git commit, so versions can be compared.
+    FILE_NAME = 'artifacts/benchmarks.jsonl'
+
+    # name -> (symbols, trades, years)
+    SIZES = {
+        'small': (50, 2000, 3),
+        'medium': (500, 50000, 10),
+        'large': (5000, 1000000, 20),
+    }
+
+    # CLI -> seconds a fresh interpreter may take to import it, and to get through argument parsing.
+    # Neither should load pandas, matplotlib or yfinance until a command needs them.
+    STARTUP_BUDGETS = {
+        'portfolio': (0.3, 0.4),
+        'render_portfolio': (0.3, 0.4),
+        'price_alerts': (0.3, 0.4),
+        'lot_analysis': (0.3, 0.4),
+        'portfolio_service': (1.0, 1.2),
+        'fetch_price_history': (1.0, 1.2),
+        'price_store': (1.0, 1.2),
+    }
+
+    def __init__(self, repeat: int, loop: bool) -> None:
+        self.repeat = repeat
+        self.loop = loop
+        self.repoDir = os.path.dirname(os.path.abspath(__file__))
+
+    def time(self, timings: Dict[str, float], name: str, func: Callable):
+        # best of `repeat` runs, and the result of the last one
+        best = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = round(best, 6)
+        Utils.log(f'{name}: {best:.3f}s')
+        return result
+
+    def run(self, size: str) -> Dict:
+        (num_symbols, num_trades, years) = self.SIZES[size]
+        timings: Dict[str, float] = {}
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as work_dir:
+            Utils.log(f'Benchmarking {size} in {work_dir}')
+            SyntheticData(num_symbols, num_trades, years).write(os.path.join(work_dir, 'data'))
+            os.makedirs(os.path.join(work_dir, 'artifacts'))
+            # every module reads and writes relative to the working directory
+            os.chdir(work_dir)
+            try:
+                self.runStages(timings)
+            finally:
+                os.chdir(cwd)
+        return {
+            'size': size,
+            'symbols': num_symbols,
+            'trades': num_trades,
+            'years': years,
+            'timings': timings,
+        }
+
+    def runStages(self, timings: Dict[str, float]) -> None:
+        from data_context import DataContext
+        from fetch_price_history import PriceHistoryFetcher
+        from ledger import PerformanceLedger
+        from lot_analysis import LotAnalysis
+        from portfolio import Portfolio
+        from price_alerts import PriceAlerts
+        from render_portfolio import RenderPortfolio
+
+        repeat = self.repeat
+        # the first read converts prices.csv, later ones map the binary store
+        self.repeat = 1
+        self.time(timings, 'fetch_stored_csv', lambda: PriceHistoryFetcher([]).fetch_stored())
+        self.repeat = repeat
+        self.time(timings, 'fetch_stored', lambda: PriceHistoryFetcher([]).fetch_stored())
+
+        # every load starts from an empty data context, so it includes parsing the inputs
+        fresh = lambda load: lambda: (DataContext.clear(), load())[1]
+        portfolio = self.time(timings, 'portfolio_load', fresh(Portfolio))
+        end_date = Utils.today()
+        start_date = end_date - timedelta(days=365)
+
+        def replayYear():
+            # without the saved ledger, or the one the portfolio holds, every repeat replays the whole year
+            if os.path.exists(PerformanceLedger.FILE_NAME):
+                os.remove(PerformanceLedger.FILE_NAME)
+            portfolio.performanceLedger = None
+            return portfolio.timeSeries(start_date, end_date)
+        self.time(timings, 'timeseries_year_cold', replayYear)
+        (aggregate_perf, _) = self.time(timings, 'timeseries_year_cached', lambda: portfolio.timeSeries(start_date, end_date))
+        if self.loop:
+            self.time(timings, 'timeseries_year_loop', lambda: portfolio.timeSeries(start_date, end_date, 'loop'))
+
+        lot_analysis = self.time(timings, 'lot_analysis_load', fresh(LotAnalysis))
+        self.time(timings, 'lots_at_loss', lambda: lot_analysis.lotsAtLoss(0.9))
+
+        alerts = self.time(timings, 'price_alerts_load', fresh(PriceAlerts))
+        self.time(timings, 'price_alerts_gen', lambda: (alerts.alerts.clear(), alerts.gen()))
+
+        renderer = RenderPortfolio('console')
+        renderer.portfolio = portfolio
+        self.time(timings, 'render_chart', lambda: renderer.renderAggregatePerfChart(aggregate_perf, start_date, end_date))
+
+    def startup(self) -> Dict:
+        timings: Dict[str, float] = {}
+        over_budget = []
+        for (cli, (import_budget, startup_budget)) in self.STARTUP_BUDGETS.items():
+            for (name, args, budget) in [
+                (f'{cli}_import', ['-c', f'import {cli}'], import_budget),
+                (f'{cli}_startup', [f'{cli}.py', '--help'], startup_budget),
+            ]:
+                command = [sys.executable] + args
+                self.time(timings, name, lambda: subprocess.run(command, cwd=self.repoDir, stdout=subprocess.DEVNULL, check=True))
+                if timings[name] > budget:
+                    Utils.log(f'{name} took {timings[name]:.3f}s, over its budget of {budget}s')
+                    over_budget.append(name)
+        return {
+            'size': 'startup',
+            'timings': timings,
+            'overBudget': over_budget,
+        }
+
+    def version(self) -> str:
+        try:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=self.repoDir, text=True).strip()
+        except Exception:
+            return 'unknown'
+
+    def write(self, file_name: str, results) -> None:
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        with open(file_name, 'a') as f:
+            for result in results:
+                f.write(json.dumps({
+                    'version': self.version(),
+                    'timestamp': datetime.now().isoformat(timespec='seconds'),
+                    'python': platform.python_version(),
+                    **result,
+                }) + '\n')
+        Utils.log(f'Wrote {file_name}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sizes', nargs='*', choices=list(Benchmark.SIZES) + ['startup'], default=['small', 'medium'])
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--loop', action='store_true', help='also time the day by day timeSeries engine')
+    parser.add_argument('-o', '--out', default=Benchmark.FILE_NAME)
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    benchmark = Benchmark(args.repeat, args.loop)
+    results = [benchmark.startup() if size == 'startup' else benchmark.run(size) for size in args.sizes]
+    benchmark.write(out, results)
+    if any(result.get('overBudget') for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
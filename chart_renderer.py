@@ -0,0 +1,196 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date
+from metrics import Metrics
+from projection import ProjectionBands
+from utils import Utils
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+@dataclass
+class ChartData:
+    # everything one aggregate performance chart shows, so it can be drawn in another process
+    fileName: str
+    dates: List[date]
+    nonFBValue: List[float]
+    netNonFBValue: List[float]
+    # symbol -> price scaled to the portfolio's starting value
+    benchmarks: Dict[str, List[float]]
+    nonFBGain: List[float]
+    deposits: List[float]
+    withdrawals: List[float]
+    # drawn in a fourth panel when set
+    projection: Optional[ProjectionBands] = None
+
+class ChartRenderer:
+    # Draws charts on one figure per number of panels, built once and cleared between charts. Lines
+    # longer than the figure is wide are downsampled, and transactions are summed into weekly or
+    # monthly bars once a daily bar would be too thin to see.
+    MAX_POINTS = 1000
+    DAILY_BAR_DAYS = 92
+    WEEKLY_BAR_DAYS = 731
+
+    def __init__(self) -> None:
+        # number of panels -> figure and its axes
+        self.figures: Dict[int, Tuple] = {}
+
+    def template(self, panels: int = 3):
+        if panels in self.figures:
+            (fig, axes) = self.figures[panels]
+            for ax in axes:
+                for artist in [*ax.lines, *ax.patches, *ax.texts, *ax.collections]:
+                    artist.remove()
+                ax.containers.clear()
+                if ax.get_legend():
+                    ax.get_legend().remove()
+                # forget the last chart's limits and colors
+                ax.relim()
+                ax.set_prop_cycle(None)
+            return (fig, axes)
+
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot as plt
+        from matplotlib import ticker as tick
+
+        fig, axes = plt.subplots(panels, 1)
+        (ax1, ax2, ax3) = axes[:3]
+        fig.set_size_inches(20, 5 * panels)
+        fig.set_dpi(100)
+
+        ax1.set_xlabel('Date')
+        ax1.set_ylabel('Value')
+        ax1.grid()
+        ax1.get_yaxis().set_major_formatter(tick.FuncFormatter(lambda x, _: Utils.currency(x)))
+
+        ax2.set_ylabel('Gain')
+        ax2.get_yaxis().set_major_formatter(tick.FuncFormatter(lambda x, _: Utils.currency(x)))
+        ax2.grid()
+
+        ax3.set_ylabel('Transactions')
+        ax3.grid()
+
+        if panels > 3:
+            axes[3].set_ylabel('Projected value')
+            axes[3].get_yaxis().set_major_formatter(tick.FuncFormatter(lambda x, _: Utils.currency(x)))
+            axes[3].grid()
+
+        self.figures[panels] = (fig, tuple(axes))
+        return self.figures[panels]
+
+    @Metrics.timed('chart.render')
+    def render(self, chart: ChartData) -> str:
+        fig, axes = self.template(4 if chart.projection else 3)
+        (ax1, ax2, ax3) = axes[:3]
+        dates = np.array(chart.dates)
+        days = np.array([d.toordinal() for d in chart.dates], dtype=float)
+
+        for (values, label) in [
+            (chart.nonFBValue, 'Value'),
+            (chart.netNonFBValue, 'Net value'),
+            *[(series, symbol) for (symbol, series) in chart.benchmarks.items()],
+        ]:
+            values = np.asarray(values, dtype=float)
+            kept = self.downsample(days, values, self.MAX_POINTS)
+            ax1.plot(dates[kept], values[kept], label=label)
+        self.annotate(ax1, chart.dates, chart.nonFBValue)
+
+        gain = np.asarray(chart.nonFBGain, dtype=float)
+        kept = self.downsample(days, gain, self.MAX_POINTS)
+        ax2.plot(dates[kept], gain[kept], label='Gain')
+        self.annotate(ax2, chart.dates, chart.nonFBGain)
+
+        (starts, widths, deposits, withdrawals) = self.buckets(chart.dates, chart.deposits, chart.withdrawals)
+        ax3.bar(starts, deposits, width=widths, align='edge', color='blue')
+        ax3.bar(starts, -withdrawals, width=widths, align='edge', color='red')
+
+        if chart.projection:
+            self.renderProjection(axes[3], chart.projection)
+
+        ax1.legend()
+        fig.savefig(chart.fileName)
+        return chart.fileName
+
+    def renderProjection(self, ax, bands: ProjectionBands) -> None:
+        # the outer percentiles as a light band, the inner ones darker, and the median as a line
+        dates = np.array(bands.dates)
+        value = np.array(bands.value)
+        middle = len(value) // 2
+        for i in range(middle):
+            ax.fill_between(dates, value[i], value[-1 - i], color='blue', alpha=0.15 * (i + 1), linewidth=0,
+                            label=f'{bands.percentiles[i]}-{bands.percentiles[-1 - i]}%')
+        ax.plot(dates, value[middle], color='blue', label='Median')
+        self.annotate(ax, bands.dates, value[middle].tolist())
+        ax.legend()
+
+    def annotate(self, ax, dates: List[date], values: List[float]) -> None:
+        # extremes and the last value come from the full series, not the downsampled one
+        min_index = np.argmin(values)
+        ax.annotate(Utils.currency(values[min_index]), (dates[min_index], values[min_index]), color='red')
+        max_index = np.argmax(values)
+        ax.annotate(Utils.currency(values[max_index]), (dates[max_index], values[max_index]), color='green')
+        ax.annotate(Utils.currency(values[-1]), (dates[-1], values[-1]), color='black')
+
+    def downsample(self, x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+        # Largest triangle three buckets: keeps the first and last points, and from each bucket in
+        # between the point making the largest triangle with the point kept before it and the mean
+        # of the next bucket. Peaks and troughs survive, unlike taking every nth point.
+        n = len(x)
+        if n <= max_points or max_points < 3:
+            return np.arange(n)
+        # missing values only stay missing in the plot, they don't steer which points are kept
+        y = np.nan_to_num(y)
+        edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+        kept = np.empty(max_points, dtype=np.int64)
+        kept[0] = 0
+        kept[-1] = n - 1
+        a = 0
+        for i in range(max_points - 2):
+            (start, end) = (edges[i], edges[i + 1])
+            next_end = edges[i + 2] if i + 2 < len(edges) else n
+            mean_x = x[end:next_end].mean()
+            mean_y = y[end:next_end].mean()
+            area = np.abs((x[a] - mean_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y - y[a]))
+            a = start + int(np.argmax(area))
+            kept[i + 1] = a
+        return kept
+
+    def buckets(self, dates: List[date], deposits: List[float], withdrawals: List[float]) -> Tuple[List[date], np.ndarray, np.ndarray, np.ndarray]:
+        # bar start dates, widths in days, and the totals of each day, week or month
+        ordinals = np.array([d.toordinal() for d in dates], dtype=np.int64)
+        if len(dates) <= self.DAILY_BAR_DAYS:
+            return (list(dates), np.full(len(dates), 0.8), np.asarray(deposits, dtype=float), np.asarray(withdrawals, dtype=float))
+        if len(dates) <= self.WEEKLY_BAR_DAYS:
+            # ordinal 1 is a Monday
+            keys = (ordinals - 1) // 7
+            starts = [date.fromordinal(int(k) * 7 + 1) for k in np.unique(keys)]
+            widths = np.full(len(starts), 7 * 0.8)
+        else:
+            keys = np.array([d.year * 12 + d.month - 1 for d in dates], dtype=np.int64)
+            starts = [date(int(k) // 12, int(k) % 12 + 1, 1) for k in np.unique(keys)]
+            ends = [date(int(k + 1) // 12, int(k + 1) % 12 + 1, 1) for k in np.unique(keys)]
+            widths = np.array([(e - s).days * 0.8 for (s, e) in zip(starts, ends)])
+        (_, bucket) = np.unique(keys, return_inverse=True)
+        return (
+            starts,
+            widths,
+            np.bincount(bucket, weights=deposits, minlength=len(starts)),
+            np.bincount(bucket, weights=withdrawals, minlength=len(starts)),
+        )
+
+    def renderAll(charts: List[ChartData], workers: int = 1) -> List[str]:
+        if workers <= 1 or len(charts) <= 1:
+            renderer = ChartRenderer()
+            return [renderer.render(chart) for chart in charts]
+        # imported before the workers start, so forked workers don't import it again
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot
+        with ProcessPoolExecutor(max_workers=min(workers, len(charts))) as pool:
+            return list(pool.map(renderInWorker, charts))
+
+# each worker process keeps its own figure across the charts it draws
+workerRenderer = ChartRenderer()
+
+def renderInWorker(chart: ChartData) -> str:
+    return workerRenderer.render(chart)
@@ -0,0 +1,71 @@
+import os
+from metrics import Metrics
+from returns import Returns
+from starting_positions import StartingPositions
+from trades import Trades
+from typing import Callable, Dict, List, Set, Tuple
+
+class DataContext:
+    # One copy of each input per process, handed to every consumer. An input is loaded on first use
+    # and again only when one of its files changes, so a long running process sees edits.
+    cache: Dict[Tuple[str, str], Tuple[Tuple, object]] = {}
+
+    def version(file_names: List[str]) -> Tuple:
+        return tuple(os.path.getmtime(f) if os.path.exists(f) else 0 for f in file_names)
+
+    def get(name: str, files: Callable[[], List[str]], load: Callable[[], object]):
+        # inputs are relative to the working directory, which the benchmarks change
+        key = (os.getcwd(), name)
+        cached = DataContext.cache.get(key)
+        if cached is None or cached[0] != DataContext.version(files()):
+            Metrics.count('data_context.misses')
+            with Metrics.span(f'load.{name}'):
+                value = load()
+            # loading may write the files, e.g. converting prices.csv, so the version is taken after
+            DataContext.cache[key] = (DataContext.version(files()), value)
+        else:
+            Metrics.count('data_context.hits')
+        return DataContext.cache[key][1]
+
+    def put(name: str, files: Callable[[], List[str]], value) -> None:
+        # an input loaded elsewhere, e.g. prices shared by batch_runner.py, used until one of files changes
+        DataContext.cache[(os.getcwd(), name)] = (DataContext.version(files()), value)
+
+    def clear() -> None:
+        DataContext.cache.clear()
+
+    def startingPositions() -> StartingPositions:
+        def load():
+            starting_positions = StartingPositions()
+            starting_positions.load()
+            return starting_positions
+        return DataContext.get('starting_positions', lambda: [StartingPositions.FILE_NAME], load)
+
+    def trades() -> Trades:
+        def load():
+            trades = Trades()
+            trades.load()
+            return trades
+        return DataContext.get('trades', lambda: [Trades.FILE_NAME], load)
+
+    def watchlist() -> Set[str]:
+        def load():
+            watchlist = set(DataContext.startingPositions().positions)
+            watchlist.update(t.symbol for t in DataContext.trades().trades)
+            # for comparison graphs
+            watchlist.update(DataContext.benchmarks())
+            return watchlist
+        return DataContext.get('watchlist', lambda: [StartingPositions.FILE_NAME, Trades.FILE_NAME, Returns.BENCHMARKS_FILE_NAME], load)
+
+    def benchmarks() -> List[str]:
+        return DataContext.get('benchmarks', lambda: [Returns.BENCHMARKS_FILE_NAME], Returns.benchmarks)
+
+    def priceFiles() -> List[str]:
+        from price_store import PriceStore
+        store = PriceStore()
+        return [PriceStore.CSV_FILE_NAME, store.path(PriceStore.SYMBOLS)] + store.partitions()
+
+    def priceHistory():
+        # imported here, as price_history depends on this module through the watchlist
+        from price_history import PriceHistory
+        return DataContext.get('price_history', DataContext.priceFiles, PriceHistory)
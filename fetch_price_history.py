@@ -1,95 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import date, timedelta, datetime
 from pandas.core.frame import DataFrame
-import yfinance as yf
 from watchlist import Watchlist
+from metrics import Metrics
+from price_store import PriceStore
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
 import pandas as pd
-import numpy as numpy
 import argparse
+import json
+import os
+import time
 from utils import Utils
 
+# (symbols, start date) -> closing prices, one column per symbol
+DownloadFunc = Callable[[List[str], date], DataFrame]
+
+def yahooDownload(symbols: List[str], start_date: date) -> DataFrame:
+    # imported on first download, so offline reads of the stored prices don't pay for it
+    import yfinance as yf
+    data = yf.download(" ".join(symbols), start=start_date)["Close"]
+    if isinstance(data, pd.Series):
+        data = data.to_frame(symbols[0])
+    return data
+
+class LocalPriceSource:
+    # Serves downloads from a local prices CSV, to run the fetcher offline
+    def __init__(self, file_name: str) -> None:
+        self.prices = pd.read_csv(file_name, index_col='Date')
+        self.prices.index = pd.to_datetime(self.prices.index)
+
+    def __call__(self, symbols: List[str], start_date: date) -> DataFrame:
+        rows = self.prices.loc[self.prices.index >= pd.Timestamp(start_date)]
+        return rows.reindex(columns=symbols)
+
+@dataclass
+class FetchTask:
+    symbols: List[str]
+    start: date
+
+class FetchPlanner:
+    # Per-symbol watermarks: the last date a symbol had a real (not filled in) price.
+    # Only the range after each symbol's watermark gets downloaded.
+    FILE_NAME = "data/price_watermarks.json"
+    START_DATE = date(2019, 1, 1)
+    BATCH_SIZE = 50
+
+    def __init__(self, symbols: List[str], file_name: str = FILE_NAME) -> None:
+        self.symbols = sorted(symbols)
+        self.fileName = file_name
+        self.watermarks: Dict[str, date] = {}
+
+    def load(self, stored: Optional[DataFrame]) -> None:
+        if os.path.exists(self.fileName):
+            with open(self.fileName) as f:
+                self.watermarks = {s: date.fromisoformat(d) for s, d in json.load(f).items()}
+        elif stored is not None:
+            # no watermarks yet, so start from the last stored price of each symbol
+            for symbol in stored.columns:
+                last = stored[symbol].last_valid_index()
+                if last is not None:
+                    self.watermarks[symbol] = last
+
+    def save(self) -> None:
+        with open(self.fileName, 'w') as f:
+            json.dump({s: d.isoformat() for s, d in sorted(self.watermarks.items())}, f, indent=1)
+
+    def plan(self, today: date) -> List[FetchTask]:
+        # symbols missing the same range are downloaded together
+        by_start: Dict[date, List[str]] = {}
+        for symbol in self.symbols:
+            start = self.watermarks[symbol] + timedelta(days=1) if symbol in self.watermarks else self.START_DATE
+            if start > today:
+                continue
+            by_start.setdefault(start, []).append(symbol)
+        tasks = []
+        for start, symbols in sorted(by_start.items()):
+            for i in range(0, len(symbols), self.BATCH_SIZE):
+                tasks.append(FetchTask(symbols[i:i + self.BATCH_SIZE], start))
+        return tasks
+
+    def update(self, downloaded: DataFrame) -> None:
+        for symbol in downloaded.columns:
+            last = downloaded[symbol].last_valid_index()
+            if last is not None and (symbol not in self.watermarks or last > self.watermarks[symbol]):
+                self.watermarks[symbol] = last
+
 class PriceHistoryFetcher:
     FILE_NAME = "data/prices.csv"
-    def __init__(self, symbols) -> None:
+    MAX_WORKERS = 4
+    MAX_ATTEMPTS = 3
+    BACKOFF_SECONDS = 2
+
+    def __init__(self, symbols, download: DownloadFunc = yahooDownload) -> None:
         self.symbols = symbols
         self.symbolStr = " ".join(symbols)
-
-    def download(self, start_date):
-        return yf.download(self.symbolStr, start=start_date)["Close"]
+        self.downloadFunc = download
+
+    @Metrics.timed('prices.download')
+    def download(self, task: FetchTask) -> Optional[DataFrame]:
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                data = self.downloadFunc(task.symbols, task.start)
+                data.index = pd.to_datetime(data.index).date
+                return data
+            except Exception as e:
+                delay = self.BACKOFF_SECONDS * 2 ** attempt
+                Utils.log(f'Download of {len(task.symbols)} symbols from {task.start} failed ({e}), attempt {attempt + 1}')
+                if attempt + 1 < self.MAX_ATTEMPTS:
+                    time.sleep(delay)
+        Utils.log(f'Giving up on {", ".join(task.symbols)} from {task.start}')
+        return None
+
+    def downloadAll(self, tasks: List[FetchTask]) -> List[DataFrame]:
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as pool:
+            results = list(pool.map(self.download, tasks))
+        return [r for r in results if r is not None and not r.empty]
+
+    def merge(self, stored: Optional[DataFrame], downloaded: List[DataFrame]) -> DataFrame:
+        # downloaded prices win over stored ones for the same day and symbol
+        merged = stored
+        for data in downloaded:
+            data = data.dropna(how='all')
+            merged = data if merged is None else data.combine_first(merged)
+        return merged
 
     def store(self, data: DataFrame) -> None:
-        data.sort_index()
-        data.index = [d.date() for d in data.index]
+        data = data.sort_index()
+        data.index = pd.to_datetime(data.index).date
         data.index.name = "Date"
-        data.ffill(inplace=True)
-        data.bfill(inplace=True)
-        data.to_csv(self.FILE_NAME)
+        data = data.ffill().bfill()
+        with Metrics.span('csv.write'):
+            data.to_csv(self.FILE_NAME)
+        Metrics.count('rows_written', data.shape[0])
+        PriceStore().write(data)
 
     def fetch_stored(self) -> DataFrame:
-        stored = pd.read_csv(self.FILE_NAME, index_col='Date')
-        stored.index = pd.to_datetime(stored.index)
-        stored.index = [d.date() for d in stored.index]
-        stored.index.name = "Date"
-        return stored
-
-    def fetch_fresh(self):
-        Utils.log("Start download")
-        data = self.download("2019-01-01")
-        Utils.log("Store locally")
-        self.store(data)
-        return self.fetch_stored()
-
-    def last_date_with_data(self, data: DataFrame) -> date:
-        vti = data.loc[:, ['VTI']]
-        num_rows = vti.shape[0]
-        index = num_rows - 1
-        while index >= 0 and numpy.isnan(vti.iat[index, 0]):
-            index -= 1
-        return vti.index[index]
-
-    def fetch_incremental(self):
-        # fetch current data
-        stored = self.fetch_stored()
-
-        # if it's not outdated, just return it
-        last_date_with_data = self.last_date_with_data(stored)
-        if last_date_with_data >= date.today():
+        # the memory-mapped binary store is used unless prices.csv has been written since
+        store = PriceStore()
+        if store.isStale(self.FILE_NAME):
+            Utils.log("Converting prices.csv to binary store")
+            return store.fromCSV(self.FILE_NAME)
+        return store.read()
+
+    def fetch_stored_arrays(self) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        # fetch_stored() as the price matrix, its day ordinals and its symbols
+        store = PriceStore()
+        if store.isStale(self.FILE_NAME):
+            Utils.log("Converting prices.csv to binary store")
+            return PriceStore.toArrays(store.fromCSV(self.FILE_NAME))
+        return store.readArrays()
+
+    def fetch(self, stored: Optional[DataFrame]) -> DataFrame:
+        planner = FetchPlanner(self.symbols)
+        planner.load(stored)
+        tasks = planner.plan(date.today())
+        if not tasks:
             Utils.log("Not updating because we have today's data")
             return stored
 
-        # else fetch the delta
-        start_date = last_date_with_data + timedelta(days = 1)
-        downloaded = self.download(start_date)
-
-        # insert delta
-        updated_rows = stored[stored.index.isin(downloaded.index)]
-        Utils.log("Dropping {0} rows".format(updated_rows.shape[0]))
+        Utils.log(f'Downloading {len(tasks)} batches')
+        downloaded = self.downloadAll(tasks)
+        if not downloaded:
+            Utils.log("Nothing new downloaded")
+            return stored
 
-        stored.drop(updated_rows.index, inplace=True)
+        if stored is None:
+            Utils.log(f'Storing {sum(d.shape[0] for d in downloaded)} downloaded rows')
+            self.store(self.merge(stored, downloaded))
+        else:
+            # only the new rows are written, and folded into the price matrix in the background
+            store = PriceStore()
+            appended = sum(store.append(data) for data in downloaded)
+            Utils.log(f'Appended {appended} prices')
+            store.compactInBackground()
+        for data in downloaded:
+            planner.update(data)
+        planner.save()
+        return self.fetch_stored()
 
-        Utils.log("Appending {0} rows".format(downloaded.shape[0]))
-        updated = stored.append(downloaded)
+    def fetch_fresh(self):
+        if os.path.exists(FetchPlanner.FILE_NAME):
+            os.remove(FetchPlanner.FILE_NAME)
+        return self.fetch(None)
 
-        # store updated data
-        self.store(updated)
-        return self.fetch_stored()
+    def fetch_incremental(self):
+        return self.fetch(self.fetch_stored())
 
 def main():
     Utils.log('Started fetch_price_history')
     parser = argparse.ArgumentParser()
     parser.add_argument('method', choices=['fresh', 'incremental'])
+    parser.add_argument('--source', help='local prices CSV to fetch from instead of Yahoo Finance')
+    Metrics.addArguments(parser)
     args = parser.parse_args()
 
-    phf = PriceHistoryFetcher(Watchlist.load())
+    with Metrics.profiling('fetch_price_history', args):
+        download = LocalPriceSource(args.source) if args.source else yahooDownload
+        phf = PriceHistoryFetcher(Watchlist.load(), download)
 
-    Utils.log(f'method = {args.method}')
-    if args.method == 'incremental':
-        phf.fetch_incremental()
-    else:
-        phf.fetch_fresh()
+        Utils.log(f'method = {args.method}')
+        if args.method == 'incremental':
+            phf.fetch_incremental()
+        else:
+            phf.fetch_fresh()
 
-    Utils.log("Finished fetch_price_history")
+        Utils.log("Finished fetch_price_history")
 
 if __name__ == "__main__":
     main()
     #phf = PriceHistoryFetcher(Watchlist.load())
-    #print(phf.fetch_incremental())
\ No newline at end of file
+    #print(phf.fetch_incremental())
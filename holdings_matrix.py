@@ -0,0 +1,199 @@
+from datetime import date, timedelta
+from metrics import Metrics
+from price_history import PriceHistory
+from starting_positions import Position
+from trades import Trade
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
+import pandas as pd
+
+class HoldingsWindow:
+    # dates x symbols quantity, cost basis and value for one reporting window, with cost basis
+    # reset to the value on the window's start date. Either the whole portfolio or one account.
+    account: str
+    symbols: List[str]
+    dates: List[date]
+    prices: np.ndarray
+    quantity: np.ndarray
+    costBasis: np.ndarray
+    value: np.ndarray
+    startQuantity: np.ndarray
+    startValue: np.ndarray
+    deposits: np.ndarray
+    withdrawals: np.ndarray
+    bought: np.ndarray
+    sold: np.ndarray
+
+class HoldingsMatrix:
+    # dates x symbols matrices of quantity and running cost basis, built from cumulative trade deltas
+    # in one pass instead of replaying trades one calendar day at a time. Any window that starts on or
+    # after start_date is a slice of these, so several reporting periods share one build.
+    #
+    # Holdings are tracked per account too, as dates x accounts x symbols. Only the (account, symbol)
+    # pairs that were ever held exist, and each is kept as the rows where it changed rather than as a
+    # dense series, which accountWindows expands one account at a time.
+    @Metrics.timed('trades.replay')
+    def __init__(self, positions: Dict[Tuple[str, str], Position], trades: List[Trade], price_history: PriceHistory, start_date: date, end_date: date) -> None:
+        trades = [t for t in trades if t.date <= end_date]
+        self.symbols = list(dict.fromkeys([*[symbol for (_, symbol) in positions], *[t.symbol for t in trades]]))
+        symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        num_symbols = len(self.symbols)
+        self.accounts = list(dict.fromkeys([*[account for (account, _) in positions], *[t.account for t in trades]]))
+        account_index = {account: i for i, account in enumerate(self.accounts)}
+        pairs = list(dict.fromkeys([*positions, *[(t.account, t.symbol) for t in trades]]))
+        pair_index = {pair: i for i, pair in enumerate(pairs)}
+        self.pairAccounts = np.array([account_index[account] for (account, _) in pairs], dtype=np.int64)
+        self.pairSymbols = np.array([symbol_index[symbol] for (_, symbol) in pairs], dtype=np.int64)
+
+        self.startDate = start_date
+        self.dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        num_days = len(self.dates)
+
+        # one row per starting position followed by one row per trade, in trade order
+        starting = [positions[pair] for pair in pairs if pair in positions]
+        num_starting = len(starting)
+        pair = np.array([pair_index[p] for p in pairs if p in positions] + [pair_index[(t.account, t.symbol)] for t in trades], dtype=np.int64)
+        sym = self.pairSymbols[pair]
+        day = np.array([-1] * num_starting + [(t.date - start_date).days for t in trades], dtype=np.int64)
+        quantity = np.array([p.quantity for p in starting] + [t.quantity for t in trades], dtype=float)
+        price = np.array([0.0] * num_starting + [t.price for t in trades], dtype=float)
+        action = np.array([''] * num_starting + [t.action for t in trades], dtype=object)
+
+        is_buy = action == 'Buy'
+        is_sell = action == 'Sell'
+        adds = is_buy | (action == 'RSU')
+        trade_value = quantity * price
+
+        dq = np.where(adds, quantity, np.where(is_sell, -quantity, 0.0))
+        dq[:num_starting] = quantity[:num_starting]
+        dc = np.where(adds, trade_value, np.where(is_sell, -trade_value, 0.0))
+        dc[:num_starting] = [p.costBasis for p in starting]
+
+        # holdings in the account after every row. A sell larger than the account's position is clamped
+        # to the position, which makes holdings a running sum reflected at zero: S - min(0, running min of S)
+        running = pd.Series(dq).groupby(pair, sort=False).cumsum().to_numpy()
+        running_min = pd.Series(running).groupby(pair, sort=False).cummin().to_numpy()
+        pair_held = running - np.minimum(running_min, 0.0)
+        pair_cost = pd.Series(dc).groupby(pair, sort=False).cumsum().to_numpy()
+
+        held_before = pd.Series(pair_held).groupby(pair, sort=False).shift(fill_value=0).to_numpy()
+        for i in np.flatnonzero(is_sell & (quantity > held_before)):
+            print(f"Sold {quantity[i]} {self.symbols[sym[i]]} shares in {pairs[pair[i]][0]} but held only {held_before[i]}")
+
+        # and across accounts
+        held = pd.Series(pair_held - held_before).groupby(sym, sort=False).cumsum().to_numpy()
+        running_cost = pd.Series(dc).groupby(sym, sort=False).cumsum().to_numpy()
+
+        before = day < 0
+        in_window = ~before
+
+        # state carried into the start date
+        last_before = self.lastRowPerKey(sym[before], np.zeros(before.sum(), dtype=np.int64))
+        self.startQuantity = np.zeros(num_symbols)
+        self.startQuantity[sym[before][last_before]] = held[before][last_before]
+        self.startCost = np.zeros(num_symbols)
+        self.startCost[sym[before][last_before]] = running_cost[before][last_before]
+        last_before = self.lastRowPerKey(pair[before], np.zeros(before.sum(), dtype=np.int64))
+        self.pairStartQuantity = np.zeros(len(pairs))
+        self.pairStartQuantity[pair[before][last_before]] = pair_held[before][last_before]
+        self.pairStartCost = np.zeros(len(pairs))
+        self.pairStartCost[pair[before][last_before]] = pair_cost[before][last_before]
+
+        self.prices = price_history.priceMatrix(self.dates, self.symbols)
+        self.quantity = self.fillForward(self.startQuantity, sym[in_window], day[in_window], held[in_window], num_days)
+        # cost basis before any reset, as positions carry it from the starting positions on
+        self.runningCost = self.fillForward(self.startCost, sym[in_window], day[in_window], running_cost[in_window], num_days)
+
+        self.tradeSymbols = sym[in_window]
+        self.tradePairs = pair[in_window]
+        self.tradeHeld = pair_held[in_window]
+        self.tradeCost = pair_cost[in_window]
+        self.tradeDays = day[in_window]
+        self.tradeValues = trade_value[in_window]
+        self.isBuy = is_buy[in_window]
+        self.isWithdrawal = is_sell[in_window] & (sym[in_window] != symbol_index.get('META', -1))
+
+    def offset(self, start_date: date) -> int:
+        offset = (start_date - self.startDate).days
+        assert(0 <= offset < len(self.dates))
+        return offset
+
+    def window(self, start_date: date) -> HoldingsWindow:
+        offset = self.offset(start_date)
+        return self.valued(offset, None, self.symbols, self.prices[offset:], self.quantity, self.runningCost, self.startQuantity, self.startCost, self.tradeSymbols)
+
+    def accountWindows(self, start_date: date) -> Iterator[HoldingsWindow]:
+        # one window per account, over the symbols the account ever held. They are built one at a time,
+        # so only one account's dates x symbols matrices are in memory at once.
+        offset = self.offset(start_date)
+        num_days = len(self.dates)
+        column_of = np.full(len(self.pairAccounts), -1, dtype=np.int64)
+        for (a, account) in enumerate(self.accounts):
+            pairs = np.flatnonzero(self.pairAccounts == a)
+            column_of[:] = -1
+            column_of[pairs] = np.arange(len(pairs))
+            trade_columns = column_of[self.tradePairs]
+            rows = trade_columns >= 0
+            quantity = self.fillForward(self.pairStartQuantity[pairs], trade_columns[rows], self.tradeDays[rows], self.tradeHeld[rows], num_days)
+            running_cost = self.fillForward(self.pairStartCost[pairs], trade_columns[rows], self.tradeDays[rows], self.tradeCost[rows], num_days)
+            symbols = self.pairSymbols[pairs]
+            yield self.valued(
+                offset,
+                account,
+                [self.symbols[s] for s in symbols],
+                self.prices[offset:, symbols],
+                quantity,
+                running_cost,
+                self.pairStartQuantity[pairs],
+                self.pairStartCost[pairs],
+                trade_columns,
+            )
+
+    def valued(self, offset: int, account: str, symbols: List[str], prices: np.ndarray, quantity: np.ndarray, running_cost: np.ndarray,
+               start_quantity: np.ndarray, start_cost: np.ndarray, trade_columns: np.ndarray) -> HoldingsWindow:
+        # trade_columns is the column of each trade in the window, or -1 for trades outside it
+        num_days = len(self.dates) - offset
+        num_columns = len(symbols)
+
+        w = HoldingsWindow()
+        w.account = account
+        w.symbols = symbols
+        w.dates = self.dates[offset:]
+        w.prices = prices
+        w.quantity = quantity[offset:]
+        w.startQuantity = quantity[offset - 1] if offset > 0 else start_quantity
+        start_cost = running_cost[offset - 1] if offset > 0 else start_cost
+
+        # cost basis is reset to the value on the start date, and then moves with the trades in the window
+        start_value = np.where(w.prices[0] == 0, start_cost, w.startQuantity * w.prices[0])
+        w.startValue = np.where(w.startQuantity == 0, 0.0, start_value)
+        w.costBasis = w.startValue + (running_cost[offset:] - start_cost)
+        w.value = np.where(w.quantity == 0, 0.0, np.where(w.prices == 0, w.costBasis, w.quantity * w.prices))
+
+        in_window = (trade_columns >= 0) & (self.tradeDays >= offset)
+        buys = in_window & self.isBuy
+        days = self.tradeDays - offset
+        w.deposits = np.bincount(days[buys], weights=self.tradeValues[buys], minlength=num_days)
+        w.bought = np.bincount(trade_columns[buys], weights=self.tradeValues[buys], minlength=num_columns)
+        sells = in_window & self.isWithdrawal
+        w.withdrawals = np.bincount(days[sells], weights=self.tradeValues[sells], minlength=num_days)
+        w.sold = np.bincount(trade_columns[sells], weights=self.tradeValues[sells], minlength=num_columns)
+        return w
+
+    def lastRowPerKey(self, sym: np.ndarray, day: np.ndarray) -> np.ndarray:
+        if len(sym) == 0:
+            return np.zeros(0, dtype=np.int64)
+        keys = pd.DataFrame({'sym': sym, 'day': day})
+        return np.flatnonzero(~keys.duplicated(keep='last').to_numpy())
+
+    def fillForward(self, initial: np.ndarray, sym: np.ndarray, day: np.ndarray, values: np.ndarray, num_days: int) -> np.ndarray:
+        # state at the end of each day: the last row of that day if there is one, else the previous day's state
+        matrix = np.empty((num_days, len(initial)))
+        matrix[0] = initial
+        has_row = np.zeros((num_days, len(initial)), dtype=bool)
+        has_row[0] = True
+        last = self.lastRowPerKey(sym, day)
+        matrix[day[last], sym[last]] = values[last]
+        has_row[day[last], sym[last]] = True
+        rows = np.maximum.accumulate(np.where(has_row, np.arange(num_days)[:, None], 0), axis=0)
+        return matrix[rows, np.arange(len(initial))[None, :]]
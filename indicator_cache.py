@@ -0,0 +1,77 @@
+import os
+import warnings
+from metrics import Metrics
+from price_store import PriceStore
+from typing import Dict, Tuple
+import numpy as np
+import pandas as pd
+
+class IndicatorCache:
+    # Rolling means, maxes and mins over the last N trading rows, computed for every symbol at once.
+    # Latest values are persisted next to the price store, and stay valid until any of the files the
+    # prices were read from changes, including closes rewritten in place.
+    FILE_NAME = os.path.join(PriceStore.DIR_NAME, 'indicators.npz')
+    STATS = ['mean', 'max', 'min']
+
+    latest: Dict[Tuple[str, int], np.ndarray]
+    series: Dict[Tuple[str, int], np.ndarray]
+
+    def __init__(self, values: np.ndarray, days: np.ndarray, version: Tuple, file_name: str = FILE_NAME) -> None:
+        self.values = values
+        self.fileName = file_name
+        # identifies the prices the cached values were computed from: their shape, and the PriceHistory
+        # version, the modification times of the files they were read from
+        self.stamp = np.array([len(days), days[-1] if len(days) else 0, values.shape[1]] + list(version), dtype=np.float64)
+        self.latest = {}
+        self.series = {}
+        self.load()
+
+    def key(self, stat: str, window: int) -> str:
+        return f'{stat}_{window}'
+
+    def load(self) -> None:
+        if not os.path.exists(self.fileName):
+            return
+        with np.load(self.fileName) as stored:
+            if 'stamp' not in stored or not np.array_equal(stored['stamp'], self.stamp):
+                return
+            for name in stored.files:
+                if name != 'stamp':
+                    (stat, window) = name.split('_')
+                    self.latest[(stat, int(window))] = stored[name]
+
+    def save(self) -> None:
+        if not os.path.isdir(os.path.dirname(self.fileName)):
+            return
+        arrays = {self.key(stat, window): values for (stat, window), values in self.latest.items()}
+        tmp = self.fileName + '.tmp.npz'
+        np.savez(tmp, stamp=self.stamp, **arrays)
+        os.replace(tmp, self.fileName)
+
+    def latestValues(self, stat: str, window: int) -> np.ndarray:
+        # per symbol value over the last `window` trading rows, ignoring missing prices
+        if (stat, window) not in self.latest:
+            Metrics.count('indicator_cache.misses')
+            self.computeLatest(window)
+            self.save()
+        else:
+            Metrics.count('indicator_cache.hits')
+        return self.latest[(stat, window)]
+
+    @Metrics.timed('indicators.compute')
+    def computeLatest(self, window: int) -> None:
+        tail = self.values[-window:]
+        with warnings.catch_warnings():
+            # symbols with no prices in the window are NaN
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            self.latest[('mean', window)] = np.nanmean(tail, axis=0)
+            self.latest[('max', window)] = np.nanmax(tail, axis=0)
+            self.latest[('min', window)] = np.nanmin(tail, axis=0)
+
+    def rolling(self, stat: str, window: int) -> np.ndarray:
+        # rows x symbols series, each row covering the `window` trading rows that end on it
+        if (stat, window) not in self.series:
+            Metrics.count('indicator_cache.misses')
+            rolling = pd.DataFrame(self.values, copy=False).rolling(window, min_periods=1)
+            self.series[(stat, window)] = getattr(rolling, stat)().to_numpy()
+        return self.series[(stat, window)]
@@ -0,0 +1,77 @@
+import hashlib
+import io
+import json
+import os
+from metrics import Metrics
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+
+class InputCache:
+    # Typed columns parsed from an input CSV, saved next to it as one uncompressed .npz per file and
+    # read back in a single read. Text columns are stored as integer codes into a table of their
+    # distinct values. The cache holds on to the size, mtime and hash of the file it came from: when
+    # the size and mtime still match it's used as is, when only the mtime moved the hash decides, and
+    # otherwise the file is parsed again.
+    DIR_NAME = 'data/cache'
+    # bumped when the layout of the columns changes
+    VERSION = 1
+    META = 'meta'
+
+    def __init__(self, dir_name: str = DIR_NAME) -> None:
+        self.dirName = dir_name
+
+    def path(self, source: str) -> str:
+        return os.path.join(self.dirName, os.path.basename(source) + '.npz')
+
+    def load(self, source: str, parse: Callable[[str], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        stat = os.stat(source)
+        cached = self.read(source)
+        if cached is not None:
+            (meta, columns) = cached
+            if meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+                Metrics.count('input_cache.hits')
+                return columns
+            if meta['size'] == stat.st_size and meta['hash'] == self.fileHash(source):
+                # touched but not changed, so only the mtime needs updating
+                Metrics.count('input_cache.hits')
+                self.write(source, stat, meta['hash'], columns)
+                return columns
+
+        Metrics.count('input_cache.misses')
+        with Metrics.span('inputs.parse'):
+            columns = parse(source)
+        self.write(source, stat, self.fileHash(source), columns)
+        return columns
+
+    def read(self, source: str) -> Tuple[Dict, Dict[str, np.ndarray]]:
+        if not os.path.exists(self.path(source)):
+            return None
+        with open(self.path(source), 'rb') as f:
+            data = np.load(io.BytesIO(f.read()))
+            columns = {name: data[name] for name in data.files}
+        meta = json.loads(str(columns.pop(self.META)))
+        if meta.get('version') != self.VERSION:
+            return None
+        return (meta, columns)
+
+    def write(self, source: str, stat: os.stat_result, file_hash: str, columns: Dict[str, np.ndarray]) -> None:
+        meta = {'version': self.VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash}
+        os.makedirs(self.dirName, exist_ok=True)
+        tmp = self.path(source) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **columns, **{self.META: np.array(json.dumps(meta))})
+        os.replace(tmp, self.path(source))
+
+    def fileHash(self, file_name: str) -> str:
+        with open(file_name, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def encode(name: str, values) -> Dict[str, np.ndarray]:
+        # a text column as codes into its distinct values, in order of first appearance
+        import pandas as pd
+        (codes, uniques) = pd.factorize(pd.Series(values, dtype=object))
+        return {name: codes.astype(np.int32), f'{name}_values': np.array(list(uniques), dtype=str)}
+
+    def decode(columns: Dict[str, np.ndarray], name: str) -> List[str]:
+        values = columns[f'{name}_values'].tolist()
+        return [values[code] for code in columns[name].tolist()]
@@ -0,0 +1,262 @@
+import argparse
+import io
+import json
+import os
+import zlib
+from data_context import DataContext
+from datetime import date, timedelta
+from metrics import Metrics
+from starting_positions import StartingPositions
+from trades import Trades
+from utils import Utils
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    from portfolio import Portfolio
+
+class PerformanceLedger:
+    # Daily totals of the portfolio saved in data/ledger.npz, so a report only computes the days that
+    # are new or whose inputs changed since the last one. The totals don't depend on where a reporting
+    # window starts: value, running cost basis, and the opening value of the previous day's holdings at
+    # the day's prices, each for all holdings and without META, plus the day's deposits and withdrawals.
+    # A window's cost basis is its opening value plus the running cost basis added since.
+    #
+    # Held symbols without a price are valued at their cost basis, which does depend on the window, so
+    # those days and symbols are kept aside for the window to adjust.
+    #
+    # To find what changed, the ledger keeps a fingerprint of every price row and of every day's trades
+    # that it was computed from. Everything from the first day that differs is computed again.
+    FILE_NAME = 'data/ledger.npz'
+    # bumped when the columns change
+    VERSION = 1
+    META = 'meta'
+    COLUMNS = ['value', 'runningCost', 'openValue', 'nonFBValue', 'nonFBRunningCost', 'nonFBOpenValue', 'deposits', 'withdrawals']
+
+    def __init__(self, portfolio: 'Portfolio', file_name: str = FILE_NAME) -> None:
+        self.portfolio = portfolio
+        self.fileName = file_name
+        self.firstDay = 0
+        self.lastDay = -1
+        self.columns: Dict[str, np.ndarray] = {}
+        self.meta: Dict = {}
+        self.read()
+
+    def read(self) -> None:
+        if not os.path.exists(self.fileName):
+            return
+        with open(self.fileName, 'rb') as f:
+            data = np.load(io.BytesIO(f.read()))
+            columns = {name: data[name] for name in data.files}
+        meta = json.loads(str(columns.pop(self.META)))
+        if meta.get('version') != self.VERSION:
+            return
+        self.meta = meta
+        self.columns = columns
+        self.firstDay = meta['first_day']
+        self.lastDay = meta['last_day']
+
+    def write(self) -> None:
+        os.makedirs(os.path.dirname(self.fileName), exist_ok=True)
+        tmp = self.fileName + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **self.columns, **{self.META: np.array(json.dumps(self.meta))})
+        os.replace(tmp, self.fileName)
+
+    def inputsVersion(self) -> List[float]:
+        return list(DataContext.version([Trades.FILE_NAME, StartingPositions.FILE_NAME]) + self.portfolio.priceHistory.version)
+
+    def startingHash(self) -> str:
+        return self.portfolio.positionIndex.fileHash(StartingPositions.FILE_NAME)
+
+    def update(self, start_date: date, end_date: date) -> None:
+        # covers start_date to end_date, computing only new days and days whose inputs changed
+        inputs = self.inputsVersion()
+        dirty = self.dirtyFrom(start_date.toordinal(), end_date.toordinal(), inputs)
+        if dirty is None:
+            if inputs != self.meta['inputs']:
+                # the files changed without changing anything the ledger covers, e.g. a compaction
+                self.meta['inputs'] = inputs
+                self.write()
+            return
+        if not self.columns:
+            Utils.log(f'Building ledger from {date.fromordinal(dirty)}')
+        elif dirty > self.lastDay:
+            Utils.log(f'Adding {end_date.toordinal() - self.lastDay} days to ledger')
+        else:
+            Utils.log(f'Recomputing ledger from {date.fromordinal(dirty)}')
+        self.recompute(dirty, max(end_date.toordinal(), self.lastDay))
+        self.meta.update({
+            'version': self.VERSION,
+            'first_day': self.firstDay,
+            'last_day': self.lastDay,
+            'starting_positions': self.startingHash(),
+            'inputs': inputs,
+        })
+        self.write()
+
+    def dirtyFrom(self, start_day: int, end_day: int, inputs: List[float]) -> Optional[int]:
+        # the first day that needs computing, or None if the ledger is up to date
+        if not self.columns or start_day < self.firstDay or self.meta['starting_positions'] != self.startingHash():
+            return start_day
+        dirty = [self.lastDay + 1] if end_day > self.lastDay else []
+        if inputs != self.meta['inputs']:
+            (price_days, price_prints) = self.priceFingerprints()
+            (trade_days, trade_prints) = self.tradeFingerprints()
+            changes = [
+                self.firstChange(self.columns['priceDays'], self.columns['pricePrints'], price_days, price_prints),
+                self.firstChange(self.columns['tradeDays'], self.columns['tradePrints'], trade_days, trade_prints),
+            ]
+            # a change before the first day changes what the first day starts with
+            dirty += [max(day, self.firstDay) for day in changes if day is not None]
+        return min(dirty) if dirty else None
+
+    def firstChange(self, old_days: np.ndarray, old_prints: np.ndarray, new_days: np.ndarray, new_prints: np.ndarray) -> Optional[int]:
+        # both are sorted by day, and only days the ledger covers are compared
+        covered = new_days <= self.lastDay
+        (new_days, new_prints) = (new_days[covered], new_prints[covered])
+        n = min(len(old_days), len(new_days))
+        differs = np.flatnonzero((old_days[:n] != new_days[:n]) | (old_prints[:n] != new_prints[:n]))
+        if len(differs):
+            return int(min(old_days[differs[0]], new_days[differs[0]]))
+        if len(old_days) != len(new_days):
+            return int(old_days[n] if len(old_days) > n else new_days[n])
+        return None
+
+    def mix(x: np.ndarray) -> np.ndarray:
+        # 64 bit finalizer of MurmurHash3, so that small changes flip about half the bits
+        x = x ^ (x >> np.uint64(33))
+        x = x * np.uint64(0xff51afd7ed558ccd)
+        x = x ^ (x >> np.uint64(33))
+        x = x * np.uint64(0xc4ceb9fe1a85ec53)
+        return x ^ (x >> np.uint64(33))
+
+    def textHashes(values: List[str]) -> np.ndarray:
+        return np.array([zlib.crc32(v.encode()) for v in values], dtype=np.uint64)
+
+    def priceFingerprints(self) -> Tuple[np.ndarray, np.ndarray]:
+        # one per price row: the sum of every price's bits, mixed with its symbol
+        price_history = self.portfolio.priceHistory
+        bits = np.ascontiguousarray(np.nan_to_num(price_history.values, nan=-1.0)).view(np.uint64)
+        symbols = PerformanceLedger.textHashes(list(price_history.symbolIndex))
+        with np.errstate(over='ignore'):
+            prints = PerformanceLedger.mix(bits ^ (symbols << np.uint64(32))[None, :]).sum(axis=1, dtype=np.uint64)
+        return (price_history.rowDays.astype(np.int64), prints)
+
+    def tradeFingerprints(self) -> Tuple[np.ndarray, np.ndarray]:
+        # one per day with trades: the sum over its trades of every field, mixed
+        columns = self.portfolio.trades.columns
+        if len(columns['date']) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64))
+        with np.errstate(over='ignore'):
+            prints = columns['date'].astype(np.uint64)
+            for name in ['action', 'symbol', 'account']:
+                prints = PerformanceLedger.mix(prints ^ PerformanceLedger.textHashes(columns[f'{name}_values'].tolist())[columns[name]])
+            for name in ['quantity', 'price']:
+                prints = PerformanceLedger.mix(prints ^ np.ascontiguousarray(columns[name]).view(np.uint64))
+            # trades are sorted by date
+            (days, starts) = np.unique(columns['date'], return_index=True)
+            return (days.astype(np.int64), np.add.reduceat(prints, starts, dtype=np.uint64))
+
+    @Metrics.timed('ledger.recompute')
+    def recompute(self, from_day: int, to_day: int) -> None:
+        from holdings_matrix import HoldingsMatrix
+        portfolio = self.portfolio
+        from_date = date.fromordinal(from_day)
+        hm = HoldingsMatrix(portfolio.positionIndex.accountPositionsBefore(from_date), portfolio.trades.since(from_date), portfolio.priceHistory, from_date, date.fromordinal(to_day))
+        num_days = len(hm.dates)
+        Metrics.count('ledger.days_computed', num_days)
+
+        non_fb = np.array([symbol != 'META' for symbol in hm.symbols], dtype=bool)
+        value = np.where(hm.quantity == 0, 0.0, np.where(hm.prices == 0, hm.runningCost, hm.quantity * hm.prices))
+        # the previous day's holdings at the day's prices
+        open_quantity = np.vstack([hm.startQuantity[None, :], hm.quantity[:-1]])
+        open_cost = np.vstack([hm.startCost[None, :], hm.runningCost[:-1]])
+        open_value = np.where(open_quantity == 0, 0.0, np.where(hm.prices == 0, open_cost, open_quantity * hm.prices))
+
+        buys = hm.isBuy
+        sells = hm.isWithdrawal
+        rows = {
+            'value': value.sum(axis=1),
+            'runningCost': hm.runningCost.sum(axis=1),
+            'openValue': open_value.sum(axis=1),
+            'nonFBValue': value[:, non_fb].sum(axis=1),
+            'nonFBRunningCost': hm.runningCost[:, non_fb].sum(axis=1),
+            'nonFBOpenValue': open_value[:, non_fb].sum(axis=1),
+            'deposits': np.bincount(hm.tradeDays[buys], weights=hm.tradeValues[buys], minlength=num_days),
+            'withdrawals': np.bincount(hm.tradeDays[sells], weights=hm.tradeValues[sells], minlength=num_days),
+        }
+        (unpriced_days, unpriced_symbols) = np.nonzero((hm.quantity != 0) & (hm.prices == 0))
+
+        if not self.columns or from_day <= self.firstDay:
+            self.columns = {name: np.zeros(0) for name in self.COLUMNS}
+            self.columns.update({'unpricedDays': np.zeros(0, dtype=np.int64), 'unpricedSymbols': np.zeros(0, dtype=str)})
+            self.firstDay = from_day
+            self.meta['prior_running_cost'] = float(hm.startCost.sum())
+            self.meta['prior_non_fb_running_cost'] = float(hm.startCost[non_fb].sum())
+        kept = from_day - self.firstDay
+        for name in self.COLUMNS:
+            self.columns[name] = np.concatenate([self.columns[name][:kept], rows[name]])
+        kept_cells = self.columns['unpricedDays'] < from_day
+        self.columns['unpricedDays'] = np.concatenate([self.columns['unpricedDays'][kept_cells], unpriced_days + from_day])
+        self.columns['unpricedSymbols'] = np.concatenate([self.columns['unpricedSymbols'][kept_cells], np.array(hm.symbols, dtype=str)[unpriced_symbols]])
+        self.lastDay = to_day
+
+        # fingerprints of what the days up to here were computed from
+        (price_days, price_prints) = self.priceFingerprints()
+        (trade_days, trade_prints) = self.tradeFingerprints()
+        self.columns.update({
+            'priceDays': price_days[price_days <= to_day],
+            'pricePrints': price_prints[price_days <= to_day],
+            'tradeDays': trade_days[trade_days <= to_day],
+            'tradePrints': trade_prints[trade_days <= to_day],
+        })
+
+    def window(self, start_date: date, end_date: date, adjustment: Dict[str, float]) -> Tuple[List[date], np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # dates, cost basis, value, non-FB cost basis, non-FB value, deposits and withdrawals of a window.
+        # adjustment is what a held symbol without a price adds to the value on top of its running cost.
+        i = start_date.toordinal() - self.firstDay
+        j = end_date.toordinal() - self.firstDay + 1
+        assert(0 <= i < j <= self.lastDay - self.firstDay + 1)
+        c = {name: self.columns[name] for name in self.COLUMNS}
+        prior_cost = c['runningCost'][i - 1] if i > 0 else self.meta['prior_running_cost']
+        prior_non_fb_cost = c['nonFBRunningCost'][i - 1] if i > 0 else self.meta['prior_non_fb_running_cost']
+        cost_basis = c['openValue'][i] + c['runningCost'][i:j] - prior_cost
+        non_fb_cost_basis = c['nonFBOpenValue'][i] + c['nonFBRunningCost'][i:j] - prior_non_fb_cost
+        value = c['value'][i:j].copy()
+        non_fb_value = c['nonFBValue'][i:j].copy()
+
+        cells = (self.columns['unpricedDays'] >= i + self.firstDay) & (self.columns['unpricedDays'] < j + self.firstDay)
+        for (day, symbol) in zip(self.columns['unpricedDays'][cells].tolist(), self.columns['unpricedSymbols'][cells].tolist()):
+            value[day - self.firstDay - i] += adjustment.get(symbol, 0.0)
+            if symbol != 'META':
+                non_fb_value[day - self.firstDay - i] += adjustment.get(symbol, 0.0)
+
+        dates = [start_date + timedelta(days=d) for d in range(j - i)]
+        return (dates, cost_basis, value, non_fb_cost_basis, non_fb_value, c['deposits'][i:j], c['withdrawals'][i:j])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['update', 'status'])
+    parser.add_argument('-s', '--start', help='first day to cover, by default the first day already covered or a year ago')
+    Metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    with Metrics.profiling('ledger', args):
+        from portfolio import Portfolio
+        ledger = Portfolio().ledger()
+        if args.command == 'update':
+            if args.start:
+                start_date = date.fromisoformat(args.start)
+            elif ledger.columns:
+                start_date = date.fromordinal(ledger.firstDay)
+            else:
+                start_date = Utils.today() - timedelta(days=365)
+            ledger.update(start_date, Utils.today())
+        if ledger.columns:
+            print(f'{ledger.fileName} covers {Utils.dateRangeStr(date.fromordinal(ledger.firstDay), date.fromordinal(ledger.lastDay))}')
+        else:
+            print(f'{ledger.fileName} is empty')
+
+if __name__ == "__main__":
+    main()
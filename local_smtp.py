@@ -0,0 +1,89 @@
+import argparse
+import os
+import socketserver
+import time
+import uuid
+from utils import Utils
+
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP to accept mail from smtplib: greeting, EHLO, AUTH, MAIL, RCPT, DATA and QUIT.
+    # Every login is accepted and every message is written to the server's folder.
+    def reply(self, line: str) -> None:
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def readLine(self) -> str:
+        return self.rfile.readline().decode('utf-8', 'replace').rstrip('\r\n')
+
+    def handle(self) -> None:
+        self.reply('220 localhost ESMTP local_smtp')
+        while True:
+            line = self.readLine()
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250-AUTH PLAIN LOGIN')
+                self.reply('250 SIZE 52428800')
+            elif command == 'HELO':
+                self.reply('250 localhost')
+            elif command == 'AUTH':
+                if line.upper().startswith('AUTH LOGIN'):
+                    self.reply('334 VXNlcm5hbWU6')
+                    self.readLine()
+                    self.reply('334 UGFzc3dvcmQ6')
+                    self.readLine()
+                self.reply('235 Authentication successful')
+            elif command in ['MAIL', 'RCPT', 'RSET', 'NOOP']:
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                self.server.save(self.readData())
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            elif line == '':
+                # the client went away
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def readData(self) -> bytes:
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if line in [b'.\r\n', b'.\n', b'']:
+                return b''.join(lines)
+            # undo dot stuffing
+            lines.append(line[1:] if line.startswith(b'..') else line)
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port: int, dir_name: str) -> None:
+        super().__init__(('127.0.0.1', port), LocalSMTPHandler)
+        self.dirName = dir_name
+        os.makedirs(dir_name, exist_ok=True)
+
+    def save(self, message: bytes) -> None:
+        file_name = os.path.join(self.dirName, f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}.eml')
+        with open(file_name, 'wb') as f:
+            f.write(message)
+        Utils.log(f'Received {file_name}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=8025)
+    parser.add_argument('-d', '--dir', default='artifacts/mail')
+    args = parser.parse_args()
+
+    server = LocalSMTPServer(args.port, args.dir)
+    Utils.log(f'Accepting mail on 127.0.0.1:{args.port} into {args.dir}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,24 @@
-from datetime import datetime, timedelta
+from collections import deque
+from dataclasses import dataclass
+from data_context import DataContext
+from metrics import Metrics
+from datetime import date, datetime, timedelta
 from os import pathsep
 from trades import Trades, Trade
-from typing import Dict, List, Set
-from price_history import PriceHistory
+from typing import Dict, List, Set, Tuple, TYPE_CHECKING
+from service_client import ServiceClient
 from utils import Utils
 import argparse
+import csv
+import heapq
+import itertools
+import os
+import numpy as np
+
+# pandas comes in with these, and clients of the portfolio service never need it
+if TYPE_CHECKING:
+    import pandas as pd
+    from price_history import PriceHistory
 
 class Lot:
     trade: Trade
@@ -16,7 +30,7 @@ class Lot:
         self.trade = trade
         self.remainingQuantity = self.trade.quantity
 
-    def computeValue(self, price_history: PriceHistory) -> None:
+    def computeValue(self, price_history: 'PriceHistory') -> None:
         self.initialValue = self.remainingQuantity * self.trade.price
         self.currentValue = self.remainingQuantity * price_history.price(Utils.today(), self.trade.symbol)
 
@@ -31,21 +45,312 @@ class Lot:
             'Percent Loss': (self.currentValue - self.initialValue)/self.initialValue,
             'Remaining Quantity': self.remainingQuantity,
             'Initial Quantity': self.trade.quantity,
-            'Long term': self.trade.date < datetime.today() - timedelta(days=365)
+            'Long term': self.trade.date < Utils.today() - timedelta(days=365)
         }
 
+@dataclass
+class LotMatch:
+    soldLot: Lot
+    boughtLot: Lot
+    quantity: float
+
+    def realizedGain(self) -> float:
+        return self.quantity * (self.soldLot.trade.price - self.boughtLot.trade.price)
+
+class OpenLots:
+    # Open lots of one account and symbol, in the order a method sells them.
+    # Exhausted lots are skipped lazily, so every lot is pushed and popped at most once.
+    def __init__(self, method: str) -> None:
+        self.method = method
+        self.lots = deque()
+        self.heap = []
+        self.pushed = itertools.count()
+        self.byDate: Dict[date, List[Lot]] = {}
+
+    def push(self, lot: Lot) -> None:
+        if self.method == 'hifo':
+            heapq.heappush(self.heap, (-lot.trade.price, lot.trade.date, next(self.pushed), lot))
+        else:
+            self.lots.append(lot)
+        if self.method == 'specific':
+            self.byDate.setdefault(lot.trade.date, []).append(lot)
+
+    def next(self) -> Lot:
+        # next lot to sell from, or None if nothing is open
+        if self.method == 'hifo':
+            while self.heap and self.heap[0][3].remainingQuantity == 0:
+                heapq.heappop(self.heap)
+            return self.heap[0][3] if self.heap else None
+        while self.lots:
+            lot = self.lots[-1] if self.method == 'lifo' else self.lots[0]
+            if lot.remainingQuantity > 0:
+                return lot
+            if self.method == 'lifo':
+                self.lots.pop()
+            else:
+                self.lots.popleft()
+        return None
+
+    def onDate(self, lot_date: date) -> List[Lot]:
+        return [lot for lot in self.byDate.get(lot_date, []) if lot.remainingQuantity > 0]
+
+class LotMatcher:
+    # Matches sells to bought lots in a single pass over trades in date order.
+    # fifo, lifo and hifo sell the oldest, newest and most expensive open lot first. specific sells the
+    # lots named in data/specific_lots.csv first, and falls back to fifo for the rest.
+    METHODS = ['fifo', 'lifo', 'hifo', 'specific']
+    SPECIFIC_LOTS_FILE_NAME = 'data/specific_lots.csv'
+
+    def __init__(self, method: str = 'fifo') -> None:
+        if method not in self.METHODS:
+            raise Exception(f'Unknown lot matching method {method}')
+        self.method = method
+        self.matches: List[LotMatch] = []
+        # (sell date, account, symbol) -> [(lot date, quantity)]
+        self.specificLots: Dict[Tuple[date, str, str], List[Tuple[date, float]]] = {}
+        if method == 'specific':
+            self.loadSpecificLots()
+
+    def loadSpecificLots(self) -> None:
+        if not os.path.exists(self.SPECIFIC_LOTS_FILE_NAME):
+            print(f"No {self.SPECIFIC_LOTS_FILE_NAME}, selling lots first in first out")
+            return
+        with open(self.SPECIFIC_LOTS_FILE_NAME) as f:
+            for row in csv.DictReader(f):
+                key = (datetime.strptime(row['Sell Date'], "%m/%d/%y").date(), row['Account'], row['Symbol'])
+                lot_date = datetime.strptime(row['Lot Date'], "%m/%d/%y").date()
+                self.specificLots.setdefault(key, []).append((lot_date, float(row['Quantity'])))
+
+    def consume(self, sold_lot: Lot, bought_lot: Lot, quantity: float) -> None:
+        quantity = min(quantity, sold_lot.remainingQuantity, bought_lot.remainingQuantity)
+        if quantity <= 0:
+            return
+        bought_lot.remainingQuantity -= quantity
+        sold_lot.remainingQuantity -= quantity
+        self.matches.append(LotMatch(sold_lot, bought_lot, quantity))
+
+    @Metrics.timed('lots.match')
+    def match(self, lots: List[Lot]) -> None:
+        # lots of buys and sells in trade order. Sells with no open lot to match (say, of starting
+        # positions) are carried forward against later buys, the way the pairwise matching used to
+        open_lots: Dict[Tuple[str, str], OpenLots] = {}
+        unmatched: Dict[Tuple[str, str], deque] = {}
+        for lot in lots:
+            key = (lot.trade.account, lot.trade.symbol)
+            if key not in open_lots:
+                open_lots[key] = OpenLots(self.method)
+                unmatched[key] = deque()
+            if lot.trade.action == 'Buy':
+                pending = unmatched[key]
+                while pending and lot.remainingQuantity > 0:
+                    self.consume(pending[0], lot, pending[0].remainingQuantity)
+                    if pending[0].remainingQuantity == 0:
+                        pending.popleft()
+                if lot.remainingQuantity > 0:
+                    open_lots[key].push(lot)
+            else:
+                self.sell(lot, open_lots[key])
+                if lot.remainingQuantity > 0:
+                    unmatched[key].append(lot)
+
+    def sell(self, sold_lot: Lot, lots: OpenLots) -> None:
+        trade = sold_lot.trade
+        # the quantity left of each named lot is kept, so another sell on the same day doesn't take it again
+        specified = self.specificLots.get((trade.date, trade.account, trade.symbol), [])
+        for (i, (lot_date, quantity)) in enumerate(specified):
+            for bought_lot in lots.onDate(lot_date):
+                if quantity <= 0:
+                    break
+                before = sold_lot.remainingQuantity
+                self.consume(sold_lot, bought_lot, quantity)
+                quantity -= before - sold_lot.remainingQuantity
+            specified[i] = (lot_date, quantity)
+        while sold_lot.remainingQuantity > 0:
+            bought_lot = lots.next()
+            if bought_lot is None:
+                return
+            self.consume(sold_lot, bought_lot, sold_lot.remainingQuantity)
+
+class LotTable:
+    # Open lots as columns, one row per lot with shares left, so valuation is one gather from the
+    # price matrix and threshold queries are array expressions
+    COLUMNS = [
+        ('account', np.int32),
+        ('symbol', np.int32),
+        ('date', np.int32),
+        ('remaining', np.float64),
+        ('initialQuantity', np.float64),
+        ('price', np.float64),
+    ]
+
+    def __init__(self, lots: List[Lot], price_history: 'PriceHistory') -> None:
+        self.lots = [lot for lot in lots if lot.remainingQuantity != 0]
+        self.accounts = list(dict.fromkeys(lot.trade.account for lot in self.lots))
+        self.symbols = list(dict.fromkeys(lot.trade.symbol for lot in self.lots))
+        account_index = {account: i for i, account in enumerate(self.accounts)}
+        symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+        self.rows = np.zeros(len(self.lots), dtype=self.COLUMNS)
+        self.rows['account'] = [account_index[lot.trade.account] for lot in self.lots]
+        self.rows['symbol'] = [symbol_index[lot.trade.symbol] for lot in self.lots]
+        self.rows['date'] = [lot.trade.date.toordinal() for lot in self.lots]
+        self.rows['remaining'] = [lot.remainingQuantity for lot in self.lots]
+        self.rows['initialQuantity'] = [lot.trade.quantity for lot in self.lots]
+        self.rows['price'] = [lot.trade.price for lot in self.lots]
+        self.priceHistory = price_history
+        self.value(Utils.today())
+
+    @Metrics.timed('lots.value')
+    def value(self, on: date) -> None:
+        prices = self.priceHistory.priceMatrix([on], self.symbols)[0]
+        self.initialValue = self.rows['remaining'] * self.rows['price']
+        self.currentValue = self.rows['remaining'] * prices[self.rows['symbol']]
+
+    def atLoss(self, threshold: float) -> np.ndarray:
+        return self.currentValue < threshold * self.initialValue
+
+    def lossByAccount(self, mask: np.ndarray) -> Dict[str, float]:
+        loss = np.bincount(self.rows['account'][mask], weights=(self.currentValue - self.initialValue)[mask], minlength=len(self.accounts))
+        has_lots = np.bincount(self.rows['account'][mask], minlength=len(self.accounts)) > 0
+        return {self.accounts[i]: float(loss[i]) for i in np.flatnonzero(has_lots)}
+
+    def accountsHolding(self, symbol: str) -> Set[str]:
+        if symbol not in self.symbols:
+            return set()
+        holding = self.rows['account'][self.rows['symbol'] == self.symbols.index(symbol)]
+        return set(self.accounts[i] for i in np.unique(holding))
+
+    def toFrame(self, mask: np.ndarray) -> 'pd.DataFrame':
+        import pandas as pd
+        rows = self.rows[mask]
+        initial_value = self.initialValue[mask]
+        current_value = self.currentValue[mask]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent_loss = (current_value - initial_value) / initial_value
+        return pd.DataFrame({
+            'Account': np.array(self.accounts, dtype=object)[rows['account']],
+            'Symbol': np.array(self.symbols, dtype=object)[rows['symbol']],
+            'Date': [date.fromordinal(int(d)).isoformat() for d in rows['date']],
+            'Initial Value': initial_value,
+            'Current Value': current_value,
+            'Loss': current_value - initial_value,
+            'Percent Loss': percent_loss,
+            'Remaining Quantity': rows['remaining'],
+            'Initial Quantity': rows['initialQuantity'],
+            'Long term': rows['date'] < (Utils.today() - timedelta(days=365)).toordinal(),
+        })
+
+class AcquisitionIndex:
+    # Every Buy and RSU, across accounts, sorted by symbol and then date, so the acquisitions of a
+    # symbol in any range of dates are one slice found by binary search. Each remembers the row of the
+    # open lot it left in a LotTable, or -1 if it left none.
+    def __init__(self, trades: List[Trade], table: LotTable) -> None:
+        acquisitions = [t for t in trades if t.action == 'Buy' or t.action == 'RSU']
+        # the table's symbols keep their numbers, and symbols no longer held come after them
+        symbol_index = {symbol: i for i, symbol in enumerate(table.symbols)}
+        for t in acquisitions:
+            symbol_index.setdefault(t.symbol, len(symbol_index))
+        row_by_trade = {id(lot.trade): i for i, lot in enumerate(table.lots)}
+
+        symbols = np.array([symbol_index[t.symbol] for t in acquisitions], dtype=np.int64)
+        days = np.array([t.date.toordinal() for t in acquisitions], dtype=np.int64)
+        open_rows = np.array([row_by_trade.get(id(t), -1) for t in acquisitions], dtype=np.int64)
+        keys = self.key(symbols, days)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.days = days[order]
+        self.openRows = open_rows[order]
+
+    def key(self, symbols: np.ndarray, days: np.ndarray) -> np.ndarray:
+        return (symbols << 32) | days
+
+    def slices(self, symbols: np.ndarray, first_days: np.ndarray, last_days: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # start and end of the acquisitions of each symbol from its first day to its last, inclusive
+        return (
+            np.searchsorted(self.keys, self.key(symbols, first_days), side='left'),
+            np.searchsorted(self.keys, self.key(symbols, last_days), side='right'),
+        )
+
+@dataclass
+class HarvestPlan:
+    # rows of the lot table to sell, those of them sold only so that they don't count as a
+    # replacement purchase, and for symbols that can't be harvested now, the first day they can be
+    sell: np.ndarray
+    clearing: np.ndarray
+    blockedUntil: Dict[str, date]
+
+class HarvestPlanner:
+    # Sells at a loss are wash sales when the same symbol is bought or granted, in any account, within
+    # 30 days before or after. A symbol's lots at a loss are harvested together with every other open
+    # lot acquired within that window, so nothing bought in it is left held, as long as none of the
+    # window's acquisitions are already gone or dated after the sale and the net result is a loss.
+    # Selling more lots of a symbol only adds to its loss, so that's the largest loss harvestable
+    # without a wash sale.
+    WASH_SALE_DAYS = 30
+    # blocked symbols listed by the CLI, soonest first
+    BLOCKED_SHOWN = 10
+
+    def __init__(self, table: LotTable, trades: Trades) -> None:
+        self.table = table
+        self.index = AcquisitionIndex(trades.trades, table)
+
+    @Metrics.timed('lots.harvest')
+    def plan(self, threshold: float, on: date) -> HarvestPlan:
+        table = self.table
+        gain = table.currentValue - table.initialValue
+        day = on.toordinal()
+        # lots without a price have no current value to sell at, and lots bought after on aren't held yet
+        candidates = table.atLoss(threshold) & (table.currentValue > 0) & (table.rows['date'] <= day)
+        rows = np.flatnonzero(candidates)
+        # every candidate of a symbol has the same window, so it's looked up once per symbol
+        symbols = np.unique(table.rows['symbol'][rows]).astype(np.int64)
+        (starts, ends) = self.index.slices(symbols, np.full(len(symbols), day - self.WASH_SALE_DAYS), np.full(len(symbols), day + self.WASH_SALE_DAYS))
+
+        # acquisitions that can't be sold along with the candidates, because they're already gone or
+        # still to come, counted per slice
+        is_blocking = (self.index.openRows < 0) | (self.index.days > day)
+        num_blocking = np.concatenate([[0], np.cumsum(is_blocking)])
+        blocked = num_blocking[ends] - num_blocking[starts] > 0
+
+        # open lots acquired in the window, each symbol's slice expanded to its acquisitions
+        lengths = ends - starts
+        in_window = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+        in_window = in_window[~is_blocking[in_window]]
+        clearing = np.zeros(len(table.lots), dtype=bool)
+        clearing[self.index.openRows[in_window]] = True
+        clearing &= ~candidates
+
+        # a symbol is harvested if nothing blocks it and selling adds up to a loss
+        num_symbols = len(table.symbols)
+        is_blocked = np.zeros(num_symbols, dtype=bool)
+        is_blocked[symbols[blocked]] = True
+        selling = candidates | clearing
+        net = np.bincount(table.rows['symbol'][selling], weights=gain[selling], minlength=num_symbols)
+        harvested = ~is_blocked & (net < 0)
+        sell = selling & harvested[table.rows['symbol']]
+        Metrics.count('lots.harvest_candidates', len(rows))
+
+        # the window moves past the last acquisition that blocks it a day after it's 30 days old, or
+        # 31 days after one still to come
+        last_blocking = np.maximum.accumulate(np.concatenate([[-1], np.where(is_blocking, np.arange(len(is_blocking)), -1)]))
+        blocked_days = self.index.days[last_blocking[ends[blocked]]]
+        blocked_until = {table.symbols[symbol]: date.fromordinal(int(d) + self.WASH_SALE_DAYS + 1) for (symbol, d) in zip(symbols[blocked].tolist(), blocked_days.tolist())}
+        return HarvestPlan(sell, clearing & sell, blocked_until)
+
 class LotAnalysis:
     FILE_NAME = 'artifacts/loss_lots.csv'
+    HARVEST_FILE_NAME = 'artifacts/harvest_plan.csv'
 
     potentialLots: List[Lot]
 
-    def __init__(self) -> None:
-        self.trades = Trades()
-        self.trades.load()
-        self.priceHistory = PriceHistory()
+    def __init__(self, method: str = 'fifo', trades: Trades = None, price_history: 'PriceHistory' = None) -> None:
+        self.trades = trades if trades else DataContext.trades()
+        self.priceHistory = price_history if price_history else DataContext.priceHistory()
         self.boughtLots = self.lotsFromTrades('Buy')
         self.soldLots = self.lotsFromTrades('Sell')
+        self.matcher = LotMatcher(method)
         self.balanceLots()
+        self.table = LotTable(self.allLots(self.boughtLots), self.priceHistory)
 
     def lotsFromTrades(self, action: str) -> Dict[str, Dict[str, List[Lot]]]:
         lots = {}
@@ -57,34 +362,24 @@ class LotAnalysis:
             lots[trade.account][trade.symbol].append(Lot(trade))
         return lots
 
+    def allLots(self, lots: Dict[str, Dict[str, List[Lot]]]) -> List[Lot]:
+        return [lot for by_symbol in lots.values() for symbol_lots in by_symbol.values() for lot in symbol_lots]
 
     def balanceLots(self) -> None:
-        # Fuzzy matching of lots. Assumes first bought first sold
-        for account in self.boughtLots:
-            if account not in self.soldLots:
-                continue
-            for symbol in self.boughtLots[account]:
-                if symbol not in self.soldLots[account]:
-                    continue
-                for bought_lot in self.boughtLots[account][symbol]:
-                    for sold_lot in self.soldLots[account][symbol]:
-                        if bought_lot.remainingQuantity > sold_lot.remainingQuantity:
-                            bought_lot.remainingQuantity -= sold_lot.remainingQuantity
-                            sold_lot.remainingQuantity = 0
-                        else:
-                            sold_lot.remainingQuantity -= bought_lot.remainingQuantity
-                            bought_lot.remainingQuantity = 0
+        lot_by_trade = {id(lot.trade): lot for lot in self.allLots(self.boughtLots) + self.allLots(self.soldLots)}
+        self.matcher.match([lot_by_trade[id(t)] for t in self.trades.trades if id(t) in lot_by_trade])
+
+    def realizedGains(self) -> List[LotMatch]:
+        return self.matcher.matches
 
     def lotsAtLoss(self, threshold: float) -> List[Lot]:
+        mask = self.table.atLoss(threshold)
         potentialLots = []
-        for account in self.boughtLots:
-            for symbol in self.boughtLots[account]:
-                for lot in self.boughtLots[account][symbol]:
-                    if lot.remainingQuantity == 0:
-                        continue
-                    lot.computeValue(self.priceHistory)
-                    if lot.currentValue < threshold * lot.initialValue:
-                        potentialLots.append(lot)
+        for i in np.flatnonzero(mask):
+            lot = self.table.lots[i]
+            lot.initialValue = self.table.initialValue[i]
+            lot.currentValue = self.table.currentValue[i]
+            potentialLots.append(lot)
         return potentialLots
 
     def lossByAccount(self, potentialLots: List[Lot]) -> Dict[str, float]:
@@ -96,39 +391,85 @@ class LotAnalysis:
         return lossByAccount
 
     def accountsHoldingSymbol(self, symbol: str) -> Set[str]:
-        accounts = set()
-        for account in self.boughtLots:
-            if symbol in self.boughtLots[account]:
-                for lot in self.boughtLots[account][symbol]:
-                    if lot.remainingQuantity > 0:
-                        accounts.add(account)
-                        continue
-        return accounts
+        return self.table.accountsHolding(symbol)
+
+    def harvestPlan(self, threshold: float) -> HarvestPlan:
+        return HarvestPlanner(self.table, self.trades).plan(threshold, Utils.today())
+
+    def harvestFrame(self, plan: HarvestPlan) -> 'pd.DataFrame':
+        lots = self.table.toFrame(plan.sell)
+        lots['Clears wash sale'] = plan.clearing[plan.sell]
+        return lots
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('func', choices=['losses', 'accounts'])
+    parser.add_argument('func', choices=['losses', 'accounts', 'harvest'])
     parser.add_argument('-t', '--thresh', type=float, default=0.8)
 
     parser.add_argument('-s', '--sym', default='VTI')
+    parser.add_argument('-m', '--method', choices=LotMatcher.METHODS, default='fifo')
+    parser.add_argument('--local', action='store_true', help="don't use a running portfolio_service.py")
+    Metrics.addArguments(parser)
     args = parser.parse_args()
 
-    la = LotAnalysis()
-
-    if args.func == 'losses':
-        lots = la.lotsAtLoss(args.thresh)
-        Utils.writeCSV(la.FILE_NAME, [lot.toDict() for lot in lots])
-        print(f'Wrote {la.FILE_NAME}')
-        for account, loss in la.lossByAccount(lots).items():
-            print(f'{account}\t{Utils.currency(loss)}')
-    elif args.func == 'accounts':
-        accounts = la.accountsHoldingSymbol(args.sym)
-        if len(accounts) == 0:
-            print(f'No accounts hold {args.sym}')
+    with Metrics.profiling('lot_analysis', args):
+        client = None if args.local else ServiceClient.connect()
+        if client:
+            if args.func == 'losses':
+                losses = client.get('/losses', thresh=args.thresh, method=args.method)
+                with open(LotAnalysis.FILE_NAME, 'w') as f:
+                    writer = csv.DictWriter(f, fieldnames=losses['columns'], lineterminator='\n')
+                    writer.writeheader()
+                    writer.writerows(losses['lots'])
+                Metrics.count('rows_written', len(losses['lots']))
+                print(f'Wrote {LotAnalysis.FILE_NAME}')
+                loss_by_account = losses['lossByAccount']
+            elif args.func == 'harvest':
+                harvest = client.get('/harvest', thresh=args.thresh, method=args.method)
+                with open(LotAnalysis.HARVEST_FILE_NAME, 'w') as f:
+                    writer = csv.DictWriter(f, fieldnames=harvest['columns'], lineterminator='\n')
+                    writer.writeheader()
+                    writer.writerows(harvest['lots'])
+                Metrics.count('rows_written', len(harvest['lots']))
+                print(f'Wrote {LotAnalysis.HARVEST_FILE_NAME}')
+                loss_by_account = harvest['lossByAccount']
+                blocked_until = {symbol: date.fromisoformat(d) for symbol, d in harvest['blockedUntil'].items()}
+            else:
+                accounts = client.get('/accounts', sym=args.sym, method=args.method)
         else:
-            account_list = ', '.join(accounts)
-            print(f'Following accounts hold {args.sym}: {account_list}')
-        
+            la = LotAnalysis(args.method)
+            if args.func == 'losses':
+                at_loss = la.table.atLoss(args.thresh)
+                with Metrics.span('csv.write'):
+                    la.table.toFrame(at_loss).to_csv(la.FILE_NAME, index=False)
+                Metrics.count('rows_written', int(at_loss.sum()))
+                print(f'Wrote {la.FILE_NAME}')
+                loss_by_account = la.table.lossByAccount(at_loss)
+            elif args.func == 'harvest':
+                plan = la.harvestPlan(args.thresh)
+                with Metrics.span('csv.write'):
+                    la.harvestFrame(plan).to_csv(la.HARVEST_FILE_NAME, index=False)
+                Metrics.count('rows_written', int(plan.sell.sum()))
+                print(f'Wrote {la.HARVEST_FILE_NAME}')
+                loss_by_account = la.table.lossByAccount(plan.sell)
+                blocked_until = plan.blockedUntil
+            else:
+                accounts = la.accountsHoldingSymbol(args.sym)
+
+        if args.func == 'losses' or args.func == 'harvest':
+            for account, loss in loss_by_account.items():
+                print(f'{account}\t{Utils.currency(loss)}')
+        if args.func == 'harvest' and blocked_until:
+            print(f'{len(blocked_until)} symbols have buys within {HarvestPlanner.WASH_SALE_DAYS} days, first harvestable on:')
+            for symbol, until in sorted(blocked_until.items(), key=lambda s: (s[1], s[0]))[:HarvestPlanner.BLOCKED_SHOWN]:
+                print(f'{symbol}\t{Utils.dateToStr(until)}')
+        elif args.func == 'accounts':
+            if len(accounts) == 0:
+                print(f'No accounts hold {args.sym}')
+            else:
+                account_list = ', '.join(accounts)
+                print(f'Following accounts hold {args.sym}: {account_list}')
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
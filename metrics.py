@@ -0,0 +1,97 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List
+from utils import Utils
+
+class Metrics:
+    # Process-wide timings of named spans and counts of named events. Both are always collected,
+    # which costs a clock read per span and a dict update per count. A CLI run with --profile, or with
+    # STOCKS_PROFILE=1 in its environment, writes them out as JSON when it finishes. --cprofile, or
+    # STOCKS_CPROFILE=1, also dumps a cProfile of the run for pstats or snakeviz.
+    DIR_NAME = 'artifacts/profiles'
+
+    # name -> [count, total seconds, longest seconds]
+    spans: Dict[str, List[float]] = {}
+    counters: Dict[str, float] = {}
+    lock = threading.Lock()
+
+    @contextmanager
+    def span(name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with Metrics.lock:
+                span = Metrics.spans.setdefault(name, [0, 0.0, 0.0])
+                span[0] += 1
+                span[1] += elapsed
+                span[2] = max(span[2], elapsed)
+
+    def timed(name: str):
+        # span() around every call of the decorated function
+        def decorate(func):
+            @functools.wraps(func)
+            def timed_func(*args, **kwargs):
+                with Metrics.span(name):
+                    return func(*args, **kwargs)
+            return timed_func
+        return decorate
+
+    def count(name: str, n: float = 1) -> None:
+        Metrics.counters[name] = Metrics.counters.get(name, 0) + n
+
+    def reset() -> None:
+        with Metrics.lock:
+            Metrics.spans = {}
+            Metrics.counters = {}
+
+    def report() -> Dict:
+        return {
+            'spans': {name: {'count': int(c), 'seconds': round(total, 6), 'max': round(longest, 6)}
+                      for name, (c, total, longest) in sorted(Metrics.spans.items(), key=lambda s: -s[1][1])},
+            'counters': {name: int(n) if float(n).is_integer() else n for name, n in sorted(Metrics.counters.items())},
+        }
+
+    def addArguments(parser) -> None:
+        parser.add_argument('--profile', action='store_true', help=f'write a JSON timing report to {Metrics.DIR_NAME}')
+        parser.add_argument('--cprofile', action='store_true', help=f'also write a cProfile dump to {Metrics.DIR_NAME}')
+
+    @contextmanager
+    def profiling(command: str, args):
+        profile = args.profile or os.environ.get('STOCKS_PROFILE') == '1'
+        cprofile = args.cprofile or os.environ.get('STOCKS_CPROFILE') == '1'
+        if not (profile or cprofile):
+            yield
+            return
+
+        started = datetime.now()
+        profiler = cProfile.Profile() if cprofile else None
+        if profiler:
+            profiler.enable()
+        try:
+            with Metrics.span(command):
+                yield
+        finally:
+            if profiler:
+                profiler.disable()
+            os.makedirs(Metrics.DIR_NAME, exist_ok=True)
+            base_name = os.path.join(Metrics.DIR_NAME, f'{command}-{started.strftime("%Y%m%d-%H%M%S")}')
+            with open(base_name + '.json', 'w') as f:
+                json.dump({
+                    'command': command,
+                    'argv': sys.argv[1:],
+                    'started': started.isoformat(timespec='seconds'),
+                    **Metrics.report(),
+                }, f, indent=1)
+            Utils.log(f'Wrote {base_name}.json')
+            if profiler:
+                profiler.dump_stats(base_name + '.prof')
+                Utils.log(f'Wrote {base_name}.prof')
@@ -1,10 +1,22 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
+from data_context import DataContext
+from metrics import Metrics
 from datetime import datetime, timedelta, date
-from price_history import PriceHistory
-from starting_positions import Position, StartingPositions
-from trades import Trade, Trades
+from position_index import PositionIndex
+from returns import Returns
+from service_client import ServiceClient
+from starting_positions import Position
+from trades import Trade
 from utils import Utils
-from typing import List, Dict, Tuple, MutableSet
+from typing import List, Dict, Tuple, MutableSet, TYPE_CHECKING
+import argparse
+import numpy as np
+
+# pandas comes in with these, and clients of the portfolio service never need it
+if TYPE_CHECKING:
+    from holdings_matrix import HoldingsMatrix, HoldingsWindow
+    from ledger import PerformanceLedger
+    from price_history import PriceHistory
 
 @dataclass
 class AggregatePerfRow:
@@ -19,6 +31,8 @@ class AggregatePerfRow:
     withdrawals: float
     netNonFBValue: float
     dayNonFBGain: float
+    # compounded from the start date, so trades don't count as gains or losses
+    timeWeightedReturn: float
 
 @dataclass
 class FinalPosition:
@@ -36,52 +50,207 @@ class FinalPosition:
     gainOnStartValue: float
     gainOnMean50Day: float
     gainOnMean200Day: float
+    # annualized money weighted return over the window
+    irr: float
 
 class Portfolio:
-    def __init__(self) -> None:
-        self.startingPositions = StartingPositions()
-        self.startingPositions.load()
-
-        self.trades = Trades()
-        self.trades.load()
-
-        self.priceHistory = PriceHistory()
-
-    def applyTrade(self, trade: Trade, positions: Dict[str, Position]):
-        symbol = trade.symbol
-
-        if symbol not in positions:
-            positions[symbol] = Position(symbol)
-
-        quantity = trade.quantity
-        cost_basis = trade.quantity * trade.price
-
-        if trade.action == 'Buy' or trade.action == 'RSU':
-            positions[symbol].quantity += quantity
-            positions[symbol].costBasis += cost_basis
-        elif trade.action == 'Sell':
-            if quantity > positions[symbol].quantity:
-                print(f"Sold {quantity} {symbol} shares but held only {positions[symbol].quantity}")
-                quantity = positions[symbol].quantity
-            positions[symbol].quantity -= quantity
-            positions[symbol].costBasis -= cost_basis
-
-    def timeSeries(self, start_date: date, end_date: date) -> Tuple[List[AggregatePerfRow], List[FinalPosition]]:
-        current_positions = self.startingPositions.positions.copy()
-        date = self.trades.trades[0].date
-        assert(date <= start_date)
+    # 'matrix' values every day and symbol in one vectorized pass, 'loop' replays trades day by day
+    ENGINES = ['matrix', 'loop']
+
+    def __init__(self, price_history: 'PriceHistory' = None) -> None:
+        self.startingPositions = DataContext.startingPositions()
+        self.trades = DataContext.trades()
+
+        self.positionIndex = PositionIndex(self.startingPositions, self.trades).load()
+
+        self.priceHistory = price_history if price_history else DataContext.priceHistory()
+        self.performanceLedger = None
+
+    def applyTrade(self, trade: Trade, positions: Dict[Tuple[str, str], Position]):
+        # a sell only takes shares from the account it was made in, as in the position index
+        key = (trade.account, trade.symbol)
+        account_positions = {trade.symbol: positions[key]} if key in positions else {}
+        PositionIndex.applyTrade(trade, account_positions)
+        positions[key] = account_positions[trade.symbol]
+
+    def sumAccounts(positions: Dict[Tuple[str, str], Position]) -> Dict[str, Position]:
+        # (account, symbol) positions summed by symbol, in order of first appearance
+        summed = {}
+        for position in positions.values():
+            if position.symbol not in summed:
+                summed[position.symbol] = Position(position.symbol)
+            total = summed[position.symbol]
+            total.quantity += position.quantity
+            total.costBasis += position.costBasis
+            total.startValue += position.startValue
+            total.startQuantity += position.startQuantity
+        return summed
+
+    def timeSeries(self, start_date: date, end_date: date, engine: str = 'matrix') -> Tuple[List[AggregatePerfRow], List[FinalPosition]]:
+        if engine == 'matrix':
+            return self.timeSeriesMatrix(start_date, end_date)
+        elif engine == 'loop':
+            return self.timeSeriesLoop(start_date, end_date)
+        raise Exception(f'Unknown engine {engine}')
+
+    def timeSeriesMatrix(self, start_date: date, end_date: date) -> Tuple[List[AggregatePerfRow], List[FinalPosition]]:
+        return self.timeSeriesPeriods([start_date], end_date)[start_date]
+
+    def timeSeriesPeriods(self, start_dates: List[date], end_date: date) -> Dict[date, Tuple[List[AggregatePerfRow], List[FinalPosition]]]:
+        # time series for several windows ending on the same day, read from the ledger once it covers the longest
+        assert(self.trades.trades[0].date <= min(start_dates))
+        assert(max(start_dates) < end_date)
+        self.ledger().update(min(start_dates), end_date)
+        return {start_date: self.ledgerTimeSeries(start_date, end_date) for start_date in start_dates}
+
+    def ledger(self) -> 'PerformanceLedger':
+        if self.performanceLedger is None:
+            from ledger import PerformanceLedger
+            self.performanceLedger = PerformanceLedger(self)
+        return self.performanceLedger
+
+    @Metrics.timed('timeseries.ledger')
+    def ledgerTimeSeries(self, start_date: date, end_date: date) -> Tuple[List[AggregatePerfRow], List[FinalPosition]]:
+        # Final positions only need each symbol's state at the two ends of the window, which come from
+        # the position index, and the trades in between
+        start_positions = self.positionIndex.positionsBefore(start_date)
+        end_positions = self.positionIndex.positionsAsOf(end_date)
+        trades = [t for t in self.trades.since(start_date) if t.date <= end_date]
+        symbols = list(dict.fromkeys([*start_positions, *[t.symbol for t in trades]]))
+        symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+        num_symbols = len(symbols)
+        num_days = (end_date - start_date).days + 1
+
+        start_quantity = np.array([start_positions[s].quantity if s in start_positions else 0.0 for s in symbols])
+        start_cost = np.array([start_positions[s].costBasis if s in start_positions else 0.0 for s in symbols])
+        quantity = np.array([end_positions[s].quantity for s in symbols])
+        running_cost = np.array([end_positions[s].costBasis for s in symbols])
+        prices = self.priceHistory.priceMatrix([start_date, end_date], symbols)
+        start_value = np.where(start_quantity == 0, 0.0, np.where(prices[0] == 0, start_cost, start_quantity * prices[0]))
+        cost_basis = start_value + running_cost - start_cost
+        value = np.where(quantity == 0, 0.0, np.where(prices[1] == 0, cost_basis, quantity * prices[1]))
+
+        sym = np.array([symbol_index[t.symbol] for t in trades], dtype=np.int64)
+        day = np.array([(t.date - start_date).days for t in trades], dtype=np.int64)
+        trade_value = np.array([t.quantity * t.price for t in trades], dtype=float)
+        action = np.array([t.action for t in trades], dtype=object)
+        is_buy = action == 'Buy'
+        is_sell = action == 'Sell'
+        is_withdrawal = is_sell & (sym != symbol_index.get('META', -1))
+        bought = np.bincount(sym[is_buy], weights=trade_value[is_buy], minlength=num_symbols)
+        sold = np.bincount(sym[is_withdrawal], weights=trade_value[is_withdrawal], minlength=num_symbols)
+
+        # the start value goes in on the first day, each trade's cost basis on its day, and the value comes out on the last
+        added = np.where(is_buy | (action == 'RSU'), trade_value, np.where(is_sell, -trade_value, 0.0))
+        flow_keys = np.concatenate([np.arange(num_symbols) * num_days, sym * num_days + day, np.arange(num_symbols) * num_days + num_days - 1])
+        (keys, flow_index) = np.unique(flow_keys, return_inverse=True)
+        amounts = np.bincount(flow_index, weights=np.concatenate([-start_value, -added, value]), minlength=len(keys))
+        nonzero = amounts != 0
+        irr = Returns.irrOfFlows(keys[nonzero] // num_days, keys[nonzero] % num_days, amounts[nonzero], num_symbols)
+
+        # a held symbol without a price is valued at its cost basis in the window, which is its running
+        # cost plus the difference between its start value and its running cost at the start
+        adjustment = dict(zip(symbols, (start_value - start_cost).tolist()))
+        aggregate_perf = self.aggregateRows(*self.ledger().window(start_date, end_date, adjustment))
+        final_positions = self.finalPositions(symbols, start_value, start_quantity, value, quantity, cost_basis, bought, sold, prices[1], irr)
+        return (aggregate_perf, final_positions)
+
+    def timeSeriesByAccount(self, start_date: date, end_date: date) -> Tuple[Tuple[List[AggregatePerfRow], List[FinalPosition]], Dict[str, Tuple[List[AggregatePerfRow], List[FinalPosition]]]]:
+        # the time series of the whole portfolio and of each account, from one holdings matrix. An account's
+        # final positions are the value and gain of each symbol held in that account.
         assert(start_date < end_date)
+        hm = self.holdingsMatrix(start_date, end_date)
+        by_account = {w.account: self.aggregate(w) for w in hm.accountWindows(start_date)}
+        return (self.aggregate(hm.window(start_date)), by_account)
 
-        day = timedelta(days=1)
+    def holdingsMatrix(self, start_date: date, end_date: date) -> 'HoldingsMatrix':
+        assert(self.trades.trades[0].date <= start_date)
+        from holdings_matrix import HoldingsMatrix
+        return HoldingsMatrix(self.positionIndex.accountPositionsBefore(start_date), self.trades.since(start_date), self.priceHistory, start_date, end_date)
 
-        # Run up to the start date
-        while date < start_date:
-            for trade in [t for t in self.trades.trades if t.date == date]:
-                self.applyTrade(trade, current_positions)
-            date += day
+    @Metrics.timed('timeseries.aggregate')
+    def aggregate(self, hm: 'HoldingsWindow') -> Tuple[List[AggregatePerfRow], List[FinalPosition]]:
+        non_fb = np.array([symbol != 'META' for symbol in hm.symbols], dtype=bool)
+        aggregate_perf = self.aggregateRows(
+            hm.dates,
+            hm.costBasis.sum(axis=1),
+            hm.value.sum(axis=1),
+            hm.costBasis[:, non_fb].sum(axis=1),
+            hm.value[:, non_fb].sum(axis=1),
+            hm.deposits,
+            hm.withdrawals,
+        )
+        irr = Returns.irr(hm.value, hm.costBasis)
+        final_positions = self.finalPositions(hm.symbols, hm.startValue, hm.startQuantity, hm.value[-1], hm.quantity[-1], hm.costBasis[-1], hm.bought, hm.sold, hm.prices[-1], irr)
+        return (aggregate_perf, final_positions)
+
+    def aggregateRows(self, dates: List[date], cost_basis: np.ndarray, value: np.ndarray, non_fb_cost_basis: np.ndarray, non_fb_value: np.ndarray,
+                      deposits: np.ndarray, withdrawals: np.ndarray) -> List[AggregatePerfRow]:
+        net_non_fb_value = non_fb_value - np.cumsum(deposits) + np.cumsum(withdrawals)
+        day_non_fb_gain = np.zeros(len(dates))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            day_non_fb_gain[1:] = (net_non_fb_value[1:] - net_non_fb_value[:-1]) / net_non_fb_value[:-1]
+        time_weighted = Returns.cumulative(Returns.timeWeighted(value, cost_basis))
+
+        return [AggregatePerfRow(*row) for row in zip(
+            dates,
+            cost_basis.tolist(),
+            value.tolist(),
+            (value - cost_basis).tolist(),
+            non_fb_cost_basis.tolist(),
+            non_fb_value.tolist(),
+            (non_fb_value - non_fb_cost_basis).tolist(),
+            deposits.tolist(),
+            withdrawals.tolist(),
+            net_non_fb_value.tolist(),
+            day_non_fb_gain.tolist(),
+            time_weighted.tolist(),
+        )]
+
+    def finalPositions(self, symbols: List[str], start_value: np.ndarray, start_quantity: np.ndarray, value: np.ndarray, quantity: np.ndarray, cost_basis: np.ndarray,
+                       bought: np.ndarray, sold: np.ndarray, prices: np.ndarray, irr: np.ndarray) -> List[FinalPosition]:
+        # from each symbol's state at the end of the window
+        final_positions = []
+        for i, symbol in enumerate(symbols):
+            if start_quantity[i] == 0 and quantity[i] == 0 and bought[i] == 0:
+                continue
+            net_gain = value[i] + sold[i] - bought[i] - start_value[i]
+            current_price = float(prices[i])
+            mean_50d = self.priceHistory.movingAverage(symbol, 50)
+            mean_200d = self.priceHistory.movingAverage(symbol, 200)
+            final_positions.append(FinalPosition(
+                symbol,
+                float(start_value[i]),
+                float(start_quantity[i]),
+                float(value[i]),
+                float(quantity[i]),
+                float(value[i] - cost_basis[i]),
+                float(bought[i]),
+                float(sold[i]),
+                current_price,
+                mean_50d,
+                mean_200d,
+                0 if start_value[i] == 0 else float(net_gain / start_value[i] * 100),
+                (current_price - mean_50d) / mean_50d * 100,
+                (current_price - mean_200d) / mean_200d * 100,
+                float(irr[i]),
+            ))
+        return final_positions
+
+    @Metrics.timed('trades.replay_loop')
+    def timeSeriesLoop(self, start_date: date, end_date: date) -> Tuple[List[AggregatePerfRow], List[FinalPosition]]:
+        assert(self.trades.trades[0].date <= start_date)
+        assert(start_date < end_date)
+
+        # positions at the start date come from the index instead of a replay from the first trade, and
+        # are kept by account so a sell is clamped to what its own account holds
+        account_positions = self.positionIndex.accountPositionsBefore(start_date)
+        trades = self.trades.since(start_date)
+        date = start_date
+        day = timedelta(days=1)
 
         # Reset cost basis on start date
-        for position in current_positions.values():
+        for position in account_positions.values():
             position.costBasis = self.priceHistory.positionValue(start_date, position)
             position.resetStartValue()
 
@@ -90,14 +259,16 @@ class Portfolio:
         cumulative_withdrawn = 0
 
         traded_value_by_symbol = {}
+        # symbol -> value and cost basis on every day so far, for the money weighted returns
+        history_by_symbol: Dict[str, Tuple[List[float], List[float]]] = {}
 
         while date <= end_date:
             # apply trades from this day
             deposit = 0
             withdrawn = 0
 
-            for trade in [t for t in self.trades.trades if t.date == date]:
-                self.applyTrade(trade, current_positions)
+            for trade in [t for t in trades if t.date == date]:
+                self.applyTrade(trade, account_positions)
                 symbol = trade.symbol
                 trade_value = trade.quantity * trade.price
                 if symbol not in traded_value_by_symbol:
@@ -112,6 +283,7 @@ class Portfolio:
             cumulative_deposit += deposit
             cumulative_withdrawn += withdrawn
 
+            current_positions = Portfolio.sumAccounts(account_positions)
             cost_basis = 0
             value = 0
             gain = 0
@@ -121,6 +293,10 @@ class Portfolio:
             for position in current_positions.values():
                 current_value = self.priceHistory.positionValue(date, position)
                 current_gain = current_value - position.costBasis
+                if position.symbol not in history_by_symbol:
+                    history_by_symbol[position.symbol] = ([0.0] * len(aggregate_perf), [0.0] * len(aggregate_perf))
+                history_by_symbol[position.symbol][0].append(current_value)
+                history_by_symbol[position.symbol][1].append(position.costBasis)
                 value += current_value
                 gain += current_gain
                 cost_basis += position.costBasis
@@ -146,10 +322,24 @@ class Portfolio:
                 deposit,
                 withdrawn,
                 net_non_fb_value,
-                day_non_fb_gain
+                day_non_fb_gain,
+                0.0
             ))
             date += day
 
+        time_weighted = Returns.cumulative(Returns.timeWeighted(
+            np.array([r.totalValue for r in aggregate_perf]),
+            np.array([r.totalCostBasis for r in aggregate_perf]),
+        ))
+        for (row, twr) in zip(aggregate_perf, time_weighted.tolist()):
+            row.timeWeightedReturn = twr
+        symbols = list(history_by_symbol)
+        irr = Returns.irr(
+            np.array([history_by_symbol[s][0] for s in symbols]).T,
+            np.array([history_by_symbol[s][1] for s in symbols]).T,
+        )
+        irr_by_symbol = dict(zip(symbols, irr.tolist()))
+
         final_positions = []
         for position in current_positions.values():
             symbol = position.symbol
@@ -178,16 +368,73 @@ class Portfolio:
                 0 if position.startValue == 0 else net_gain / position.startValue * 100,
                 (current_price - mean_50d) / mean_50d * 100,
                 (current_price - mean_200d) / mean_200d * 100,
+                irr_by_symbol[symbol],
             ))
         return (aggregate_perf, final_positions)
 
     def activePositions(self) -> MutableSet[str]:
+        # same symbols as the final positions of timeSeries(yesterday, today), without valuing them
         today = Utils.today()
         yesterday = today - timedelta(days=1)
-        (_, positions) = self.timeSeries(yesterday, today)
         active_positions = set()
-        [active_positions.add(p.symbol) for p in positions]
+        [active_positions.add(p.symbol) for p in self.positionIndex.positionsBefore(yesterday).values() if p.quantity != 0]
+        [active_positions.add(p.symbol) for p in self.positionIndex.positionsAsOf(today).values() if p.quantity != 0]
+        [active_positions.add(t.symbol) for t in self.trades.since(yesterday) if t.action == 'Buy' and t.date <= today]
         return active_positions
 
+    def compareEngines(self, start_date: date, end_date: date) -> float:
+        # largest absolute difference between the two engines, across every field of every row
+        (loop_perf, loop_positions) = self.timeSeries(start_date, end_date, 'loop')
+        (matrix_perf, matrix_positions) = self.timeSeries(start_date, end_date, 'matrix')
+        assert([p.symbol for p in loop_positions] == [p.symbol for p in matrix_positions])
+        max_diff = 0.0
+        for (a, b) in zip(loop_perf + loop_positions, matrix_perf + matrix_positions):
+            for (x, y) in zip(asdict(a).values(), asdict(b).values()):
+                if isinstance(x, float) and not (np.isnan(x) and np.isnan(y)):
+                    max_diff = max(max_diff, abs(x - y))
+        return max_diff
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--start', default='2021-01-01')
+    parser.add_argument('-e', '--engine', choices=Portfolio.ENGINES + ['compare'], default='matrix')
+    parser.add_argument('-a', '--by-account', action='store_true', help='also write the time series of every account')
+    parser.add_argument('--local', action='store_true', help="don't use a running portfolio_service.py")
+    Metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    with Metrics.profiling('portfolio', args):
+        start_date = datetime.fromisoformat(args.start).date()
+        if args.by_account:
+            end_date = Utils.today()
+            date_range_str = Utils.dateRangeStr(start_date, end_date)
+            Utils.log('Started timeSeriesByAccount')
+            (_, by_account) = Portfolio().timeSeriesByAccount(start_date, end_date)
+            Utils.log('Finished timeSeriesByAccount')
+            with Metrics.span('csv.write'):
+                for (account, (aggregate_perf, final_positions)) in by_account.items():
+                    Utils.writeCSVObjects(f'artifacts/Timeseries {account} {date_range_str}.csv', aggregate_perf)
+                    if final_positions:
+                        Utils.writeCSVObjects(f'artifacts/Stocks {account} {date_range_str}.csv', final_positions)
+                    Metrics.count('rows_written', len(aggregate_perf) + len(final_positions))
+            for (account, (aggregate_perf, _)) in by_account.items():
+                print(f'{account}\t{Utils.currency(aggregate_perf[-1].totalValue)}\t{Utils.currency(aggregate_perf[-1].totalGain)}')
+            return
+
+        client = None if args.local or args.engine != 'matrix' else ServiceClient.connect()
+        if client:
+            Utils.log('Started timeSeries with the portfolio service')
+            client.get('/timeseries', start=start_date.isoformat(), end=Utils.today().isoformat())
+            Utils.log('Finished timeSeries')
+            return
+
+        portfolio = Portfolio()
+        Utils.log(f'Started timeSeries with {args.engine}')
+        if args.engine == 'compare':
+            print(f'Max difference between engines: {portfolio.compareEngines(start_date, Utils.today())}')
+        else:
+            portfolio.timeSeries(start_date, Utils.today(), args.engine)
+        Utils.log('Finished timeSeries')
+
 if __name__ == "__main__":
-    Portfolio().timeSeries(datetime.fromisoformat('2021-01-01').date(), Utils.today())
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,167 @@
+from dataclasses import asdict
+from data_context import DataContext
+from datetime import date
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from lot_analysis import LotAnalysis
+from metrics import Metrics
+from portfolio import Portfolio
+from price_alerts import PriceAlerts
+from projection import Projection
+from service_client import ServiceClient
+from utils import Utils
+from typing import Dict, List, Tuple
+import argparse
+import json
+import os
+import time
+import urllib.parse
+import numpy as np
+
+class PortfolioService:
+    # Keeps the portfolio, the price history and the lot tables in memory between queries. Before every
+    # query the data context reloads any input whose files changed, and only what depends on it is rebuilt.
+    QUERIES = ['/timeseries', '/price_history', '/losses', '/accounts', '/active', '/alerts', '/projection', '/harvest']
+
+    def __init__(self) -> None:
+        self.priceHistory = None
+        self.portfolio = None
+        self.lotAnalyses: Dict[str, LotAnalysis] = {}
+        # encoded answers for the current files and day, keyed by query
+        self.results: Dict[Tuple, bytes] = {}
+
+    def refresh(self) -> None:
+        price_history = DataContext.priceHistory()
+        if price_history is not self.priceHistory:
+            Utils.log('Loaded prices')
+            self.priceHistory = price_history
+            if self.portfolio:
+                self.portfolio.priceHistory = price_history
+            self.lotAnalyses = {}
+            self.results = {}
+        if self.portfolio is None or self.portfolio.trades is not DataContext.trades() or self.portfolio.startingPositions is not DataContext.startingPositions():
+            Utils.log('Loading trades and starting positions')
+            self.portfolio = Portfolio(self.priceHistory)
+            self.lotAnalyses = {}
+            self.results = {}
+
+    def lotAnalysis(self, method: str) -> LotAnalysis:
+        if method not in self.lotAnalyses:
+            self.lotAnalyses[method] = LotAnalysis(method, self.portfolio.trades, self.priceHistory)
+        return self.lotAnalyses[method]
+
+    def query(self, path: str, params: Dict[str, List[str]]) -> bytes:
+        self.refresh()
+        key = (path, tuple(sorted((k, tuple(v)) for k, v in params.items())), Utils.today())
+        if key not in self.results:
+            Metrics.count('service.cache_misses')
+            with Metrics.span(f'service{path}'):
+                self.results[key] = json.dumps(self.answer(path, params)).encode()
+        else:
+            Metrics.count('service.cache_hits')
+        return self.results[key]
+
+    def answer(self, path: str, params: Dict[str, List[str]]):
+        param = lambda name, default=None: params[name][0] if name in params else default
+        if path == '/timeseries':
+            end_date = date.fromisoformat(param('end', Utils.today().isoformat()))
+            start_dates = [date.fromisoformat(s) for s in params['start']]
+            results = self.portfolio.timeSeriesPeriods(start_dates, end_date)
+            return {start.isoformat(): {
+                'aggregatePerf': [self.record(r) for r in aggregate_perf],
+                'finalPositions': [asdict(p) for p in final_positions],
+            } for start, (aggregate_perf, final_positions) in results.items()}
+        elif path == '/price_history':
+            return self.priceHistory.priceHistories([param('symbol')], date.fromisoformat(param('start')), date.fromisoformat(param('end')))[:, 0].tolist()
+        elif path == '/losses':
+            table = self.lotAnalysis(param('method', 'fifo')).table
+            # the service outlives the day the table was valued on
+            table.value(Utils.today())
+            at_loss = table.atLoss(float(param('thresh', 0.8)))
+            lots = table.toFrame(at_loss)
+            return {
+                'columns': list(lots.columns),
+                'lots': [self.record(r) for r in lots.to_dict('records')],
+                'lossByAccount': {a: float(loss) for a, loss in table.lossByAccount(at_loss).items()},
+            }
+        elif path == '/harvest':
+            analysis = self.lotAnalysis(param('method', 'fifo'))
+            analysis.table.value(Utils.today())
+            plan = analysis.harvestPlan(float(param('thresh', 0.8)))
+            lots = analysis.harvestFrame(plan)
+            return {
+                'columns': list(lots.columns),
+                'lots': [self.record(r) for r in lots.to_dict('records')],
+                'lossByAccount': {a: float(loss) for a, loss in analysis.table.lossByAccount(plan.sell).items()},
+                'blockedUntil': {symbol: until.isoformat() for symbol, until in plan.blockedUntil.items()},
+            }
+        elif path == '/accounts':
+            return sorted(self.lotAnalysis(param('method', 'fifo')).accountsHoldingSymbol(param('sym')))
+        elif path == '/active':
+            return sorted(self.portfolio.activePositions())
+        elif path == '/alerts':
+            alerts = PriceAlerts(self.portfolio)
+            alerts.gen()
+            return alerts.alerts
+        elif path == '/projection':
+            bands = asdict(Projection(self.portfolio).simulate(
+                int(param('paths', Projection.PATHS)), int(param('horizon', Projection.HORIZON)), int(param('block', Projection.BLOCK)),
+                int(param('workers', 1)), int(param('seed')) if 'seed' in params else None))
+            return {**bands, 'dates': [d.isoformat() for d in bands['dates']]}
+        raise Exception(f'Unknown query {path}')
+
+    def record(self, row) -> Dict:
+        row = row if isinstance(row, dict) else asdict(row)
+        return {k: v.isoformat() if isinstance(v, date) else v.item() if isinstance(v, np.generic) else v for k, v in row.items()}
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    service: PortfolioService
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        start = time.perf_counter()
+        try:
+            if url.path == '/health':
+                (status, data) = (200, json.dumps({'cwd': os.getcwd(), 'pid': os.getpid()}).encode())
+            elif url.path not in PortfolioService.QUERIES:
+                (status, data) = (404, json.dumps({'error': f'Unknown query {url.path}'}).encode())
+            else:
+                (status, data) = (200, self.service.query(url.path, urllib.parse.parse_qs(url.query)))
+        except Exception as e:
+            (status, data) = (500, json.dumps({'error': repr(e)}).encode())
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        Utils.log(f'{url.path} {status} in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve', 'status'])
+    parser.add_argument('-p', '--port', type=int, default=ServiceClient.PORT)
+    Metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    with Metrics.profiling('portfolio_service', args):
+        if args.command == 'status':
+            client = ServiceClient.connect(args.port)
+            print(f'Serving {os.getcwd()}' if client else 'Not running for this folder')
+            return
+
+        service = PortfolioService()
+        service.refresh()
+        ServiceHandler.service = service
+        # one query at a time, so reloads never race with answers
+        server = HTTPServer((ServiceClient.HOST, args.port), ServiceHandler)
+        Utils.log(f'Serving on {ServiceClient.HOST}:{args.port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import csv
+import hashlib
+import io
+import json
+import os
+from bisect import bisect_right
+from datetime import date, timedelta
+from input_cache import InputCache
+from metrics import Metrics
+from starting_positions import Position, StartingPositions
+from trades import Trade, Trades
+from utils import Utils
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+
+class PositionIndex:
+    # Checkpoint of quantity and cost basis per account and symbol at the end of every day the symbol
+    # was traded in the account, and of the symbol's total across accounts on those days. Positions as
+    # of a date are a binary search per account and symbol, or per symbol for the totals, instead of a
+    # replay from the first trade. The checkpoints are saved as columns in an uncompressed .npz.
+    FILE_NAME = 'data/position_index.npz'
+    META_FILE_NAME = 'data/position_index.json'
+    STARTING_DATE = date.min
+    # bumped when the file layout changes, so older indexes are rebuilt
+    VERSION = 3
+
+    # (account, symbol) -> (day ordinals, quantity, cost basis), in order of first appearance
+    checkpoints: Dict[Tuple[str, str], Tuple[List[int], List[float], List[float]]]
+    # symbol -> the same, summed across accounts
+    symbolCheckpoints: Dict[str, Tuple[List[int], List[float], List[float]]]
+    # symbol -> the accounts it has checkpoints in, in order of first appearance
+    symbolAccounts: Dict[str, List[Tuple[str, str]]]
+
+    def __init__(self, starting_positions: StartingPositions, trades: Trades) -> None:
+        self.startingPositions = starting_positions
+        self.trades = trades
+        self.checkpoints = {}
+        self.symbolCheckpoints = {}
+        self.symbolAccounts = {}
+        self.lastDate = self.STARTING_DATE
+
+    def applyTrade(trade: Trade, positions: Dict[str, Position]) -> None:
+        symbol = trade.symbol
+
+        if symbol not in positions:
+            positions[symbol] = Position(symbol)
+
+        quantity = trade.quantity
+        cost_basis = trade.quantity * trade.price
+
+        if trade.action == 'Buy' or trade.action == 'RSU':
+            positions[symbol].quantity += quantity
+            positions[symbol].costBasis += cost_basis
+        elif trade.action == 'Sell':
+            # clamped to what's held, which HoldingsMatrix reports along with the account
+            quantity = min(quantity, positions[symbol].quantity)
+            positions[symbol].quantity -= quantity
+            positions[symbol].costBasis -= cost_basis
+
+    @Metrics.timed('position_index.load')
+    def load(self) -> 'PositionIndex':
+        meta = self.readMeta()
+        starting_hash = self.fileHash(StartingPositions.FILE_NAME)
+        if meta is None or meta.get('version') != self.VERSION or meta['starting_positions'] != starting_hash or not os.path.exists(self.FILE_NAME):
+            return self.rebuild()
+
+        trades_size = os.path.getsize(Trades.FILE_NAME)
+        if trades_size < meta['trades_size'] or self.fileHash(Trades.FILE_NAME, meta['trades_size']) != meta['trades_hash']:
+            Utils.log('Trades have changed, rebuilding position index')
+            return self.rebuild()
+
+        self.read()
+        if trades_size == meta['trades_size']:
+            return self
+
+        # trades.csv only gained new rows, so apply just those
+        new_trades = self.readTradesFrom(meta['trades_size'])
+        if new_trades and min(t.date for t in new_trades) < self.lastDate:
+            Utils.log('Backdated trades, rebuilding position index')
+            return self.rebuild()
+        Utils.log(f'Adding {len(new_trades)} trades to position index')
+        self.addTrades(new_trades)
+        self.write()
+        return self
+
+    def rebuild(self) -> 'PositionIndex':
+        self.checkpoints = {}
+        self.symbolCheckpoints = {}
+        self.symbolAccounts = {}
+        self.lastDate = self.STARTING_DATE
+        for ((account, _), position) in self.startingPositions.accountPositions.items():
+            self.checkpoint(self.STARTING_DATE, account, position)
+        self.addTrades(self.trades.trades)
+        self.write()
+        return self
+
+    def addTrades(self, trades: List[Trade]) -> None:
+        positions = self.accountPositionsAsOf(date.max)
+        for trade in sorted(trades, key=lambda t: t.date):
+            # a sell only takes shares from the account it was made in
+            key = (trade.account, trade.symbol)
+            account_positions = {trade.symbol: positions[key]} if key in positions else {}
+            PositionIndex.applyTrade(trade, account_positions)
+            positions[key] = account_positions[trade.symbol]
+            self.checkpoint(trade.date, trade.account, positions[key])
+            self.lastDate = trade.date
+
+    def checkpoint(self, on: date, account: str, position: Position) -> None:
+        # checkpoints come in order of date, so every account's last checkpoint is its state on the day
+        key = (account, position.symbol)
+        if key not in self.checkpoints:
+            self.checkpoints[key] = ([], [], [])
+            self.symbolAccounts.setdefault(position.symbol, []).append(key)
+        PositionIndex.addCheckpoint(self.checkpoints[key], on, position.quantity, position.costBasis)
+        total = Position(position.symbol)
+        for account_key in self.symbolAccounts[position.symbol]:
+            (_, quantities, cost_bases) = self.checkpoints[account_key]
+            total.quantity += quantities[-1]
+            total.costBasis += cost_bases[-1]
+        if position.symbol not in self.symbolCheckpoints:
+            self.symbolCheckpoints[position.symbol] = ([], [], [])
+        PositionIndex.addCheckpoint(self.symbolCheckpoints[position.symbol], on, total.quantity, total.costBasis)
+
+    def addCheckpoint(series: Tuple[List[int], List[float], List[float]], on: date, quantity: float, cost_basis: float) -> None:
+        (days, quantities, cost_bases) = series
+        # one checkpoint per day, holding the state after the day's last trade
+        if days and days[-1] == on.toordinal():
+            quantities[-1] = quantity
+            cost_bases[-1] = cost_basis
+        else:
+            days.append(on.toordinal())
+            quantities.append(quantity)
+            cost_bases.append(cost_basis)
+
+    def accountPositionsAsOf(self, on: date) -> Dict[Tuple[str, str], Position]:
+        # state at the end of the given day, by (account, symbol)
+        positions = {}
+        day = on.toordinal()
+        for ((account, symbol), (days, quantities, cost_bases)) in self.checkpoints.items():
+            i = bisect_right(days, day) - 1
+            if i >= 0:
+                positions[(account, symbol)] = Position(symbol, quantities[i], cost_bases[i])
+        return positions
+
+    def accountPositionsBefore(self, on: date) -> Dict[Tuple[str, str], Position]:
+        return self.accountPositionsAsOf(on - timedelta(days=1))
+
+    def positionsAsOf(self, on: date) -> Dict[str, Position]:
+        # state at the end of the given day, summed across accounts
+        positions = {}
+        day = on.toordinal()
+        for (symbol, (days, quantities, cost_bases)) in self.symbolCheckpoints.items():
+            i = bisect_right(days, day) - 1
+            if i >= 0:
+                positions[symbol] = Position(symbol, quantities[i], cost_bases[i])
+        return positions
+
+    def positionsBefore(self, on: date) -> Dict[str, Position]:
+        return self.positionsAsOf(on - timedelta(days=1))
+
+    def positionAsOf(self, on: date, symbol: str) -> Position:
+        if symbol not in self.symbolCheckpoints:
+            return Position(symbol)
+        (days, quantities, cost_bases) = self.symbolCheckpoints[symbol]
+        i = bisect_right(days, on.toordinal()) - 1
+        if i < 0:
+            return Position(symbol)
+        return Position(symbol, quantities[i], cost_bases[i])
+
+    def readTradesFrom(self, offset: int) -> List[Trade]:
+        with open(Trades.FILE_NAME) as f:
+            fieldnames = next(csv.reader(f))
+        with open(Trades.FILE_NAME, 'rb') as f:
+            f.seek(offset)
+            lines = f.read().decode().splitlines()
+        return [Trades.parse(row) for row in csv.DictReader(lines, fieldnames=fieldnames) if row['Date']]
+
+    def fileHash(self, filename: str, size: int = -1) -> str:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read(size)).hexdigest()
+
+    def readMeta(self):
+        if not os.path.exists(self.META_FILE_NAME):
+            return None
+        with open(self.META_FILE_NAME) as f:
+            return json.load(f)
+
+    def read(self) -> None:
+        with open(self.FILE_NAME, 'rb') as f:
+            data = np.load(io.BytesIO(f.read()))
+            columns = {name: data[name] for name in data.files}
+        keys = list(zip(InputCache.decode(columns, 'account'), InputCache.decode(columns, 'symbol')))
+        self.checkpoints = dict(zip(keys, PositionIndex.readSeries(columns, 'account_')))
+        self.symbolCheckpoints = dict(zip(InputCache.decode(columns, 'total'), PositionIndex.readSeries(columns, 'total_')))
+        self.symbolAccounts = {}
+        for key in keys:
+            self.symbolAccounts.setdefault(key[1], []).append(key)
+        self.lastDate = date.fromordinal(self.readMeta()['last_date'])
+
+    def readSeries(columns: Dict[str, np.ndarray], prefix: str) -> List[Tuple[List[int], List[float], List[float]]]:
+        # every key's checkpoints are stored one after the other, with the number of them per key
+        bounds = np.concatenate([[0], np.cumsum(columns[f'{prefix}lengths'])]).tolist()
+        (days, quantities, cost_bases) = (columns[f'{prefix}{name}'].tolist() for name in ['days', 'quantities', 'cost_bases'])
+        return [(days[start:end], quantities[start:end], cost_bases[start:end]) for (start, end) in zip(bounds[:-1], bounds[1:])]
+
+    def seriesColumns(series: Iterable[Tuple[List[int], List[float], List[float]]], prefix: str) -> Dict[str, np.ndarray]:
+        series = list(series)
+        return {
+            f'{prefix}lengths': np.array([len(days) for (days, _, _) in series], dtype=np.int64),
+            f'{prefix}days': np.array([day for (days, _, _) in series for day in days], dtype=np.int64),
+            f'{prefix}quantities': np.array([q for (_, quantities, _) in series for q in quantities], dtype=np.float64),
+            f'{prefix}cost_bases': np.array([c for (_, _, cost_bases) in series for c in cost_bases], dtype=np.float64),
+        }
+
+    def write(self) -> None:
+        columns = {
+            **InputCache.encode('account', [account for (account, _) in self.checkpoints]),
+            **InputCache.encode('symbol', [symbol for (_, symbol) in self.checkpoints]),
+            **PositionIndex.seriesColumns(self.checkpoints.values(), 'account_'),
+            **InputCache.encode('total', list(self.symbolCheckpoints)),
+            **PositionIndex.seriesColumns(self.symbolCheckpoints.values(), 'total_'),
+        }
+        tmp = self.FILE_NAME + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(tmp, self.FILE_NAME)
+        with open(self.META_FILE_NAME, 'w') as f:
+            json.dump({
+                'version': self.VERSION,
+                'starting_positions': self.fileHash(StartingPositions.FILE_NAME),
+                'trades_size': os.path.getsize(Trades.FILE_NAME),
+                'trades_hash': self.fileHash(Trades.FILE_NAME),
+                'last_date': self.lastDate.toordinal(),
+            }, f)
+
+if __name__ == "__main__":
+    sp = StartingPositions()
+    sp.load()
+    t = Trades()
+    t.load()
+    index = PositionIndex(sp, t).load()
+    print(index.positionsAsOf(Utils.today()))
@@ -1,75 +1,299 @@
 import argparse
-from datetime import timedelta
-from typing import List, MutableSet
+import csv
+import socket
+from collections import deque
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Callable, Deque, Dict, Iterator, List, MutableSet, Optional, Tuple, TYPE_CHECKING
 from portfolio import FinalPosition, Portfolio
-from price_history import PriceHistory
+from service_client import ServiceClient
 from utils import Utils
-from send_email import EmailSender
 import numpy as np
+from metrics import Metrics
+
+if TYPE_CHECKING:
+    from price_history import PriceHistory
+
+@dataclass
+class AlertRule:
+    # kind is 'cross' (price crossed the moving average), 'move' (day over day change) or
+    # 'extreme' (price at the window's high or low). direction is 'below'/'above' for crossings,
+    # 'high'/'low' for extremes and unused for moves.
+    kind: str
+    direction: str = ''
+    window: int = 0
+    threshold: float = 0
+
+    def evaluate(self, today: np.ndarray, yesterday: np.ndarray, indicator) -> Tuple[np.ndarray, np.ndarray]:
+        # which symbols fire, and the value that goes in the message, for all symbols at once
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.kind == 'cross':
+                mean = indicator('mean', self.window)
+                if self.direction == 'below':
+                    return ((yesterday >= mean) & (mean >= today), mean)
+                return ((yesterday <= mean) & (mean <= today), mean)
+            elif self.kind == 'move':
+                diff = (today - yesterday) / yesterday
+                return (np.abs(diff) > self.threshold, diff)
+            elif self.kind == 'extreme':
+                if self.direction == 'high':
+                    return (today >= indicator('max', self.window), today)
+                return (today <= indicator('min', self.window), today)
+        raise Exception(f'Unknown alert kind {self.kind}')
+
+    def message(self, symbol: str, value: float) -> str:
+        if self.kind == 'cross':
+            verb = 'dipped under' if self.direction == 'below' else 'went above'
+            return f'{symbol} {verb} {self.window}da {Utils.currency(value)}'
+        elif self.kind == 'move':
+            return f'{symbol} moved by {Utils.percent(value)}'
+        return f'{symbol} at {self.window} day {self.direction} {Utils.currency(value)}'
 
 class PriceAlerts:
-    priceHistory: PriceHistory
+    priceHistory: 'PriceHistory'
     activePositions: MutableSet[str]
     alerts: List[str]
 
-    def __init__(self) -> None:
-        portfolio = Portfolio()
+    RULES = [
+        AlertRule('cross', 'below', 50),
+        AlertRule('cross', 'above', 50),
+        AlertRule('cross', 'below', 200),
+        AlertRule('cross', 'above', 200),
+        AlertRule('move', threshold=0.05),
+        AlertRule('extreme', 'high', 50),
+        AlertRule('extreme', 'low', 50),
+    ]
+
+    def __init__(self, portfolio: Portfolio = None) -> None:
+        if portfolio is None:
+            portfolio = Portfolio()
         self.priceHistory = portfolio.priceHistory
         self.positions = portfolio.activePositions()
         self.alerts = []
-        
+
     def gen(self):
         today = Utils.today()
         yesterday = today - timedelta(days=1)
-        for symbol in self.priceHistory.prices:
-            if symbol not in self.positions:
-                continue
-            today_price = self.priceHistory.price(today, symbol)
-            yesterday_price = self.priceHistory.price(yesterday, symbol)
-            mean_50 = self.priceHistory.movingAverage(symbol, 50)
-            mean_200 = self.priceHistory.movingAverage(symbol, 200)
-
-            if yesterday_price >= mean_50 and mean_50 >= today_price:
-                self.alerts.append(f'{symbol} dipped under 50da {Utils.currency(mean_50)}')
-            if yesterday_price <= mean_50 and mean_50 <= today_price:
-                self.alerts.append(f'{symbol} went above 50da {Utils.currency(mean_50)}')
-
-            if yesterday_price >= mean_200 and mean_200 >= today_price:
-                self.alerts.append(f'{symbol} dipped under 200da {Utils.currency(mean_200)}')
-            if yesterday_price <= mean_200 and mean_200 <= today_price:
-                self.alerts.append(f'{symbol} went above 200da {Utils.currency(mean_200)}')
+        symbols = [symbol for symbol in self.priceHistory.symbolIndex if symbol in self.positions]
+        columns = np.array([self.priceHistory.symbolIndex[symbol] for symbol in symbols], dtype=np.int64)
+        (yesterday_prices, today_prices) = self.priceHistory.priceMatrix([yesterday, today], symbols)
+        indicator = lambda stat, window: self.priceHistory.indicators.latestValues(stat, window)[columns]
 
-            diff = (today_price - yesterday_price) / yesterday_price
-            if abs(diff) > 0.05:
-                self.alerts.append(f'{symbol} moved by {Utils.percent(diff)}')
+        # rules x symbols, each rule evaluated across every symbol in one go
+        results = [rule.evaluate(today_prices, yesterday_prices, indicator) for rule in self.RULES]
+        fired = np.array([mask for (mask, _) in results]).reshape(len(self.RULES), len(symbols))
 
-            if today_price >= self.priceHistory.max(symbol, 50):
-                self.alerts.append(f'{symbol} at 50 day high {Utils.currency(today_price)}')
-
-            if today_price <= self.priceHistory.min(symbol, 50):
-                self.alerts.append(f'{symbol} at 50 day low {Utils.currency(today_price)}')
+        # alerts are listed symbol by symbol, in rule order
+        for (symbol_index, rule_index) in np.argwhere(fired.T):
+            value = results[rule_index][1][symbol_index]
+            self.alerts.append(self.RULES[rule_index].message(symbols[symbol_index], value))
 
     def render(self) -> str:
         self.gen()
-        alerts_str = '\n'.join([f'* {alert}' for alert in self.alerts])
+        return PriceAlerts.markdown(self.alerts)
+
+    def markdown(alerts: List[str]) -> str:
+        alerts_str = '\n'.join([f'* {alert}' for alert in alerts])
         return f'''
 # Stock alerts
 {alerts_str}
             '''
 
+@dataclass
+class PriceEvent:
+    time: datetime
+    symbol: str
+    price: float
+
+class PriceEvents:
+    # Sources of price events, one per line as time,symbol,price with an ISO time or date.
+    # A recorded file may start with a Time,Symbol,Price header.
+    def parse(lines: Iterator[str]) -> Iterator[PriceEvent]:
+        for row in csv.reader(lines):
+            if not row or row[0] == 'Time':
+                continue
+            yield PriceEvent(datetime.fromisoformat(row[0]), row[1], float(row[2]))
+
+    def replay(file_name: str) -> Iterator[PriceEvent]:
+        with open(file_name, newline='') as f:
+            yield from PriceEvents.parse(f)
+
+    def feed(address: str) -> Iterator[PriceEvent]:
+        # a local feed that writes events to whoever connects, until it closes the connection
+        (host, port) = address.rsplit(':', 1)
+        with socket.create_connection((host, int(port))) as conn:
+            with conn.makefile('r', newline='') as f:
+                yield from PriceEvents.parse(f)
+
+class RollingWindow:
+    # Closes of one symbol over the last `size` trading rows, with the current row's latest price kept
+    # apart until the row closes. The sum is kept running, and the highs and lows in monotonic deques
+    # with the oldest at the front, so each price and each lookup is O(1) amortized.
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.closes: Deque[Tuple[int, float]] = deque()
+        self.total = 0.0
+        self.highs: Deque[Tuple[int, float]] = deque()
+        self.lows: Deque[Tuple[int, float]] = deque()
+
+    def add(self, row: int, price: float) -> None:
+        self.closes.append((row, price))
+        self.total += price
+        while self.highs and self.highs[-1][1] <= price:
+            self.highs.pop()
+        self.highs.append((row, price))
+        while self.lows and self.lows[-1][1] >= price:
+            self.lows.pop()
+        self.lows.append((row, price))
+
+    def expire(self, row: int) -> None:
+        # drop closes that are out of the window ending at row
+        oldest = row - self.size
+        while self.closes and self.closes[0][0] <= oldest:
+            self.total -= self.closes.popleft()[1]
+        while self.highs and self.highs[0][0] <= oldest:
+            self.highs.popleft()
+        while self.lows and self.lows[0][0] <= oldest:
+            self.lows.popleft()
+
+    def value(self, stat: str, current: float) -> float:
+        # the stat over the closes in the window and the current price
+        if stat == 'mean':
+            return (self.total + current) / (len(self.closes) + 1)
+        elif stat == 'max':
+            return max(self.highs[0][1], current) if self.highs else current
+        return min(self.lows[0][1], current) if self.lows else current
+
+class StreamingAlerts:
+    # PriceAlerts.RULES evaluated on every price event, for the symbol it's about. Each row of
+    # price history is a day, and the last price seen for a symbol on a day is its close once a
+    # later day's event arrives. Windows start from the stored prices before the first event's day,
+    # and each rule fires at most once per symbol and day. Rules over a window wait until it holds a
+    # close from an earlier row.
+    def __init__(self, portfolio: Portfolio = None, on_alert: Callable[[str], None] = print) -> None:
+        if portfolio is None:
+            portfolio = Portfolio()
+        self.priceHistory = portfolio.priceHistory
+        self.positions = portfolio.activePositions()
+        self.onAlert = on_alert
+        self.rules = PriceAlerts.RULES
+        self.sizes = sorted({rule.window for rule in self.rules if rule.window})
+        self.day: Optional[date] = None
+        self.row = 0
+        self.windows: Dict[str, Dict[int, RollingWindow]] = {}
+        # symbol -> last close, and the latest price of the current row
+        self.closes: Dict[str, float] = {}
+        self.current: Dict[str, float] = {}
+        self.fired: MutableSet[Tuple[str, int]] = set()
+        self.alerts: List[str] = []
+
+    @Metrics.timed('alerts.seed')
+    def seed(self, day: date) -> None:
+        # windows of the stored rows before day, which become rows 0 to row - 1
+        rows = int(np.searchsorted(self.priceHistory.rowDays, day.toordinal()))
+        start = max(rows - (self.sizes[-1] if self.sizes else 1), 0)
+        self.row = rows - start
+        for symbol in self.positions:
+            column = self.priceHistory.symbolIndex.get(symbol)
+            self.windows[symbol] = {size: RollingWindow(size) for size in self.sizes}
+            if column is None:
+                continue
+            prices = self.priceHistory.values[start:rows, column]
+            for (row, price) in enumerate(prices.tolist()):
+                if price == price:
+                    for window in self.windows[symbol].values():
+                        window.add(row, price)
+                    self.closes[symbol] = price
+
+    def close(self) -> None:
+        # the current row's prices become closes, and the next day starts a new row
+        for (symbol, price) in self.current.items():
+            for window in self.windows[symbol].values():
+                window.add(self.row, price)
+            self.closes[symbol] = price
+        self.current = {}
+        self.fired = set()
+        self.row += 1
+
+    @Metrics.timed('alerts.event')
+    def process(self, event: PriceEvent) -> List[str]:
+        day = event.time.date()
+        if self.day is None:
+            self.seed(day)
+        elif day > self.day:
+            self.close()
+        elif day < self.day:
+            Metrics.count('alerts.late_events')
+            return []
+        self.day = day
+        Metrics.count('alerts.events')
+        if event.symbol not in self.windows:
+            return []
+
+        self.current[event.symbol] = event.price
+        windows = self.windows[event.symbol]
+        for window in windows.values():
+            window.expire(self.row)
+        today = np.array([event.price])
+        yesterday = np.array([self.closes.get(event.symbol, np.nan)])
+        indicator = lambda stat, size: np.array([windows[size].value(stat, event.price)])
+
+        alerts = []
+        for (rule_index, rule) in enumerate(self.rules):
+            if (event.symbol, rule_index) in self.fired:
+                continue
+            if rule.window and not windows[rule.window].closes:
+                # without an earlier close, the price would be its own high, low and average
+                continue
+            (mask, value) = rule.evaluate(today, yesterday, indicator)
+            if mask[0]:
+                self.fired.add((event.symbol, rule_index))
+                alerts.append(rule.message(event.symbol, value[0]))
+        for alert in alerts:
+            Metrics.count('alerts.fired')
+            self.alerts.append(alert)
+            self.onAlert(alert)
+        return alerts
+
+    def run(self, events: Iterator[PriceEvent]) -> List[str]:
+        for event in events:
+            self.process(event)
+        return self.alerts
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--dest', choices=['console', 'email'], default='console')
+    parser.add_argument('--local', action='store_true', help="don't use a running portfolio_service.py")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--replay', metavar='FILE', help='alert on each price event in a recorded time,symbol,price file')
+    source.add_argument('--feed', metavar='HOST:PORT', help='alert on each price event from a local socket feed, as it arrives')
+    Metrics.addArguments(parser)
     args = parser.parse_args()
-    dest = args.dest
 
-    alerts = PriceAlerts()
-    alerts_markdown = alerts.render()
+    with Metrics.profiling('price_alerts', args):
+        dest = args.dest
+
+        if args.replay or args.feed:
+            events = PriceEvents.replay(args.replay) if args.replay else PriceEvents.feed(args.feed)
+            if dest == 'console':
+                on_alert = lambda alert: print(f'* {alert}', flush=True)
+            else:
+                from send_email import EmailSender
+                on_alert = lambda alert: EmailSender.sendMarkdown(f'Stock alert: {alert}', PriceAlerts.markdown([alert]), [])
+            StreamingAlerts(on_alert=on_alert).run(events)
+            return
+
+        client = None if args.local else ServiceClient.connect()
+        if client:
+            alerts_markdown = PriceAlerts.markdown(client.get('/alerts'))
+        else:
+            alerts_markdown = PriceAlerts().render()
 
-    if dest == 'console':
-        print(alerts_markdown)
-    else:
-        EmailSender.sendMarkdown('Stock alerts', alerts_markdown, [])
+        if dest == 'console':
+            print(alerts_markdown)
+        else:
+            from send_email import EmailSender
+            EmailSender.sendMarkdown('Stock alerts', alerts_markdown, [])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,23 +1,85 @@
+from data_context import DataContext
 from datetime import date, datetime, timedelta
 from fetch_price_history import PriceHistoryFetcher
+from indicator_cache import IndicatorCache
+from metrics import Metrics
 from starting_positions import Position
-from watchlist import Watchlist
+from typing import List, Tuple
 import numpy as np
 
 class PriceHistory:
+    # price() looks back this many days for the last trading day before giving up
+    MAX_STALE_DAYS = 6
+
     def __init__(self) -> None:
-        phf = PriceHistoryFetcher(Watchlist.load())
-        self.prices = phf.fetch_stored()
+        # the stored prices are read whole, so this doesn't need the watchlist, or trades to build it from
+        phf = PriceHistoryFetcher([])
+        (values, row_days, symbols) = phf.fetch_stored_arrays()
+        # the files the prices were read from, taken after reading as it may convert prices.csv
+        self.version = DataContext.version(DataContext.priceFiles())
+        if not np.all(np.diff(row_days) >= 0):
+            # only rows just read from prices.csv can be out of order. The store's are sorted by day,
+            # and reordering them would copy the whole memory-mapped matrix.
+            order = np.argsort(row_days, kind='stable')
+            (values, row_days) = (values[order], row_days[order])
+        self.buildAsOfIndex(values, row_days, symbols)
+
+    def fromArrays(values: np.ndarray, row_days: np.ndarray, symbols: List[str], version: Tuple) -> 'PriceHistory':
+        # prices loaded by another process, e.g. in shared memory by batch_runner.py, with rows sorted by day
+        price_history = PriceHistory.__new__(PriceHistory)
+        price_history.version = version
+        price_history.buildAsOfIndex(values, row_days, symbols)
+        return price_history
+
+    @Metrics.timed('prices.index')
+    def buildAsOfIndex(self, values: np.ndarray, row_days: np.ndarray, symbols: List[str]) -> None:
+        # dense day -> row table, forward filled across non trading days up to the staleness limit,
+        # so as-of lookups are an array index instead of a walk back through the calendar
+        self.values = values
+        self.symbolIndex = {symbol: i for i, symbol in enumerate(symbols)}
+        self.rowDays = row_days
+
+        self.firstDay = int(row_days[0]) if len(row_days) else 0
+        num_days = int(row_days[-1]) - self.firstDay + self.MAX_STALE_DAYS if len(row_days) else 0
+        days = self.firstDay + np.arange(num_days)
+        rows = np.searchsorted(row_days, days, side='right') - 1
+        stale = days - row_days[np.maximum(rows, 0)] >= self.MAX_STALE_DAYS
+        self.rowByDay = np.where(stale, -1, rows)
+        self.indicators = IndicatorCache(self.values, row_days, self.version)
+
+    def rowsAsOf(self, days: np.ndarray, num_symbols: int = 1) -> np.ndarray:
+        offsets = days - self.firstDay
+        in_range = (offsets >= 0) & (offsets < len(self.rowByDay))
+        rows = np.where(in_range, self.rowByDay[np.clip(offsets, 0, max(len(self.rowByDay) - 1, 0))], -1)
+        # counted per price, for the num_symbols looked up on each day
+        found = rows >= 0
+        Metrics.count('price_lookups', len(days) * num_symbols)
+        Metrics.count('price_misses', (len(days) - int(np.count_nonzero(found))) * num_symbols)
+        # days without a price of their own, answered with an earlier day's
+        Metrics.count('asof_walkbacks', int(np.count_nonzero(self.rowDays[rows[found]] != days[found])) * num_symbols)
+        return rows
 
     def price(self, date: date, symbol):
-        retries = 0
-        while date not in self.prices.index:
-            date = date - timedelta(days=1)
-            retries += 1
-            if retries == 6:
-                print(f"Don't have data for {symbol} in the last 6 days from {date}")
-                return 0
-        return self.prices.loc[date, symbol]
+        offset = date.toordinal() - self.firstDay
+        row = self.rowByDay[offset] if 0 <= offset < len(self.rowByDay) else -1
+        Metrics.count('price_lookups')
+        if row < 0:
+            Metrics.count('price_misses')
+            print(f"Don't have data for {symbol} in the last 6 days from {date - timedelta(days=self.MAX_STALE_DAYS)}")
+            return 0
+        if self.rowDays[row] != offset + self.firstDay:
+            Metrics.count('asof_walkbacks')
+        return self.values[row, self.symbolIndex[symbol]]
+
+    @Metrics.timed('prices.lookup')
+    def priceMatrix(self, dates: List[date], symbols: List[str]) -> np.ndarray:
+        # batched price(): a dates x symbols array, 0 where there's no recent data or no such symbol
+        rows = self.rowsAsOf(np.array([d.toordinal() for d in dates], dtype=np.int64), len(symbols))
+        columns = np.array([self.symbolIndex.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        matrix = self.values[np.maximum(rows, 0)[:, None], np.maximum(columns, 0)[None, :]]
+        matrix[rows < 0, :] = 0
+        matrix[:, columns < 0] = 0
+        return matrix
 
     def positionValue(self, date: date, position: Position):
         if position.quantity == 0:
@@ -28,27 +90,27 @@ class PriceHistory:
         return position.quantity * price
 
     def priceHistory(self, symbol: str, start_date: date, end_date: date):
-        df = self.prices.loc[start_date:end_date, symbol]
-        last_value = df[-1]
-        date = df.index[-1]
-        while date < end_date:
-            date += timedelta(days=1)
-            df[date] = last_value
-        return df.values.tolist()
-
-    def adjustWindow(self, window: int) -> int:
-        # since we fill in days with no values, which is mainly weekends. not perfect but ok for the job
-        return int((7 * window)/5)
+        # one as-of price per calendar day, NaN where there's no recent data
+        return self.priceHistories([symbol], start_date, end_date)[:, 0].tolist()
+
+    def priceHistories(self, symbols: List[str], start_date: date, end_date: date) -> np.ndarray:
+        # calendar days x symbols as-of prices, NaN where there's no recent data or no such symbol
+        days = np.arange(start_date.toordinal(), end_date.toordinal() + 1)
+        rows = self.rowsAsOf(days, len(symbols))
+        columns = np.array([self.symbolIndex.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        matrix = self.values[np.maximum(rows, 0)[:, None], np.maximum(columns, 0)[None, :]]
+        matrix[rows < 0, :] = np.nan
+        matrix[:, columns < 0] = np.nan
+        return matrix
 
     def movingAverage(self, symbol: str, window: int) -> float:
-        return np.mean(self.prices.tail(self.adjustWindow(window))[symbol])
+        return self.indicators.latestValues('mean', window)[self.symbolIndex[symbol]]
 
     def max(self, symbol: str, window: int) -> float:
-        return np.max(self.prices.tail(self.adjustWindow(window))[symbol])
+        return self.indicators.latestValues('max', window)[self.symbolIndex[symbol]]
 
     def min(self, symbol: str, window: int) -> float:
-        return np.min(self.prices.tail(self.adjustWindow(window))[symbol])
-
+        return self.indicators.latestValues('min', window)[self.symbolIndex[symbol]]
 
 
 if __name__ == "__main__":
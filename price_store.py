@@ -0,0 +1,218 @@
+import argparse
+import fcntl
+import json
+import os
+import subprocess
+import sys
+from contextlib import contextmanager
+from datetime import date
+from pandas.core.frame import DataFrame
+from typing import List, Tuple
+from metrics import Metrics
+from utils import Utils
+import numpy as np
+import pandas as pd
+
+class PriceStore:
+    # Binary columnar copy of the price history: a float64 dates x symbols matrix, an int32 axis of
+    # day ordinals and a symbol table. The matrix is memory-mapped, so opening it doesn't parse anything.
+    #
+    # Daily updates don't rewrite the matrix. They are appended to monthly partitions of
+    # (Date, Symbol, Close) rows, and compaction later folds the partitions into the matrix.
+    # Reads see the union of both.
+    DIR_NAME = 'data/prices'
+    CSV_FILE_NAME = 'data/prices.csv'
+    VALUES = 'values.npy'
+    DAYS = 'days.npy'
+    SYMBOLS = 'symbols.json'
+    PARTITIONS = 'partitions'
+    LOCK = '.lock'
+
+    def __init__(self, dir_name: str = DIR_NAME) -> None:
+        self.dirName = dir_name
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.dirName, name)
+
+    def exists(self) -> bool:
+        return all(os.path.exists(self.path(name)) for name in [self.VALUES, self.DAYS, self.SYMBOLS])
+
+    def mtime(self) -> float:
+        return os.path.getmtime(self.path(self.SYMBOLS)) if self.exists() else 0
+
+    def isStale(self, csv_file_name: str = CSV_FILE_NAME) -> bool:
+        if not self.exists():
+            return True
+        return os.path.exists(csv_file_name) and os.path.getmtime(csv_file_name) > self.mtime()
+
+    @contextmanager
+    def locked(self, exclusive: bool):
+        # readers share the lock, appends and compaction take it exclusively
+        os.makedirs(self.dirName, exist_ok=True)
+        with open(self.path(self.LOCK), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def write(self, data: DataFrame) -> None:
+        # full rewrite of the matrix, which replaces anything in the partitions
+        with self.locked(exclusive=True):
+            self.writeMatrix(data)
+            self.removePartitions(self.partitions())
+
+    def writeMatrix(self, data: DataFrame) -> None:
+        data = data.sort_index()
+        days = np.array([d.toordinal() for d in data.index], dtype=np.int32)
+        values = np.ascontiguousarray(data.to_numpy(dtype=np.float64))
+        # the symbol table is written last, so a reader never sees it ahead of the matrix it describes
+        self.replace(self.VALUES, lambda f: np.save(f, values))
+        self.replace(self.DAYS, lambda f: np.save(f, days))
+        self.replace(self.SYMBOLS, lambda f: f.write(json.dumps(list(data.columns)).encode()))
+
+    def replace(self, name: str, write) -> None:
+        tmp = self.path(name + '.tmp')
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, self.path(name))
+
+    def days(self) -> np.ndarray:
+        return np.load(self.path(self.DAYS))
+
+    def symbols(self) -> List[str]:
+        with open(self.path(self.SYMBOLS)) as f:
+            return json.load(f)
+
+    def values(self) -> np.ndarray:
+        # copy-on-write mapping: pages are read lazily and writes never reach the file
+        return np.load(self.path(self.VALUES), mmap_mode='c')
+
+    @Metrics.timed('prices.read')
+    def read(self) -> DataFrame:
+        with self.locked(exclusive=False):
+            data = self.readMatrix()
+            partitions = self.partitions()
+            if not partitions:
+                return data
+            return self.union(data, self.readPartitions(partitions))
+
+    @Metrics.timed('prices.read')
+    def readArrays(self) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        # read() as the matrix, its day ordinals and its symbols. Without partitions to fold in, the
+        # matrix stays memory-mapped and no DataFrame is built.
+        with self.locked(exclusive=False):
+            partitions = self.partitions()
+            if not partitions:
+                return (self.values(), self.days().astype(np.int64), self.symbols())
+            return PriceStore.toArrays(self.union(self.readMatrix(), self.readPartitions(partitions)))
+
+    def toArrays(data: DataFrame) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        days = np.array([d.toordinal() for d in data.index], dtype=np.int64)
+        return (data.to_numpy(dtype=np.float64), days, list(data.columns))
+
+    def readMatrix(self) -> DataFrame:
+        data = pd.DataFrame(self.values(), columns=self.symbols(), copy=False)
+        data.index = [date.fromordinal(int(d)) for d in self.days()]
+        data.index.name = "Date"
+        return data
+
+    def partitions(self) -> List[str]:
+        directory = self.path(self.PARTITIONS)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.csv'))
+
+    @Metrics.timed('prices.append')
+    def append(self, data: DataFrame) -> int:
+        # appends the non-missing prices as (Date, Symbol, Close) rows to each month's partition
+        # stack() keeps missing values in pandas 3, so they're dropped explicitly
+        rows = data.rename_axis(index='Date', columns='Symbol').stack().dropna().rename('Close').reset_index()
+        if rows.empty:
+            return 0
+        rows['Date'] = pd.to_datetime(rows['Date'])
+        with self.locked(exclusive=True):
+            os.makedirs(self.path(self.PARTITIONS), exist_ok=True)
+            for month, month_rows in rows.groupby(rows['Date'].dt.strftime('%Y-%m')):
+                file_name = os.path.join(self.path(self.PARTITIONS), f'{month}.csv')
+                month_rows.to_csv(file_name, mode='a', header=not os.path.exists(file_name), index=False, date_format='%Y-%m-%d')
+        Metrics.count('rows_written', rows.shape[0])
+        return rows.shape[0]
+
+    def readPartitions(self, partitions: List[str]) -> DataFrame:
+        rows = pd.concat([pd.read_csv(p) for p in partitions])
+        # empty rows appended before missing prices were dropped mustn't replace real ones
+        rows = rows.dropna(subset=['Close'])
+        # a later row for the same day and symbol is a revision
+        rows = rows.drop_duplicates(['Date', 'Symbol'], keep='last')
+        data = rows.pivot(index='Date', columns='Symbol', values='Close')
+        data.index = pd.to_datetime(data.index).date
+        data.columns.name = None
+        return data
+
+    def union(self, data: DataFrame, appended: DataFrame) -> DataFrame:
+        # the matrix is already filled in, so when only new days were appended, just those need filling
+        if len(data.index) and min(appended.index) > data.index[-1] and set(appended.columns) <= set(data.columns):
+            tail = pd.concat([data.iloc[[-1]], appended.reindex(columns=data.columns)]).ffill().iloc[1:]
+            union = pd.concat([data, tail])
+        else:
+            columns = list(data.columns) + [c for c in appended.columns if c not in data.columns]
+            union = appended.combine_first(data).sort_index().ffill().bfill()[columns]
+        union.index.name = "Date"
+        return union
+
+    def removePartitions(self, partitions: List[str]) -> None:
+        for p in partitions:
+            os.remove(p)
+
+    @Metrics.timed('prices.compact')
+    def compact(self) -> None:
+        # folds the partitions into the matrix, after which reads are zero-copy again
+        with self.locked(exclusive=True):
+            partitions = self.partitions()
+            if not partitions:
+                return
+            Utils.log(f'Compacting {len(partitions)} partitions')
+            self.writeMatrix(self.union(self.readMatrix(), self.readPartitions(partitions)))
+            self.removePartitions(partitions)
+
+    def compactInBackground(self) -> None:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'compact'],
+            cwd=os.getcwd(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+
+    @Metrics.timed('prices.from_csv')
+    def fromCSV(self, csv_file_name: str = CSV_FILE_NAME) -> DataFrame:
+        data = pd.read_csv(csv_file_name, index_col='Date')
+        data.index = pd.to_datetime(data.index)
+        data.index = [d.date() for d in data.index]
+        data.index.name = "Date"
+        self.write(data)
+        return data
+
+    def toCSV(self, csv_file_name: str = CSV_FILE_NAME) -> None:
+        self.read().to_csv(csv_file_name)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['to-binary', 'to-csv', 'compact'])
+    Metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    with Metrics.profiling('price_store', args):
+        store = PriceStore()
+        Utils.log(f'Started {args.command}')
+        if args.command == 'to-binary':
+            store.fromCSV()
+        elif args.command == 'to-csv':
+            store.toCSV()
+        else:
+            store.compact()
+        Utils.log(f'Finished {args.command}')
+
+if __name__ == "__main__":
+    main()
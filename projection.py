@@ -0,0 +1,155 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date
+from metrics import Metrics
+from utils import Utils
+from typing import List, Tuple, TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    from portfolio import Portfolio
+
+@dataclass
+class ProjectionBands:
+    # percentile x day arrays over the simulated paths, day 0 being today
+    startValue: float
+    dates: List[date]
+    percentiles: List[int]
+    value: List[List[float]]
+    drawdown: List[List[float]]
+    # percentiles of each path's largest drawdown
+    maxDrawdown: List[float]
+    paths: int
+
+class Projection:
+    # Simulated values of today's holdings over the coming trading days, if they are held without
+    # trading. Each path replays days of returns drawn at random from the stored price history, whole
+    # rows at a time so symbols keep moving together, in blocks of consecutive days to keep some of
+    # the autocorrelation. Holdings without prices keep their cost basis.
+    HISTORY_ROWS = 756
+    HORIZON = 252
+    PATHS = 10000
+    BLOCK = 5
+    PERCENTILES = [5, 25, 50, 75, 95]
+    # paths x symbols growth factors simulated at once
+    BATCH_ELEMENTS = 1 << 20
+    CHECKPOINTS = {'1 month': 21, '3 months': 63, '6 months': 126, '1 year': 252}
+
+    def __init__(self, portfolio: 'Portfolio') -> None:
+        self.portfolio = portfolio
+
+    def holdings(self, today: date) -> Tuple[np.ndarray, np.ndarray, float]:
+        # log returns of the last HISTORY_ROWS price rows x held symbols, the value held in each, and
+        # the value of holdings without a price
+        price_history = self.portfolio.priceHistory
+        positions = [p for p in self.portfolio.positionIndex.positionsAsOf(today).values() if p.quantity != 0]
+        prices = price_history.priceMatrix([today], [p.symbol for p in positions])[0]
+        priced = prices > 0
+        unpriced_value = sum(p.costBasis for (p, has_price) in zip(positions, priced) if not has_price)
+        positions = [p for (p, has_price) in zip(positions, priced) if has_price]
+        values = np.array([p.quantity for p in positions]) * prices[priced]
+
+        columns = [price_history.symbolIndex[p.symbol] for p in positions]
+        history = price_history.values[-(self.HISTORY_ROWS + 1):, columns]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_returns = np.log(history[1:] / history[:-1])
+        # a day without a price, or the day after it, counts as unchanged
+        log_returns[~np.isfinite(log_returns)] = 0
+        return (log_returns, values, unpriced_value)
+
+    def paths(growth: np.ndarray, values: np.ndarray, rng: np.random.Generator, num_paths: int, horizon: int, block: int) -> np.ndarray:
+        # paths x horizon values of the priced holdings after each simulated day, from rows x symbols
+        # daily growth factors. Stepping a day at a time over paths x symbols keeps the working set
+        # small, where a paths x days x symbols cumulative product wouldn't fit in cache.
+        num_rows = len(growth)
+        block = max(min(block, num_rows), 1)
+        starts = rng.integers(0, num_rows - block + 1, size=(num_paths, -(-horizon // block)))
+        rows = (starts[:, :, None] + np.arange(block)).reshape(num_paths, -1)[:, :horizon]
+        held = np.ones((num_paths, growth.shape[1]), dtype=growth.dtype)
+        simulated = np.empty((num_paths, horizon))
+        for day in range(horizon):
+            held *= growth[rows[:, day]]
+            simulated[:, day] = held @ values
+        return simulated
+
+    @Metrics.timed('projection.simulate')
+    def simulate(self, num_paths: int = PATHS, horizon: int = HORIZON, block: int = BLOCK, workers: int = 1, seed: int = None) -> ProjectionBands:
+        today = Utils.today()
+        (log_returns, values, unpriced_value) = self.holdings(today)
+        start_value = float(values.sum() + unpriced_value)
+        if len(log_returns) == 0:
+            # no history to draw from, so nothing moves
+            log_returns = np.zeros((1, len(values)))
+        # single precision is plenty for a year of daily factors, and halves the memory traffic
+        growth = np.exp(log_returns).astype(np.float32)
+        values = values.astype(np.float32)
+
+        # batches are seeded from one sequence, so a seed gives the same paths with any number of workers
+        batch_paths = max(self.BATCH_ELEMENTS // max(len(values), 1), 1)
+        sizes = [min(batch_paths, num_paths - start) for start in range(0, num_paths, batch_paths)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        if workers <= 1 or len(sizes) <= 1:
+            initWorker(growth, values, horizon, block)
+            batches = list(map(simulateInWorker, seeds, sizes))
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(sizes)), initializer=initWorker, initargs=(growth, values, horizon, block)) as pool:
+                batches = list(pool.map(simulateInWorker, seeds, sizes))
+        Metrics.count('projection.paths', num_paths)
+
+        simulated = np.concatenate(batches) + unpriced_value
+        simulated = np.concatenate([np.full((num_paths, 1), start_value), simulated], axis=1)
+        drawdown = simulated / np.maximum.accumulate(simulated, axis=1) - 1
+        trading_days = np.busday_offset(np.datetime64(today, 'D'), np.arange(horizon + 1), roll='forward')
+        return ProjectionBands(
+            start_value,
+            [d.item() for d in trading_days],
+            self.PERCENTILES,
+            np.percentile(simulated, self.PERCENTILES, axis=0).tolist(),
+            np.percentile(drawdown, self.PERCENTILES, axis=0).tolist(),
+            np.percentile(drawdown.min(axis=1), self.PERCENTILES).tolist(),
+            num_paths,
+        )
+
+    def markdown(bands: ProjectionBands) -> str:
+        horizon = len(bands.dates) - 1
+        checkpoints = {name: day for (name, day) in Projection.CHECKPOINTS.items() if day < horizon}
+        checkpoints[f'{horizon} trading days'] = horizon
+        header = ' | '.join(f'{p}%' for p in bands.percentiles)
+        rows = '\n'.join(f'| {name} | ' + ' | '.join(Utils.currency(band[day]) for band in bands.value) + ' |' for (name, day) in checkpoints.items())
+        return f"""
+## Projection from {Utils.currency(bands.startValue)} over {bands.paths} paths
+| Horizon | {header} |
+| --- | {' | '.join('---' for _ in bands.percentiles)} |
+{rows}
+| Largest drawdown | {' | '.join(Utils.percent(d) for d in bands.maxDrawdown)} |
+        """
+
+# the returns and holdings, set once in each worker process instead of sent with every batch
+workerState = None
+
+def initWorker(growth: np.ndarray, values: np.ndarray, horizon: int, block: int) -> None:
+    global workerState
+    workerState = (growth, values, horizon, block)
+
+def simulateInWorker(seed: np.random.SeedSequence, num_paths: int) -> np.ndarray:
+    (growth, values, horizon, block) = workerState
+    return Projection.paths(growth, values, np.random.default_rng(seed), num_paths, horizon, block)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--paths', type=int, default=Projection.PATHS)
+    parser.add_argument('--horizon', type=int, default=Projection.HORIZON, help='trading days to simulate')
+    parser.add_argument('--block', type=int, default=Projection.BLOCK, help='consecutive days of history drawn at a time, 1 to draw single days')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='processes to simulate batches of paths with')
+    parser.add_argument('--seed', type=int, default=None)
+    Metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    with Metrics.profiling('projection', args):
+        from portfolio import Portfolio
+        bands = Projection(Portfolio()).simulate(args.paths, args.horizon, args.block, args.workers, args.seed)
+        print(Projection.markdown(bands))
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
 from datetime import datetime, timedelta, date
 from posixpath import join
 from utils import Utils
+from chart_renderer import ChartData, ChartRenderer
+from metrics import Metrics
 from portfolio import AggregatePerfRow, FinalPosition, Portfolio
-from typing import Final, List, Dict
-from matplotlib import pyplot as plt
-from matplotlib import ticker as tick
+from typing import Final, List, Dict, Tuple
 import argparse
 import numpy as np
-from send_email import EmailSender
+from service_client import ServiceClient
 from dataclasses import asdict
+from data_context import DataContext
+from projection import Projection, ProjectionBands
+from returns import Returns
 
 class FinalSummary:
     absoluteWinners: List[FinalPosition]
@@ -20,9 +23,11 @@ class FinalSummary:
     startDate: date
     endDate: date
     finalPerf: AggregatePerfRow
+    benchmarkReturns: Dict[str, float]
 
-    def __init__(self, final_positions: List[FinalPosition], aggregate_perf: List[AggregatePerfRow], start_date: date, end_date: date) -> None:
+    def __init__(self, final_positions: List[FinalPosition], aggregate_perf: List[AggregatePerfRow], start_date: date, end_date: date, benchmark_returns: Dict[str, float] = None) -> None:
         self.finalPerf = aggregate_perf[-1]
+        self.benchmarkReturns = benchmark_returns if benchmark_returns else {}
         sorted_by_gain = sorted(final_positions, key=lambda x: x.gain)
         self.absoluteWinners = list(reversed(sorted_by_gain[-5:]))
         self.absoluteLosers = sorted_by_gain[:5]
@@ -45,6 +50,7 @@ class FinalSummary:
 ## Summary from {Utils.dateRangeStr(self.startDate, self.endDate)}
 ### Overall: {Utils.currency(self.finalPerf.totalGain)}, {Utils.percent(self.finalPerf.totalGain / self.finalPerf.totalCostBasis)}
 ### Non FB: {Utils.currency(self.finalPerf.nonFBGain)}, {Utils.percent(self.finalPerf.nonFBGain / self.finalPerf.nonFBCostBasis)}
+### Time weighted: {Utils.percent(self.finalPerf.timeWeightedReturn)}{''.join(f', {symbol} {Utils.percent(r)}' for symbol, r in self.benchmarkReturns.items())}
 
 ### Biggest winners
 | Symbol | Delta |
@@ -79,33 +85,84 @@ class FinalSummary:
         return text
 
 class RenderPortfolio:
-    def __init__(self, dest: str) -> None:
-        self.portfolio = Portfolio()
+    PERIODS = ['week', 'month', 'quarter', 'year', 'ytd']
+
+    def __init__(self, dest: str, client: ServiceClient = None, workers: int = 1, projection: bool = False) -> None:
+        # with a client, the time series come from the portfolio service instead of a local Portfolio
+        self.client = client
+        self.portfolio = None if client else Portfolio()
         self.dest = dest
+        self.workers = workers
+        self.renderer = ChartRenderer()
+        self.projection = projection
+        self.bands: ProjectionBands = None
 
     def timeseries(self, start_date: date, end_date: date):
+        Utils.log(f'Computing timeseries {Utils.dateRangeStr(start_date, end_date)}')
+        (aggregate_perf, final_positions) = self.timeSeriesPeriods([start_date], end_date)[start_date]
+        self.report(start_date, end_date, aggregate_perf, final_positions)
+
+    def timeSeriesPeriods(self, start_dates: List[date], end_date: date) -> Dict[date, Tuple[List[AggregatePerfRow], List[FinalPosition]]]:
+        if not self.client:
+            return self.portfolio.timeSeriesPeriods(start_dates, end_date)
+        results = self.client.get('/timeseries', start=[d.isoformat() for d in start_dates], end=end_date.isoformat())
+        return {date.fromisoformat(start): (
+            [AggregatePerfRow(**{**row, 'date': date.fromisoformat(row['date'])}) for row in result['aggregatePerf']],
+            [FinalPosition(**row) for row in result['finalPositions']],
+        ) for start, result in results.items()}
+
+    def periodStart(self, period: str, end_date: date) -> date:
+        if period == 'ytd':
+            return datetime(year=end_date.year, month=1, day=1).date()
+        days = {'week': 7, 'month': 30, 'quarter': 90, 'year': 365}[period]
+        return end_date - timedelta(days=days)
+
+    def periods(self, periods: List[str]):
+        # every period ends today, so they are all slices of one time series over the longest
+        end_date = Utils.today()
+        start_dates = {period: self.periodStart(period, end_date) for period in periods}
+        Utils.log(f'Computing timeseries for {", ".join(periods)}')
+        results = self.timeSeriesPeriods(list(set(start_dates.values())), end_date)
+
+        # the charts don't depend on each other, so with several workers they are drawn in parallel
+        Utils.log(f'Rendering {len(periods)} charts')
+        charts = [self.chartData(results[start_dates[period]][0], start_dates[period], end_date) for period in periods]
+        chart_filenames = ChartRenderer.renderAll(charts, self.workers)
+        for (period, chart_filename) in zip(periods, chart_filenames):
+            (aggregate_perf, final_positions) = results[start_dates[period]]
+            self.report(start_dates[period], end_date, aggregate_perf, final_positions, chart_filename)
+
+    def report(self, start_date: date, end_date: date, aggregate_perf: List[AggregatePerfRow], final_positions: List[FinalPosition], chart_filename: str = None):
         date_range_str = Utils.dateRangeStr(start_date, end_date)
 
-        Utils.log(f'Computing timeseries {date_range_str}')
-        (aggregate_perf, final_positions) = self.portfolio.timeSeries(start_date, end_date)
-
         # write local csv files
         Utils.log('Writing CSVs')
-        Utils.writeCSVObjects(f'artifacts/Timeseries {date_range_str}.csv', aggregate_perf)
-        Utils.writeCSVObjects(f'artifacts/Stocks {date_range_str}.csv', final_positions)
+        with Metrics.span('csv.write'):
+            Utils.writeCSVObjects(f'artifacts/Timeseries {date_range_str}.csv', aggregate_perf)
+            Utils.writeCSVObjects(f'artifacts/Stocks {date_range_str}.csv', final_positions)
+        Metrics.count('rows_written', len(aggregate_perf) + len(final_positions))
 
-        Utils.log('Rendering Chart')
-        chart_filename = self.renderAggregatePerfChart(aggregate_perf, start_date, end_date)
+        if chart_filename is None:
+            Utils.log('Rendering Chart')
+            chart_filename = self.renderAggregatePerfChart(aggregate_perf, start_date, end_date)
 
         Utils.log('Generating markdown')
-        summaryMarkdown = FinalSummary(final_positions, aggregate_perf, start_date, end_date).markdown()
+        (symbols, prices) = self.benchmarkPrices(start_date, end_date)
+        benchmark_returns = {symbol: r for (symbol, r) in zip(symbols, Returns.total(prices).tolist()) if not np.isnan(r)}
+        summaryMarkdown = FinalSummary(final_positions, aggregate_perf, start_date, end_date, benchmark_returns).markdown()
+        if self.projection:
+            summaryMarkdown += Projection.markdown(self.projectionBands())
 
         if self.dest == "console":
             print(summaryMarkdown)
         elif self.dest == "email":
             Utils.log('Sending email')
+            from send_email import EmailSender
             EmailSender.sendMarkdown(f'Investment summary {date_range_str}', summaryMarkdown, [chart_filename])
             Utils.log('Sent email')
+        elif self.dest == "file":
+            with open(f'artifacts/Summary {date_range_str}.md', 'w') as f:
+                f.write(summaryMarkdown)
         else:
             raise Exception(f'Unknown dest {self.dest}')
 
@@ -132,114 +189,67 @@ class RenderPortfolio:
         self.timeseries(start_date, end_date)
 
     def renderAggregatePerfChart(self, aggregate_perf: List[AggregatePerfRow], start_date: date, end_date: date) -> str:
-        fig, (ax1, ax2, ax3) = plt.subplots(3, 1)
-
-        fig.set_size_inches(20, 15)
-        fig.set_dpi(100)
-
-        ax1.set_xlabel('Date')
-        ax1.set_ylabel('Value')
-        ax1.grid()
-
-        ax1.get_yaxis().set_major_formatter(tick.FuncFormatter(lambda x, _: Utils.currency(x)))
-        
-        dates = [r.date for r in aggregate_perf]
+        filename = self.renderer.render(self.chartData(aggregate_perf, start_date, end_date))
+        Utils.log(f'\nWrote {filename}')
+        return filename
 
+    def chartData(self, aggregate_perf: List[AggregatePerfRow], start_date: date, end_date: date) -> ChartData:
         non_fb_value = [r.nonFBValue for r in aggregate_perf]
-        net_non_fb_value = [r.netNonFBValue for r in aggregate_perf]
-
-        ax1.plot(dates, non_fb_value, label='Value')
-        ax1.plot(dates, net_non_fb_value, label='Net value')
-        ax1.plot(dates, self.stockPriceHistoryToPlot('VTI', start_date, end_date, non_fb_value[0]), label = 'VTI')
-
-        min_index = np.argmin(non_fb_value)
-        ax1.annotate(
-            Utils.currency(non_fb_value[min_index]),
-            (dates[min_index], non_fb_value[min_index]),
-            color='red'
-        )
-
-        max_index = np.argmax(non_fb_value)
-        ax1.annotate(
-            Utils.currency(non_fb_value[max_index]),
-            (dates[max_index], non_fb_value[max_index]),
-            color='green'
-        )
-
-        ax1.annotate(
-            Utils.currency(non_fb_value[-1]),
-            (dates[-1], non_fb_value[-1]),
-            color='black'
+        (symbols, prices) = self.benchmarkPrices(start_date, end_date)
+        scaled = Returns.scaled(prices, non_fb_value[0])
+        return ChartData(
+            f'artifacts/Plot {Utils.dateRangeStr(start_date, end_date)}.png',
+            [r.date for r in aggregate_perf],
+            non_fb_value,
+            [r.netNonFBValue for r in aggregate_perf],
+            {symbol: scaled[:, i].tolist() for (i, symbol) in enumerate(symbols) if not np.isnan(scaled[:, i]).all()},
+            [r.nonFBGain for r in aggregate_perf],
+            [r.deposits for r in aggregate_perf],
+            [r.withdrawals for r in aggregate_perf],
+            self.projectionBands() if self.projection else None,
         )
 
-        ax2.set_ylabel('Gain')
-        ax2.get_yaxis().set_major_formatter(tick.FuncFormatter(lambda x, _: Utils.currency(x)))
-        ax2.grid()
-        non_fb_gain = [r.nonFBGain for r in aggregate_perf]
-        ax2.plot(dates, non_fb_gain, label='Gain')
-        min_index = np.argmin(non_fb_gain)
-        ax2.annotate(
-            Utils.currency(non_fb_gain[min_index]),
-            (dates[min_index], non_fb_gain[min_index]),
-            color='red'
-        )
-
-        max_index = np.argmax(non_fb_gain)
-        ax2.annotate(
-            Utils.currency(non_fb_gain[max_index]),
-            (dates[max_index], non_fb_gain[max_index]),
-            color='green'
-        )
-
-        ax2.annotate(
-            Utils.currency(non_fb_gain[-1]),
-            (dates[-1], non_fb_gain[-1]),
-            color='black'
-        )
-
-        ax3.bar(dates, [r.deposits for r in aggregate_perf], color='blue')
-        ax3.bar(dates, [-1*r.withdrawals for r in aggregate_perf], color='red')
-        ax3.set_ylabel('Transactions')
-        ax3.grid()
-
-        ax1.legend()
-        filename = f'artifacts/Plot {Utils.dateRangeStr(start_date, end_date)}.png'
-        plt.savefig(filename)
-        Utils.log(f'\nWrote {filename}')
-        return filename
-
-    def stockPriceHistoryToPlot(self, symbol: str, start_date: date, end_date: date, scale_to: float):
-        series = self.portfolio.priceHistory.priceHistory(symbol, start_date, end_date)
-        # adjust for scale
-        i=0
-        while np.isnan(series[i]):
-            i+=1
-        multiplier = scale_to / series[i]
-        return [multiplier * v for v in series]
+    def projectionBands(self) -> ProjectionBands:
+        # today's holdings are the same for every period, so they are projected once per run
+        if self.bands is None:
+            Utils.log('Projecting holdings')
+            if self.client:
+                bands = self.client.get('/projection', workers=self.workers)
+                self.bands = ProjectionBands(**{**bands, 'dates': [date.fromisoformat(d) for d in bands['dates']]})
+            else:
+                self.bands = Projection(self.portfolio).simulate(workers=self.workers)
+        return self.bands
+
+    def benchmarkPrices(self, start_date: date, end_date: date) -> Tuple[List[str], np.ndarray]:
+        # days x benchmarks prices, NaN where there's no data
+        symbols = DataContext.benchmarks()
+        if self.client:
+            series = [self.client.get('/price_history', symbol=symbol, start=start_date.isoformat(), end=end_date.isoformat()) for symbol in symbols]
+            return (symbols, np.array(series, dtype=float).reshape(len(symbols), (end_date - start_date).days + 1).T)
+        return (symbols, self.portfolio.priceHistory.priceHistories(symbols, start_date, end_date))
 
 def main():
     Utils.log("Start render_portfolio")
     parser = argparse.ArgumentParser()
-    parser.add_argument('period', choices=['week', 'month', 'quarter', 'year', 'ytd', 'test'])
-    parser.add_argument('-d', '--dest', choices=['console', 'email'], default='console')
+    parser.add_argument('period', nargs='+', choices=RenderPortfolio.PERIODS + ['all', 'test'])
+    parser.add_argument('-d', '--dest', choices=['console', 'email', 'file'], default='console')
+    parser.add_argument('--local', action='store_true', help="don't use a running portfolio_service.py")
+    parser.add_argument('-w', '--workers', type=int, default=1, help='processes to draw the charts of several periods with')
+    parser.add_argument('--projection', action='store_true', help='add a simulated projection of the current holdings')
+    Metrics.addArguments(parser)
     args = parser.parse_args()
-    rp = RenderPortfolio(args.dest)
-
-    Utils.log(args)
-
-    period = args.period
-    if period == 'week':
-        rp.lastWeek()
-    elif period == 'month':
-        rp.lastMonth()
-    elif period == 'quarter':
-        rp.lastQuarter()
-    elif period == 'year':
-        rp.lastYear()
-    elif period == 'ytd':
-        rp.ytd()
-    elif period == 'test':
-        print("Test 123\n")
+
+    with Metrics.profiling('render_portfolio', args):
+        if args.period == ['test']:
+            print("Test 123\n")
+            return
+
+        rp = RenderPortfolio(args.dest, None if args.local else ServiceClient.connect(), args.workers, args.projection)
+
+        Utils.log(args)
+
+        periods = RenderPortfolio.PERIODS if 'all' in args.period else list(dict.fromkeys(p for p in args.period if p != 'test'))
+        rp.periods(periods)
 
 def test():
     rp = RenderPortfolio('console')
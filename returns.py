@@ -0,0 +1,80 @@
+import csv
+import os
+from typing import List
+import numpy as np
+
+class Returns:
+    # Returns from aligned dates x positions arrays of value and cost basis. Cost basis only moves
+    # with trades, by the amount bought, granted or sold, so its daily change is the day's cash flow.
+    BENCHMARKS_FILE_NAME = 'data/benchmarks.csv'
+    DEFAULT_BENCHMARKS = ['VTI']
+    DAYS_PER_YEAR = 365
+    MAX_ITERATIONS = 50
+    TOLERANCE = 1e-10
+
+    def benchmarks() -> List[str]:
+        # symbols the portfolio is compared against, from the Symbol column of data/benchmarks.csv
+        if not os.path.exists(Returns.BENCHMARKS_FILE_NAME):
+            return Returns.DEFAULT_BENCHMARKS
+        with open(Returns.BENCHMARKS_FILE_NAME) as f:
+            return list(dict.fromkeys(row['Symbol'] for row in csv.DictReader(f) if row['Symbol']))
+
+    def flows(cost_basis: np.ndarray) -> np.ndarray:
+        # money put in, or taken out if negative, on each day. The first day's is the value held at the
+        # start plus that day's trades.
+        return np.diff(cost_basis, axis=0, prepend=np.zeros_like(cost_basis[:1]))
+
+    def timeWeighted(value: np.ndarray, cost_basis: np.ndarray) -> np.ndarray:
+        # daily time weighted return, with each day's trades counted at its close
+        daily = np.zeros(value.shape)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            daily[1:] = (value[1:] - np.diff(cost_basis, axis=0)) / value[:-1] - 1
+        daily[~np.isfinite(daily)] = 0
+        return daily
+
+    def cumulative(daily: np.ndarray) -> np.ndarray:
+        return np.cumprod(1 + daily, axis=0) - 1
+
+    def irr(value: np.ndarray, cost_basis: np.ndarray) -> np.ndarray:
+        # Annualized money weighted return of every position: the start value and each day's flows
+        # are paid in, and the final value paid out
+        cash_flows = -Returns.flows(cost_basis)
+        cash_flows[-1] += value[-1]
+        (days, columns) = np.nonzero(cash_flows)
+        return Returns.irrOfFlows(columns, days, cash_flows[days, columns], cash_flows.shape[1])
+
+    def irrOfFlows(columns: np.ndarray, days: np.ndarray, amounts: np.ndarray, num_columns: int) -> np.ndarray:
+        # irr() from the days with a cash flow: column, days from the start and amount, at most one per
+        # column and day. Newton's method is run on all columns at once, on the continuously compounded
+        # rate, where the net present value is smooth and monotonic. NaN for columns that never had
+        # money both in and out, or didn't converge.
+        years = days / Returns.DAYS_PER_YEAR
+        has_flows = (np.bincount(columns[amounts > 0], minlength=num_columns) > 0) & (np.bincount(columns[amounts < 0], minlength=num_columns) > 0)
+        rate = np.zeros(num_columns)
+        converged = np.zeros(num_columns, dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for _ in range(Returns.MAX_ITERATIONS):
+                discounted = amounts * np.exp(-years * rate[columns])
+                npv = np.bincount(columns, weights=discounted, minlength=num_columns)
+                slope = -np.bincount(columns, weights=years * discounted, minlength=num_columns)
+                step = np.where(converged | ~has_flows, 0.0, npv / slope)
+                rate = np.clip(rate - np.nan_to_num(step), -20, 20)
+                converged |= np.abs(step) < Returns.TOLERANCE
+                if converged[has_flows].all():
+                    break
+        return np.where(has_flows & converged, np.expm1(rate), np.nan)
+
+    def scaled(prices: np.ndarray, scale_to: float) -> np.ndarray:
+        # dates x symbols prices, NaN where missing, each scaled so its first price is scale_to
+        first = np.argmax(~np.isnan(prices), axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return prices * (scale_to / prices[first, np.arange(prices.shape[1])])
+
+    def total(prices: np.ndarray) -> np.ndarray:
+        # return of each column from its first price to its last
+        seen = ~np.isnan(prices)
+        first = np.argmax(seen, axis=0)
+        last = len(prices) - 1 - np.argmax(seen[::-1], axis=0)
+        columns = np.arange(prices.shape[1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return prices[last, columns] / prices[first, columns] - 1
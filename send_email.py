@@ -1,43 +1,191 @@
 import email_config as config
+import argparse
+import email
+import email.policy
+import fcntl
+import os
 import smtplib
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import contextmanager
 from email.message import EmailMessage
 from email.mime.image import MIMEImage
-from typing import List
-import os
+from typing import List, Optional
+from metrics import Metrics
+from utils import Utils
 import markdown
 
+class SMTPConnection:
+    # One logged in connection, opened on first use and reused for every message after it.
+    # config.email may set 'smtp_ssl': False for a plain connection, e.g. to local_smtp.py.
+    TIMEOUT = 30
+
+    def __init__(self, settings=None) -> None:
+        self.settings = settings if settings else config.email
+        self.server: Optional[smtplib.SMTP] = None
+
+    def get(self) -> smtplib.SMTP:
+        if self.server is None:
+            if self.settings.get('smtp_ssl', True):
+                server = smtplib.SMTP_SSL(self.settings['smtp_host'], self.settings['smtp_port'], timeout=self.TIMEOUT)
+            else:
+                server = smtplib.SMTP(self.settings['smtp_host'], self.settings['smtp_port'], timeout=self.TIMEOUT)
+            server.ehlo()
+            if self.settings.get('password'):
+                server.login(self.settings['from'], self.settings['password'])
+            self.server = server
+        return self.server
+
+    def close(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+class EmailOutbox:
+    # Messages are written to a folder and sent later, oldest first, by a drain that holds the
+    # folder's lock. A message is deleted once the server accepts it. One the server rejects for
+    # good is moved to failed/, and anything else is retried by the next drain.
+    DIR_NAME = 'data/outbox'
+    FAILED = 'failed'
+    LOCK = '.lock'
+    LOG = 'drain.log'
+    MAX_ATTEMPTS = 3
+    BACKOFF_SECONDS = 2
+
+    def __init__(self, dir_name: str = DIR_NAME, connection: SMTPConnection = None) -> None:
+        self.dirName = dir_name
+        self.connection = connection if connection else SMTPConnection()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.dirName, name)
+
+    @Metrics.timed('email.enqueue')
+    def enqueue(self, msg: EmailMessage) -> str:
+        os.makedirs(self.dirName, exist_ok=True)
+        # names sort in the order messages were queued, and the rename makes each one appear whole
+        name = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}.eml'
+        with open(self.path(name + '.tmp'), 'wb') as f:
+            f.write(msg.as_bytes())
+        os.replace(self.path(name + '.tmp'), self.path(name))
+        Utils.log(f'Queued "{msg["Subject"]}"')
+        return self.path(name)
+
+    def queued(self) -> List[str]:
+        if not os.path.isdir(self.dirName):
+            return []
+        return sorted(self.path(name) for name in os.listdir(self.dirName) if name.endswith('.eml'))
+
+    def failed(self) -> List[str]:
+        if not os.path.isdir(self.path(self.FAILED)):
+            return []
+        return sorted(os.path.join(self.path(self.FAILED), name) for name in os.listdir(self.path(self.FAILED)) if name.endswith('.eml'))
+
+    @contextmanager
+    def locked(self):
+        os.makedirs(self.dirName, exist_ok=True)
+        with open(self.path(self.LOCK), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def drain(self) -> int:
+        sent = 0
+        with self.locked():
+            try:
+                for file_name in self.queued():
+                    with open(file_name, 'rb') as f:
+                        msg = email.message_from_bytes(f.read(), policy=email.policy.default)
+                    result = self.send(msg)
+                    if result is None:
+                        # the server is unreachable, so the rest would fail too
+                        break
+                    if result:
+                        os.remove(file_name)
+                        sent += 1
+                    else:
+                        os.makedirs(self.path(self.FAILED), exist_ok=True)
+                        os.replace(file_name, os.path.join(self.path(self.FAILED), os.path.basename(file_name)))
+            finally:
+                self.connection.close()
+        Utils.log(f'Sent {sent} emails, {len(self.queued())} still queued')
+        return sent
+
+    @Metrics.timed('email.send')
+    def send(self, msg: EmailMessage) -> Optional[bool]:
+        # True once sent, False if the server refused it for good, None if it couldn't be sent now
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                self.connection.get().send_message(msg)
+                Metrics.count('emails_sent')
+                return True
+            except smtplib.SMTPRecipientsRefused as e:
+                Utils.log(f'Dropping "{msg["Subject"]}": {e}')
+                return False
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code >= 500 and not isinstance(e, smtplib.SMTPAuthenticationError):
+                    Utils.log(f'Dropping "{msg["Subject"]}": {e}')
+                    return False
+                error = e
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+            Utils.log(f'Sending "{msg["Subject"]}" failed ({error}), attempt {attempt + 1}')
+            # start over on a new connection
+            self.connection.close()
+            if attempt + 1 < self.MAX_ATTEMPTS:
+                time.sleep(self.BACKOFF_SECONDS * 2 ** attempt)
+        return None
+
+    def drainInBackground(self) -> None:
+        # the drain outlives the report that started it, so what it logs goes to a file in the outbox
+        os.makedirs(self.dirName, exist_ok=True)
+        with open(self.path(self.LOG), 'a') as log:
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'drain'],
+                cwd=os.getcwd(),
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True
+            )
+
 class EmailSender:
+    # Sending queues the message in the outbox and leaves the delivery to a background drain,
+    # so reports don't wait on the mail server
     def sendMarkdown(subject:str, bodyMarkdown:str, attachments:List[str]) -> None:
         EmailSender.send(subject, markdown.markdown(bodyMarkdown, extensions=['tables', 'sane_lists']), attachments)
 
     def send(subject:str, body:str, attachments:List[str]) -> None:
-        try:
-            server = smtplib.SMTP_SSL(config.email['smtp_host'], config.email['smtp_port'])
-            server.ehlo()
-            server.login(config.email['from'], config.email['password'])
-
-            msg = EmailMessage()
-            msg.set_content(body)
-            msg['Subject'] = subject
-            msg['From'] = config.email['from']
-            msg['To'] = config.email['to']
+        outbox = EmailOutbox()
+        failed = outbox.failed()
+        if failed:
+            Utils.log(f'{len(failed)} emails were refused by the server and are in {outbox.path(outbox.FAILED)}, see {outbox.path(outbox.LOG)}')
+        outbox.enqueue(EmailSender.message(subject, body, attachments))
+        outbox.drainInBackground()
 
-            msg.add_alternative(body, subtype='html')
+    def message(subject:str, body:str, attachments:List[str]) -> EmailMessage:
+        msg = EmailMessage()
+        msg.set_content(body)
+        msg['Subject'] = subject
+        msg['From'] = config.email['from']
+        msg['To'] = config.email['to']
 
-            for attachment in attachments:
-                with open(attachment, 'rb') as f:
-                    img_data = f.read()
-                msg.attach(MIMEImage(img_data, name=os.path.basename(attachment)))
+        msg.add_alternative(body, subtype='html')
 
-            server.send_message(msg)
+        # attachments are read now, so later runs can overwrite the files before the message is sent
+        for attachment in attachments:
+            with open(attachment, 'rb') as f:
+                img_data = f.read()
+            msg.attach(MIMEImage(img_data, name=os.path.basename(attachment)))
+        return msg
 
-        except Exception as e:
-            print(e)
-        finally:
-            server.quit()
-
-if __name__ == "__main__":
-    str = """
+TEST_MARKDOWN = """
 # Testing
 | Column 1 | Column 2|
 | --- | --- |
@@ -49,6 +197,22 @@ if __name__ == "__main__":
 \t* Subbullet 1.1
 * Bullet 2
     """
-    print(markdown.markdown(str, extensions=['tables', 'sane_lists']))
-    #send_email('Testing 123',  markdown.markdown(str, extensions=['tables', 'sane_lists']), ['Plot 2021-01-01 to 2021-12-28.png'])
-    EmailSender.send('Testing 123',  markdown.markdown(str, extensions=['tables', 'sane_lists']), [])
\ No newline at end of file
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['drain', 'status', 'test'])
+    Metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    with Metrics.profiling('send_email', args):
+        outbox = EmailOutbox()
+        if args.command == 'drain':
+            outbox.drain()
+        elif args.command == 'status':
+            print(f'{len(outbox.queued())} emails queued in {outbox.dirName}, {len(outbox.failed())} failed')
+        else:
+            print(markdown.markdown(TEST_MARKDOWN, extensions=['tables', 'sane_lists']))
+            EmailSender.sendMarkdown('Testing 123', TEST_MARKDOWN, [])
+
+if __name__ == "__main__":
+    main()
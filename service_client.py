@@ -0,0 +1,32 @@
+import json
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Optional
+
+class ServiceClient:
+    # Talks to a running portfolio_service.py. The CLIs use it when the service is up and was started
+    # from the same folder, and otherwise compute everything themselves.
+    HOST = '127.0.0.1'
+    PORT = 8765
+    CONNECT_TIMEOUT = 0.2
+    TIMEOUT = 60
+
+    def __init__(self, port: int = PORT) -> None:
+        self.url = f'http://{self.HOST}:{port}'
+
+    def get(self, path: str, timeout: float = TIMEOUT, **params):
+        query = urllib.parse.urlencode(params, doseq=True)
+        with urllib.request.urlopen(f'{self.url}{path}?{query}', timeout=timeout) as response:
+            return json.loads(response.read())
+
+    def connect(port: int = PORT) -> Optional['ServiceClient']:
+        client = ServiceClient(port)
+        try:
+            health = client.get('/health', ServiceClient.CONNECT_TIMEOUT)
+        except (urllib.error.URLError, OSError, ValueError):
+            return None
+        if health.get('cwd') != os.getcwd():
+            return None
+        return client
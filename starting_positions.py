@@ -1,6 +1,7 @@
-import csv
 from dataclasses import dataclass
-from typing import Dict
+from input_cache import InputCache
+from typing import Dict, Tuple
+import numpy as np
 
 @dataclass
 class Position:
@@ -24,24 +25,42 @@ class StartingPositions:
 
     def __init__(self) -> None:
         self.positions: Dict[str, Position] = {}
+        # the same positions kept apart by account, keyed by (account, symbol)
+        self.accountPositions: Dict[Tuple[str, str], Position] = {}
 
     def load(self) -> Dict[str, Position]:
         if self.positions:
             print("Starting position data has already been loaded")
             return self.positions
 
-        with open(self.FILE_NAME) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                symbol = row['Symbol']
-                # ignoring account for now
-                if symbol not in self.positions:
-                    self.positions[symbol] = Position(symbol)
-                self.positions[symbol].quantity += float(row['Quantity'])
-                self.positions[symbol].costBasis += float(row['Cost Basis'])
-                self.positions[symbol].resetStartValue()
+        columns = InputCache().load(self.FILE_NAME, StartingPositions.parseColumns)
+        for (symbol, account, quantity, cost_basis) in zip(
+            InputCache.decode(columns, 'symbol'),
+            InputCache.decode(columns, 'account'),
+            columns['quantity'].tolist(),
+            columns['cost_basis'].tolist(),
+        ):
+            key = (account, symbol)
+            if symbol not in self.positions:
+                self.positions[symbol] = Position(symbol)
+            if key not in self.accountPositions:
+                self.accountPositions[key] = Position(symbol)
+            for position in [self.positions[symbol], self.accountPositions[key]]:
+                position.quantity += quantity
+                position.costBasis += cost_basis
+                position.resetStartValue()
         return self.positions
 
+    def parseColumns(file_name: str) -> Dict[str, np.ndarray]:
+        import pandas as pd
+        rows = pd.read_csv(file_name, dtype=str, keep_default_na=False)
+        return {
+            **InputCache.encode('symbol', rows['Symbol']),
+            **InputCache.encode('account', rows['Account']),
+            'quantity': rows['Quantity'].astype(float).to_numpy(),
+            'cost_basis': rows['Cost Basis'].astype(float).to_numpy(),
+        }
+
 if __name__ == "__main__":
     sp = StartingPositions()
     sp.load()
@@ -0,0 +1,99 @@
+import argparse
+import os
+from datetime import date
+from utils import Utils
+import numpy as np
+import pandas as pd
+from metrics import Metrics
+
+class SyntheticData:
+    # Writes a starting_positions.csv, trades.csv and prices.csv of any size, to exercise the
+    # reports without brokerage exports or a price download. Same seed, same files.
+    ACCOUNTS = ['Brokerage', 'IRA', 'Roth IRA', '401k', 'HSA', 'Trust']
+
+    def __init__(self, num_symbols: int, num_trades: int, years: int, seed: int = 0) -> None:
+        self.numSymbols = num_symbols
+        self.numTrades = num_trades
+        self.years = years
+        self.rng = np.random.default_rng(seed)
+        # VTI is always watched for the comparison chart, META is special cased in the reports
+        self.symbols = ['VTI', 'META'] + [f'SYN{i:04d}' for i in range(max(num_symbols - 2, 0))]
+        end_date = Utils.today()
+        self.dates = pd.bdate_range(date(end_date.year - years, end_date.month, 1), end_date).date
+
+    def write(self, dir_name: str) -> None:
+        os.makedirs(dir_name, exist_ok=True)
+        prices = self.prices()
+        Utils.log(f'Writing {prices.shape[0]} x {prices.shape[1]} prices')
+        prices.to_csv(os.path.join(dir_name, 'prices.csv'), float_format='%.4f')
+        Utils.log(f'Writing {self.numTrades} trades')
+        self.trades(prices).to_csv(os.path.join(dir_name, 'trades.csv'), index=False)
+        self.startingPositions(prices).to_csv(os.path.join(dir_name, 'starting_positions.csv'), index=False)
+
+    def prices(self) -> pd.DataFrame:
+        # geometric random walk per symbol
+        returns = self.rng.normal(0.0003, 0.02, (len(self.dates), len(self.symbols)))
+        start = self.rng.uniform(10, 500, len(self.symbols))
+        prices = pd.DataFrame(start * np.exp(np.cumsum(returns, axis=0)), index=self.dates, columns=self.symbols)
+        prices.index.name = 'Date'
+        return prices
+
+    def startingPositions(self, prices: pd.DataFrame) -> pd.DataFrame:
+        held = self.rng.choice(len(self.symbols), max(len(self.symbols) // 4, 1), replace=False)
+        quantity = self.rng.integers(1, 500, len(held)).astype(float)
+        return pd.DataFrame({
+            'Symbol': [self.symbols[i] for i in held],
+            'Quantity': quantity,
+            'Cost Basis': np.round(quantity * prices.iloc[0].to_numpy()[held] * self.rng.uniform(0.5, 1.2, len(held)), 2),
+            'Account': self.rng.choice(self.ACCOUNTS, len(held)),
+        })
+
+    def trades(self, prices: pd.DataFrame) -> pd.DataFrame:
+        n = self.numTrades
+        # keep the last few days free of trades so reports have a full trailing window
+        day = np.sort(self.rng.integers(0, max(len(self.dates) - 5, 1), n))
+        symbol = self.rng.integers(0, len(self.symbols), n)
+        account = self.rng.integers(0, len(self.ACCOUNTS), n)
+        quantity = np.round(self.rng.uniform(1, 100, n), 3)
+        action = np.where(self.rng.random(n) < 0.1, 'RSU', 'Buy').astype(object)
+
+        # Within an account and symbol, every other trade may sell part of the trade before it,
+        # so nothing is ever sold that isn't held
+        order = np.lexsort((day, symbol, account))
+        group = account[order] * len(self.symbols) + symbol[order]
+        nth = pd.Series(group).groupby(group).cumcount().to_numpy()
+        sell_positions = np.flatnonzero((nth % 2 == 1) & (self.rng.random(n) < 0.6))
+        sells = order[sell_positions]
+        previous = order[sell_positions - 1]
+        action[sells] = 'Sell'
+        quantity[sells] = np.round(quantity[previous] * self.rng.uniform(0.1, 0.9, len(sells)), 3)
+
+        close = prices.to_numpy()[day, symbol]
+        trades = pd.DataFrame({
+            'Date': pd.to_datetime(self.dates[day]).strftime('%m/%d/%y'),
+            'Action': action,
+            'Symbol': np.array(self.symbols, dtype=object)[symbol],
+            'Quantity': quantity,
+            'Price': np.round(close * self.rng.uniform(0.98, 1.02, n), 2),
+            'Account': np.array(self.ACCOUNTS, dtype=object)[account],
+        })
+        # trades of a group stay in order on the same day, so a sell follows the buy it sells from
+        return trades.iloc[order].sort_values('Date', key=lambda d: pd.to_datetime(d, format='%m/%d/%y'), kind='stable')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--symbols', type=int, default=500)
+    parser.add_argument('-t', '--trades', type=int, default=50000)
+    parser.add_argument('-y', '--years', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-d', '--dir', default='data')
+    Metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    with Metrics.profiling('synthetic_data', args):
+        Utils.log(f'Generating {args.symbols} symbols, {args.trades} trades, {args.years} years into {args.dir}')
+        SyntheticData(args.symbols, args.trades, args.years, args.seed).write(args.dir)
+        Utils.log('Finished generating')
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
-import csv
+from bisect import bisect_left
 from datetime import datetime, date
 from dataclasses import dataclass
-from typing import List
+from input_cache import InputCache
+from typing import Dict, List
+import numpy as np
 
 @dataclass
 class Trade:
@@ -17,26 +19,61 @@ class Trades:
 
     def __init__(self) -> None:
         self.trades: List[Trade] = []
+        self.dates: List[date] = []
+        # the same trades as typed columns, see parseColumns
+        self.columns: Dict[str, np.ndarray] = {}
+
+    def parse(row: Dict[str, str]) -> Trade:
+        return Trade(
+            datetime.strptime(row['Date'], "%m/%d/%y").date(),
+            row['Action'],
+            row['Symbol'],
+            float(row['Quantity']),
+            float(row['Price']),
+            row['Account']
+        )
+
+    def parseColumns(file_name: str) -> Dict[str, np.ndarray]:
+        # the whole file in one go, sorted by date
+        import pandas as pd
+        rows = pd.read_csv(file_name, dtype=str, keep_default_na=False)
+        days = pd.to_datetime(rows['Date'], format="%m/%d/%y").to_numpy().astype('datetime64[D]').astype(np.int64) + date(1970, 1, 1).toordinal()
+        order = np.argsort(days, kind='stable')
+        rows = rows.iloc[order]
+        return {
+            'date': days[order].astype(np.int32),
+            **InputCache.encode('action', rows['Action']),
+            **InputCache.encode('symbol', rows['Symbol']),
+            'quantity': rows['Quantity'].astype(float).to_numpy(),
+            'price': rows['Price'].astype(float).to_numpy(),
+            **InputCache.encode('account', rows['Account']),
+        }
 
     def load(self) -> List[Trade]:
         if self.trades:
             print("Trades data has already been loaded")
             return self.trades
-        
-        with open(self.FILE_NAME) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                self.trades.append(Trade(
-                    datetime.strptime(row['Date'], "%m/%d/%y").date(),
-                    row['Action'],
-                    row['Symbol'],
-                    float(row['Quantity']),
-                    float(row['Price']),
-                    row['Account']
-                ))
-        self.trades.sort(key = lambda trade:trade.date)
+
+        columns = InputCache().load(self.FILE_NAME, Trades.parseColumns)
+        self.columns = columns
+        days = columns['date'].tolist()
+        dates = {day: date.fromordinal(day) for day in set(days)}
+        self.trades = list(map(
+            Trade,
+            map(dates.__getitem__, days),
+            InputCache.decode(columns, 'action'),
+            InputCache.decode(columns, 'symbol'),
+            columns['quantity'].tolist(),
+            columns['price'].tolist(),
+            InputCache.decode(columns, 'account'),
+        ))
+        self.dates = [t.date for t in self.trades]
         return self.trades
 
+    def since(self, start_date: date) -> List[Trade]:
+        # trades are sorted by date, so this is a binary search
+        return self.trades[bisect_left(self.dates, start_date):]
+
 if __name__ == "__main__":
     t = Trades()
     t.load()
@@ -1,17 +1,9 @@
-from trades import Trades
-from starting_positions import StartingPositions
+from data_context import DataContext
 
 class Watchlist:
     def load():
-        watchlist = set()
-        
-        [watchlist.add(symbol) for symbol in StartingPositions().load()]
-        [watchlist.add(t.symbol) for t in Trades().load()]
-
-        # for comparison graphs
-        watchlist.add('VTI')
-
-        return watchlist
+        # every symbol in the starting positions and trades, plus the benchmarks for comparison graphs
+        return set(DataContext.watchlist())
 
 if __name__ == "__main__":
     print(Watchlist.load())
\ No newline at end of file